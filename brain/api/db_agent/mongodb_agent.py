@@ -12,59 +12,56 @@ logger = get_logger(__name__)
 class DBAgent(MongoDB, BaseDBAgent):
     """
     MongoDB-based implementation of DB agent.
+    Users and snapshots are fetched from their own collections (see `brain.utils.mongodb`), by their indexes.
     """
 
     def find_users(self) -> list:
         # _id is used for "db uniqueness" only, fetch user_id and username
-        users_list = self.find({}, {'_id': 0, 'user_id': 1, 'username': 1})
+        users_list = self.users.find({}, {'_id': 0, 'user_id': 1, 'username': 1})
         users_list = list(users_list)
         return users_list
 
     def find_user(self, user_id: int) -> dict:
-        logger.debug(f'fetching all users from database')
+        logger.debug(f'fetching user from database, {user_id=}')
         user_id = str(user_id)
-        # exclude _id snapshots list
-        user = self.find_one({'_id': user_id}, {'_id': 0, 'snapshots': 0})
+        user = self.users.find_one({'_id': user_id}, {'_id': 0})
         return user
 
     def find_snapshots(self, user_id: int) -> list:
-        logger.debug(f'fetching snapshot from database, {user_id=}')
+        logger.debug(f'fetching snapshots from database, {user_id=}')
         user_id = str(user_id)
-        # take only uuid and datetime from snapshots
-        snapshots = self.find_one({'_id': user_id},
-                                  {'_id': 0, 'snapshots.uuid': 1, 'snapshots.datetime': 1})
-        if snapshots is None:
+        # take only uuid and datetime of the snapshots, ordered by the (user_id, datetime) index
+        snapshots = self.snapshots.find({'user_id': user_id}, {'_id': 0, 'uuid': 1, 'datetime': 1}).sort('datetime')
+        snapshots = list(snapshots)
+        if not snapshots and self.users.find_one({'_id': user_id}, {'_id': 1}) is None:
             logger.info(f'could not find entry with {user_id=}')
-            return snapshots
-        return snapshots['snapshots']
+            return None
+        return snapshots
 
     def find_snapshot(self, user_id: int, snapshot_id: int) -> dict:
         logger.debug(f'fetching snapshot from database, {user_id=}, {snapshot_id=}')
         user_id = str(user_id)
         snapshot_id = str(snapshot_id)
-        projection = {'snapshots': {'$elemMatch': {'_id': snapshot_id}}, '_id': 0,
-                      'snapshots.uuid': 1, 'snapshots.datetime': 1, 'snapshots.results': 1}
-        snapshot = self.find_one({'_id': user_id}, projection)
+        snapshot = self.snapshots.find_one({'user_id': user_id, 'uuid': snapshot_id},
+                                           {'_id': 0, 'uuid': 1, 'datetime': 1, 'results': 1})
         if not snapshot:
             logger.info(f'could not find entry with {user_id=}, {snapshot_id=}')
             return None
-        snapshots = snapshot['snapshots']
-        snapshot = snapshots[0]
         # do not return the full results, only names
-        snapshot['results'] = list(snapshot['results'].keys())
+        snapshot['results'] = list(snapshot.get('results', {}).keys())
         return snapshot
 
     def find_result(self, user_id: int, snapshot_id: int, result_name: str) -> dict:
         logger.debug(f'fetching snapshot result from database, {user_id=}, {snapshot_id=}, {result_name=}')
         user_id = str(user_id)
         snapshot_id = str(snapshot_id)
-        # take result from snapshot results
-        entry = self.find_one({'_id': user_id}, {'snapshots': {'$elemMatch': {'_id': snapshot_id}}, '_id': 0,
-                                                 f'snapshots.results.{result_name}': 1})
-        if not entry:
+        # take only the result from the snapshot results
+        snapshot = self.snapshots.find_one({'user_id': user_id, 'uuid': snapshot_id},
+                                           {'_id': 0, f'results.{result_name}': 1})
+        if not snapshot:
             logger.info(f'could not find entry with {user_id=}, {snapshot_id=}')
             return None
-        results = entry['snapshots'][0]['results']
+        results = snapshot.get('results', {})
         if result_name not in results:
             logger.info(f'could not find entry with {user_id=}, {snapshot_id=}, {result_name=}')
             return None
@@ -0,0 +1,64 @@
+"""
+The SQLite agent module provides a DB agent with SQLite implementation.
+"""
+
+import json
+
+from brain.api.db_agent.base_db_agent import BaseDBAgent
+from brain.utils.common import get_logger
+from brain.utils.sqlite import SQLite
+
+logger = get_logger(__name__)
+
+
+class DBAgent(SQLite, BaseDBAgent):
+    """
+    SQLite-based implementation of DB agent.
+    Users, snapshots and results are fetched from their own tables (see `brain.utils.sqlite`), by their indexes.
+    """
+
+    def find_users(self) -> list:
+        logger.debug(f'fetching all users from database')
+        rows = self.connection.execute('SELECT user_id, username FROM users ORDER BY rowid')
+        return [dict(row) for row in rows]
+
+    def find_user(self, user_id: int) -> dict:
+        logger.debug(f'fetching user from database, {user_id=}')
+        row = self.connection.execute('SELECT user_id, username, birthday, gender FROM users WHERE user_id = ?',
+                                      (str(user_id),)).fetchone()
+        return dict(row) if row else None
+
+    def find_snapshots(self, user_id: int) -> list:
+        logger.debug(f'fetching snapshots from database, {user_id=}')
+        user_id = str(user_id)
+        rows = self.connection.execute('SELECT snapshot_id AS uuid, datetime FROM snapshots WHERE user_id = ? '
+                                       'ORDER BY datetime', (user_id,))
+        snapshots = [dict(row) for row in rows]
+        if not snapshots and self.find_user(user_id) is None:
+            logger.info(f'could not find entry with {user_id=}')
+            return None
+        return snapshots
+
+    def find_snapshot(self, user_id: int, snapshot_id: int) -> dict:
+        logger.debug(f'fetching snapshot from database, {user_id=}, {snapshot_id=}')
+        key = (str(user_id), str(snapshot_id))
+        row = self.connection.execute('SELECT snapshot_id AS uuid, datetime FROM snapshots '
+                                      'WHERE user_id = ? AND snapshot_id = ?', key).fetchone()
+        if not row:
+            logger.info(f'could not find entry with {user_id=}, {snapshot_id=}')
+            return None
+        snapshot = dict(row)
+        # do not return the full results, only names
+        rows = self.connection.execute('SELECT name FROM results WHERE user_id = ? AND snapshot_id = ? ORDER BY rowid',
+                                       key)
+        snapshot['results'] = [name for name, in rows]
+        return snapshot
+
+    def find_result(self, user_id: int, snapshot_id: int, result_name: str) -> dict:
+        logger.debug(f'fetching snapshot result from database, {user_id=}, {snapshot_id=}, {result_name=}')
+        row = self.connection.execute('SELECT result FROM results WHERE user_id = ? AND snapshot_id = ? AND name = ?',
+                                      (str(user_id), str(snapshot_id), result_name)).fetchone()
+        if not row:
+            logger.info(f'could not find entry with {user_id=}, {snapshot_id=}, {result_name=}')
+            return None
+        return json.loads(row['result'])
@@ -11,6 +11,7 @@ logger = get_logger(__name__)
 def api_get(host: str, port: int, path: str) -> str:
     """
     Get data from the API using a specific path.
+    The request is sent using the shared HTTP client, so consecutive requests reuse the same connection.
 
     :param host: hostname of the API server
     :param port: port number of the API server
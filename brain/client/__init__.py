@@ -2,4 +2,5 @@
 The client package is responsible for reading snapshots from sample file and streaming them to the server.
 """
 
-from .client import upload_sample
+from .client import upload_sample, build_index, import_sample
+from .pipeline import UploadError
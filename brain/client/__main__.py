@@ -2,7 +2,8 @@ import click
 
 from brain.utils.common import cli_suppress, get_logger
 from brain.utils.consts import *
-from .client import upload_sample
+from .client import upload_sample, build_index, import_sample
+from .pipeline import DEFAULT_BATCH_BYTES
 
 logger = get_logger(__name__)
 
@@ -15,17 +16,55 @@ def cli():
 @cli.command('upload-sample')
 @click.option('-h', '--host', type=click.STRING, default=SERVER_HOST, help='Server hostname.')
 @click.option('-p', '--port', type=click.INT, default=SERVER_PORT, help='Server port number.')
+@click.option('-s', '--start', type=click.INT, default=0,
+              help='Index of the first snapshot to upload (requires an index, see build-index).')
+@click.option('-c', '--concurrency', type=click.IntRange(min=1), default=1,
+              help='Number of requests to send at the same time.')
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=1,
+              help='Maximal number of snapshots to send in a single request.')
+@click.option('--batch-bytes', type=click.IntRange(min=1), default=DEFAULT_BATCH_BYTES,
+              help='Maximal size (in bytes) of the snapshots sent in a single request.')
 @click.argument('path', type=click.STRING)
 @cli_suppress
-def cli_upload_sample(host, port, path):
+def cli_upload_sample(host, port, start, concurrency, batch_size, batch_bytes, path):
     """
     Reads the sample file and stream the snapshots to the server.
     """
 
-    logger.info(f'running cli upload-sample: {host=}, {port=}, {path=}')
-    count = upload_sample(host, port, path)
+    logger.info(f'running cli upload-sample: {host=}, {port=}, {start=}, {concurrency=}, {batch_size=}, '
+                f'{batch_bytes=}, {path=}')
+    count = upload_sample(host, port, path, start=start, concurrency=concurrency, batch_size=batch_size,
+                          batch_bytes=batch_bytes)
     print(f'Successfully uploaded {count} snapshots')
 
 
+@cli.command('import-sample')
+@click.option('-h', '--host', type=click.STRING, default=SERVER_HOST, help='Server hostname.')
+@click.option('-p', '--port', type=click.INT, default=SERVER_PORT, help='Server port number.')
+@click.argument('path', type=click.STRING)
+@cli_suppress
+def cli_import_sample(host, port, path):
+    """
+    Streams the whole sample file to the server, which reads the snapshots from it.
+    """
+
+    logger.info(f'running cli import-sample: {host=}, {port=}, {path=}')
+    count = import_sample(host, port, path)
+    print(f'Successfully imported {count} snapshots')
+
+
+@cli.command('build-index')
+@click.argument('path', type=click.STRING)
+@cli_suppress
+def cli_build_index(path):
+    """
+    Builds an offset index for the sample file, which allows random access and parallel reads.
+    """
+
+    logger.info(f'running cli build-index: {path=}')
+    count = build_index(path)
+    print(f'Successfully indexed {count} snapshots')
+
+
 if __name__ == '__main__':
     cli(prog_name='client')
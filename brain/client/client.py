@@ -4,33 +4,49 @@ The client module contains the main logic of the client via `upload_sample`.
 
 from brain.utils.common import get_logger
 from brain.utils.consts import config
-from .reader import Reader
+from .pipeline import DEFAULT_BATCH_BYTES, upload_pipelined
+from .reader import Reader, get_index_path
 from .server_agent import load_server_agent
 
 logger = get_logger(__name__)
 
 
-def upload_sample(host: str, port: int, path: str) -> int:
+def upload_sample(host: str, port: int, path: str, start: int = 0, concurrency: int = 1, batch_size: int = 1,
+                  batch_bytes: int = DEFAULT_BATCH_BYTES) -> int:
     """
     Reads the sample file and streams the snapshots to the server.
 
     :param host: server hostname.
     :param port: server port number.
     :param path: sample file path.
+    :param start: index of the first snapshot to upload, for example to resume a partial upload
+        (requires an index, see `build_index`).
+    :param concurrency: number of snapshots to send at the same time. If greater than 1, the upload is pipelined
+        (see `brain.client.pipeline`), and failed snapshots are reported only once the upload is done.
+    :param batch_size: maximal number of snapshots to send in a single request. If greater than 1, the upload is
+        pipelined as well.
+    :param batch_bytes: maximal size (in bytes) of the snapshots sent in a single request.
     :return: number of uploaded snapshots.
+    :raises: UploadError if some of the snapshots could not be uploaded in a pipelined upload.
     """
 
     # initialize reader
-    logger.info(f'uploading samples to {host}:{port} from {path=}')
+    logger.info(f'uploading samples to {host}:{port} from {path=}, {start=}, {concurrency=}, {batch_size=}')
     file_fmt = config['sample_format']['file_format']
     msg_fmt = config['sample_format']['message_format']
-    reader = Reader(path, file_fmt, msg_fmt)
+    # the snapshots are transcoded to the server format without being parsed
+    reader = Reader(path, file_fmt, msg_fmt, start=start, raw=True)
     user = reader.user
 
     # initialize server agent
     protocol = config['client_server_protocol']
     server_agent_module = load_server_agent(protocol)
-    server_agent = server_agent_module.ServerAgent(host, port)
+    server_agent = server_agent_module.ServerAgent(host, port, concurrency)
+
+    if concurrency > 1 or batch_size > 1:
+        count = upload_pipelined(reader, server_agent, concurrency, batch_size=batch_size, batch_bytes=batch_bytes)
+        logger.info(f'all {count} snapshots were successfully uploaded')
+        return count
 
     count = 0
     for snapshot in reader:
@@ -40,3 +56,42 @@ def upload_sample(host: str, port: int, path: str) -> int:
 
     logger.info(f'all {count} snapshots were successfully uploaded')
     return count
+
+
+def build_index(path: str) -> int:
+    """
+    Builds the offset index of the sample file, and saves it next to the sample file.
+    The index allows the reader to seek to any snapshot and to split the sample file into ranges.
+
+    :param path: sample file path.
+    :return: number of indexed snapshots.
+    """
+
+    logger.info(f'building index for {path=}')
+    file_fmt = config['sample_format']['file_format']
+    msg_fmt = config['sample_format']['message_format']
+    reader = Reader(path, file_fmt, msg_fmt)
+    index = reader.build_index()
+    index.save(get_index_path(path))
+    return len(index)
+
+
+def import_sample(host: str, port: int, path: str) -> int:
+    """
+    Streams the whole sample file to the server as is, and lets the server read the snapshots from it.
+    Unlike `upload_sample`, the snapshots are not read nor constructed by the client, so the upload of large
+    (archived) sample files is bounded by the disk and the network.
+
+    :param host: server hostname.
+    :param port: server port number.
+    :param path: sample file path (might be gzip compressed).
+    :return: number of imported snapshots.
+    """
+
+    logger.info(f'importing sample to {host}:{port} from {path=}')
+    protocol = config['client_server_protocol']
+    server_agent_module = load_server_agent(protocol)
+    server_agent = server_agent_module.ServerAgent(host, port)
+    count = server_agent.send_sample(path)
+    logger.info(f'all {count} snapshots were successfully imported')
+    return count
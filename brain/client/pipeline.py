@@ -0,0 +1,142 @@
+"""
+The pipeline module contains the pipelined upload engine, which uploads snapshots concurrently.
+
+The upload is split into three stages, connected by bounded queues:
+
+1. Reader - reads the snapshots from the sample file.
+2. Constructor - constructs the messages to send to the server, and groups them into batches.
+3. Senders - a pool of threads, each one sends a batch of messages to the server and waits for its response.
+
+This way, reading and constructing the next snapshots overlaps with the network, and several snapshots are in flight
+at the same time, so the upload is bounded by the bandwidth instead of by the round-trip time.
+Batching several snapshots into a single request further reduces the per-request overhead.
+"""
+
+import queue
+import threading
+
+from brain.client.reader import Reader
+from brain.client.server_agent.base_server_agent import BaseServerAgent
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+_done = object()  # marks the end of a queue
+DEFAULT_BATCH_BYTES = 8 << 20  # 8MB
+
+
+class UploadError(Exception):
+    """
+    Raised when some of the snapshots could not be uploaded.
+
+    :param count: number of successfully uploaded snapshots.
+    :param errors: list of (snapshot index, error) pairs, one for each snapshot that could not be uploaded.
+    :param fatal: if given, the error that stopped the upload (e.g. invalid sample file).
+    """
+
+    def __init__(self, count: int, errors: list, fatal: Exception = None):
+        self.count = count
+        self.errors = errors
+        self.fatal = fatal
+        failed = ', '.join(f'#{n}: {error}' for n, error in errors)
+        message = f'Uploaded {count} snapshots'
+        if errors:
+            message += f', failed to upload {len(errors)} snapshots ({failed})'
+        if fatal:
+            message += f', upload was stopped: {fatal}'
+        super().__init__(message)
+
+
+def upload_pipelined(reader: Reader, server_agent: BaseServerAgent, concurrency: int, batch_size: int = 1,
+                     batch_bytes: int = DEFAULT_BATCH_BYTES) -> int:
+    """
+    Upload all the snapshots of the reader to the server, using `concurrency` senders.
+    A snapshot that could not be uploaded does not stop the upload, and it is reported once the upload is done.
+
+    :param reader: the sample file reader.
+    :param server_agent: the server agent to construct and send the messages.
+    :param concurrency: number of batches to send at the same time.
+    :param batch_size: maximal number of snapshots to send in a single batch.
+    :param batch_bytes: maximal size (in bytes) of a batch, a batch is sent once its messages exceed this size.
+    :return: number of uploaded snapshots.
+    :raises: UploadError if some of the snapshots could not be uploaded.
+    """
+
+    logger.info(f'starting pipelined upload: {concurrency=}, {batch_size=}, {batch_bytes=}')
+    user = reader.user
+    snapshots = queue.Queue(2 * concurrency)
+    messages = queue.Queue(2 * concurrency)
+    lock = threading.Lock()  # protects count and errors
+    count = 0
+    errors = []
+    fatal = None
+
+    def read():
+        nonlocal fatal
+        try:
+            position = reader.position
+            for snapshot in reader:
+                snapshots.put((position, snapshot))
+                position += 1
+        except Exception as error:
+            logger.error(f'error while reading sample file: {error}')
+            fatal = error
+        finally:
+            snapshots.put(_done)
+
+    def construct():
+        batch, size = [], 0
+        while True:
+            item = snapshots.get()
+            if item is _done:
+                break
+            n, snapshot = item
+            try:
+                message = server_agent.construct_message(user, snapshot)
+            except Exception as error:
+                logger.error(f'error while constructing snapshot #{n}: {error}')
+                with lock:
+                    errors.append((n, error))
+                continue
+            batch.append((n, message))
+            size += len(message)
+            if len(batch) >= batch_size or size >= batch_bytes:
+                messages.put(batch)
+                batch, size = [], 0
+        if batch:
+            messages.put(batch)
+        for _ in range(concurrency):
+            messages.put(_done)
+
+    def send():
+        nonlocal count
+        while True:
+            batch = messages.get()
+            if batch is _done:
+                break
+            first, last = batch[0][0], batch[-1][0]
+            try:
+                logger.debug(f'uploading snapshots #{first}-#{last} to server')
+                results = server_agent.send_messages([message for _, message in batch])
+            except Exception as error:
+                logger.error(f'error while uploading snapshots #{first}-#{last}: {error}')
+                results = [error] * len(batch)
+            with lock:
+                for (n, _), error in zip(batch, results):
+                    if error:
+                        logger.error(f'error while uploading snapshot #{n}: {error}')
+                        errors.append((n, error))
+                    else:
+                        count += 1
+
+    threads = [threading.Thread(target=read), threading.Thread(target=construct)]
+    threads += [threading.Thread(target=send) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors or fatal:
+        errors.sort(key=lambda item: item[0])
+        raise UploadError(count, errors, fatal)
+    return count
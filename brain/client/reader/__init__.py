@@ -2,8 +2,11 @@
 The reader package contains an interface for reading the sample file and get the parsed snapshots.
 """
 
+import os
+
 from brain.utils.common import get_logger, get_file_stream_type
 from brain.utils.consts import MessageFormat, FileFormat
+from .index import Index, get_index_path
 from .mind_reader import MindReader
 
 logger = get_logger(__name__)
@@ -26,12 +29,34 @@ class Reader:
     - After initializing the reader, the user will be available in the `user` member (`reader.user`).
     - In order to get the parsed snapshots, you should iterate over the reader object.
 
+    If the sample file has an index (see `brain.client.build_index`), the reader also supports random access:
+
+    - `reader.seek(n)` moves the reader to the n-th snapshot.
+    - `reader[n]` moves the reader to the n-th snapshot and returns it.
+    - `reader[start:stop]` returns a new reader, that reads only the snapshots in the given range.
+    - `reader.split(n)` returns `n` new readers, that read disjoint ranges of the sample file.
+
+    A compressed (gzip) sample file cannot be accessed randomly, so seeking decompresses the sample file from its start
+    (or from the current position when seeking forward), and so does each reader returned by `split`.
+
     :param path: path of the sample file.
     :param file_fmt: file format of the sample file.
     :param msg_fmt: the message format of the sample file (mind for example).
+    :param start: index of the first snapshot to read (requires an index).
+    :param stop: if given, stop reading before the snapshot with this index.
+    :param index: the index of the sample file, will be loaded from the index file when required if not given.
+    :param raw: if True, the snapshots are returned serialized, without being parsed (the user is still parsed).
     """
 
-    def __init__(self, path: str, file_fmt: FileFormat, msg_fmt: MessageFormat):
+    def __init__(self, path: str, file_fmt: FileFormat, msg_fmt: MessageFormat, start: int = 0, stop: int = None,
+                 index: Index = None, raw: bool = False):
+        self.path = path
+        self.file_fmt = file_fmt
+        self.msg_fmt = msg_fmt
+        self.raw = raw
+        self._index = index
+        self.position = 0  # index of the next snapshot
+        self.stop = stop
         file_stream_type = get_file_stream_type(file_fmt)
         # initialize file stream
         self.file_stream = file_stream_type(path, 'rb')
@@ -40,6 +65,11 @@ class Reader:
         try:
             # read header (user)
             self.user = self._reader.read_user()
+            if self.stop is not None and start >= self.stop:
+                # empty range, there is nothing to read
+                self.position = start
+            elif start:
+                self.seek(start)
         except Exception:
             self.file_stream.close()
             raise
@@ -48,14 +78,108 @@ class Reader:
         return self
 
     def __next__(self):
+        if self.stop is not None and self.position >= self.stop:
+            # reached end of range
+            self.close()
+            raise StopIteration
+
         try:
             # read next snapshot
-            snapshot = self._reader.read_snapshot()
+            snapshot = self._reader.read_raw_snapshot() if self.raw else self._reader.read_snapshot()
         except Exception:
             self.file_stream.close()
             raise
 
         if not snapshot:
             # reached end of file
+            self.close()
             raise StopIteration
+        self.position += 1
         return snapshot
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self.index))
+            if step != 1:
+                raise ValueError(f'Unsupported slice step: {step}')
+            return Reader(self.path, self.file_fmt, self.msg_fmt, start=start, stop=max(start, stop),
+                          index=self.index, raw=self.raw)
+        count = len(self.index)
+        if not -count <= item < count:
+            raise IndexError(f'Snapshot index out of range: {item} (sample file has {count} snapshots)')
+        self.seek(item)
+        return next(self)
+
+    @property
+    def index(self) -> Index:
+        """
+        The index of the sample file, loaded from the index file on first access.
+
+        :raises: FileNotFoundError if the sample file has no index.
+        """
+
+        if self._index is None:
+            index_path = get_index_path(self.path)
+            if not os.path.exists(index_path):
+                raise FileNotFoundError(f'Could not find index file for {self.path}, please run build-index first')
+            self._index = Index.load(index_path, self.path)
+        return self._index
+
+    def seek(self, n: int):
+        """
+        Move the reader to the n-th snapshot, so it will be the next snapshot to read.
+        Seeking to the number of snapshots moves the reader to the end of the sample file.
+
+        :param n: index of the snapshot (negative values count from the end).
+        :raises: IndexError if there is no such snapshot.
+        """
+
+        count = len(self.index)
+        if n < 0:
+            n += count
+        if not 0 <= n <= count:
+            raise IndexError(f'Snapshot index out of range: {n} (sample file has {count} snapshots)')
+        logger.debug(f'seeking to snapshot #{n}')
+        if n < count:
+            self.file_stream.seek(self.index.offsets[n])
+        elif count:
+            # the end of the last snapshot
+            self.file_stream.seek(self.index.offsets[-1] + self.index.sizes[-1])
+        self.position = n
+
+    def split(self, n: int) -> list:
+        """
+        Split the remaining snapshots into `n` readers of disjoint ranges, so they can be read in parallel.
+
+        :param n: number of readers.
+        :return: list of readers.
+        """
+
+        stop = len(self.index) if self.stop is None else self.stop
+        return [Reader(self.path, self.file_fmt, self.msg_fmt, start=start, stop=end, index=self.index, raw=self.raw)
+                for start, end in self.index.split(n, self.position, stop)]
+
+    def build_index(self) -> Index:
+        """
+        Read the rest of the sample file without parsing the snapshots, and build its index.
+        Should be called before reading any snapshot.
+
+        :return: the built index.
+        """
+
+        index = Index.create(os.path.getsize(self.path))
+        while True:
+            offset = self.file_stream.tell()
+            if not self._reader.skip_snapshot():
+                break
+            index.append(offset, self.file_stream.tell() - offset)
+        self.close()
+        self._index = index
+        return index
+
+    def close(self):
+        """
+        Close the sample file.
+        """
+
+        self.file_stream.close()
@@ -34,3 +34,23 @@ class BaseReader(abc.ABC):
         """
 
         pass
+
+    @abc.abstractmethod
+    def read_raw_snapshot(self):
+        """
+        Read the next snapshot from the sample file without parsing it.
+
+        :return: the serialized snapshot.
+        """
+
+        pass
+
+    @abc.abstractmethod
+    def skip_snapshot(self) -> bool:
+        """
+        Read the next snapshot from the sample file without parsing it.
+
+        :return: True if a snapshot was read, False if reached EOF.
+        """
+
+        pass
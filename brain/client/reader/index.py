@@ -0,0 +1,138 @@
+"""
+The index module provides a sidecar offset index for sample files.
+
+The index is built once per sample file (see `brain.client.build_index`), and is saved next to it with an `.idx`
+suffix. It contains the offset and the size of every snapshot message in the (uncompressed) sample file, which
+allows the reader to seek to any snapshot, and to split the sample file into disjoint ranges.
+"""
+
+import array
+import os
+import struct
+
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+
+INDEX_SUFFIX = '.idx'
+# index file header: magic, sample file size (to detect stale indexes), and number of snapshots
+_header = struct.Struct('4sQQ')
+_magic = b'BIDX'
+
+
+def get_index_path(path: str) -> str:
+    """
+    Get the path of the index file of a given sample file.
+
+    :param path: sample file path.
+    :return: the index file path.
+    """
+
+    return f'{path}{INDEX_SUFFIX}'
+
+
+class Index:
+    """
+    The index class holds the offsets and sizes of all the snapshot messages in a sample file.
+    Offsets point to the beginning of the message (including its header) in the uncompressed sample file.
+
+    :param offsets: array of snapshot messages offsets.
+    :param sizes: array of snapshot messages sizes.
+    :param file_size: size of the indexed sample file (on disk).
+    """
+
+    def __init__(self, offsets: array.array, sizes: array.array, file_size: int):
+        self.offsets = offsets
+        self.sizes = sizes
+        self.file_size = file_size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def create(cls, file_size: int) -> 'Index':
+        """
+        Create an empty index, to be filled using `append`.
+
+        :param file_size: size of the indexed sample file (on disk).
+        :return: the new index.
+        """
+
+        return cls(array.array('Q'), array.array('Q'), file_size)
+
+    def append(self, offset: int, size: int):
+        """
+        Add the next snapshot message to the index.
+
+        :param offset: offset of the message.
+        :param size: size of the message.
+        """
+
+        self.offsets.append(offset)
+        self.sizes.append(size)
+
+    def save(self, path: str):
+        """
+        Save the index to a file.
+
+        :param path: index file path.
+        """
+
+        logger.info(f'saving index: {path=}, snapshots={len(self)}')
+        with open(path, 'wb') as file:
+            file.write(_header.pack(_magic, self.file_size, len(self)))
+            self.offsets.tofile(file)
+            self.sizes.tofile(file)
+
+    @classmethod
+    def load(cls, path: str, sample_path: str = None) -> 'Index':
+        """
+        Load an index from a file.
+
+        :param path: index file path.
+        :param sample_path: if given, verify the index was built for this sample file.
+        :return: the loaded index.
+        :raises: ValueError for invalid or stale index file.
+        """
+
+        logger.debug(f'loading index: {path=}')
+        with open(path, 'rb') as file:
+            magic, file_size, count = _header.unpack(file.read(_header.size))
+            if magic != _magic:
+                raise ValueError(f'Invalid index file: {path}')
+            index = cls.create(file_size)
+            try:
+                index.offsets.fromfile(file, count)
+                index.sizes.fromfile(file, count)
+            except EOFError:
+                raise ValueError(f'Invalid index file: {path} is truncated')
+        if sample_path and os.path.getsize(sample_path) != file_size:
+            raise ValueError(f'Stale index file: {path} does not match {sample_path}, please rebuild it')
+        return index
+
+    def split(self, n: int, start: int = 0, stop: int = None) -> list:
+        """
+        Split a range of snapshots into `n` disjoint contiguous ranges, balanced by the messages sizes.
+
+        :param n: number of ranges.
+        :param start: first snapshot of the range to split.
+        :param stop: end of the range to split (exclusive), defaults to the number of snapshots.
+        :return: list of (start, stop) tuples, some of them might be empty if there are less than `n` snapshots.
+        """
+
+        if n < 1:
+            raise ValueError(f'Cannot split into {n} ranges')
+        stop = len(self) if stop is None else stop
+        total = sum(self.sizes[start:stop])
+        ranges = []
+        current, accumulated = start, 0
+        for i in range(1, n + 1):
+            # take snapshots until reaching i/n of the total size
+            target = total * i / n
+            end = current
+            while end < stop and (i == n or accumulated + self.sizes[end] / 2 <= target):
+                accumulated += self.sizes[end]
+                end += 1
+            ranges.append((current, end))
+            current = end
+        return ranges
@@ -3,6 +3,7 @@ The base server agent module provides an abstract class for server agent impleme
 """
 
 import abc
+from typing import Union
 
 from brain.autogen import mind_pb2
 
@@ -13,13 +14,53 @@ class BaseServerAgent(abc.ABC):
 
     :param host: server hostname.
     :param port: server port number.
+    :param concurrency: number of messages that might be sent at the same time.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, concurrency=1):
         self.host = host
         self.port = port
+        self.concurrency = concurrency
 
     @abc.abstractmethod
+    def construct_message(self, user: mind_pb2.User, snapshot: Union[mind_pb2.Snapshot, bytes]) -> bytes:
+        """
+        Constructs a message from the given user and snapshot, that can be sent to the server.
+
+        :param user: user in mind_pb2.User format.
+        :param snapshot: snapshot in mind_pb2.Snapshot format, or serialized (as read by a raw reader).
+        :return: the message.
+        """
+
+        pass
+
+    @abc.abstractmethod
+    def send_message(self, message: bytes):
+        """
+        Sends a message, constructed by `construct_message`, to the server.
+        Must be thread-safe, as messages might be sent concurrently.
+
+        :param message: the message to send.
+        """
+
+        pass
+
+    def send_messages(self, messages: list) -> list:
+        """
+        Sends a batch of messages, constructed by `construct_message`, to the server.
+        Server agents should override it if their protocol can send several messages at once.
+        Must be thread-safe, as batches might be sent concurrently.
+
+        :param messages: list of messages to send.
+        :return: list with the error of each message that could not be handled by the server
+            (None for messages that were handled successfully).
+        :raises: Exception if the batch could not be sent at all.
+        """
+
+        for message in messages:
+            self.send_message(message)
+        return [None] * len(messages)
+
     def send_snapshot(self, user: mind_pb2.User, snapshot: mind_pb2.Snapshot):
         """
         Constructs a message from the given user and snapshots and sends it to the server.
@@ -28,4 +69,14 @@ class BaseServerAgent(abc.ABC):
         :param snapshot: snapshot in mind_pb2.Snapshot format.
         """
 
-        pass
+        self.send_message(self.construct_message(user, snapshot))
+
+    def send_sample(self, path: str) -> int:
+        """
+        Sends a whole sample file to the server as is, and let the server read its snapshots.
+
+        :param path: sample file path.
+        :return: number of snapshots that were handled by the server.
+        """
+
+        raise NotImplementedError(f'Sending whole sample files is not supported by {self.__class__.__name__}')
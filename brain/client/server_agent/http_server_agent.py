@@ -2,14 +2,19 @@
 The HTTP server agent module provides a server agent of http protocol.
 """
 
+import json
+from typing import Union
+
 from furl import furl
 
 from brain.autogen import client_server_pb2, mind_pb2
 from brain.client.server_agent.base_server_agent import BaseServerAgent
-from brain.utils.common import get_logger, serialize_protobuf
-from brain.utils.http import post
+from brain.utils.common import get_logger, pack_messages, serialize_protobuf
+from brain.utils.http import HTTPClient
+from brain.utils.transcoder import mind_to_client_snapshot
 
 logger = get_logger(__name__)
+SAMPLE_CHUNK_SIZE = 1 << 20  # 1MB
 
 
 def copy_protobuf(item_a, item_b, attrs):
@@ -20,12 +25,14 @@ def copy_protobuf(item_a, item_b, attrs):
 class ServerAgent(BaseServerAgent):
     """
     HTTP-based implementation of server agent.
+    Messages are sent over a pool of keep-alive connections, one connection per concurrent message.
     """
 
-    def __init__(self, host: str, port: int):
-        BaseServerAgent.__init__(self, host, port)
-        logger.info(f'initializing ServerAgent, {host=}, {port=}')
+    def __init__(self, host: str, port: int, concurrency: int = 1):
+        BaseServerAgent.__init__(self, host, port, concurrency)
+        logger.info(f'initializing ServerAgent, {host=}, {port=}, {concurrency=}')
         self.url = furl(scheme='http', host=host, port=port)
+        self.http = HTTPClient(pool_size=concurrency)
 
     @classmethod
     def _construct_snapshot(cls, user: mind_pb2.User, snapshot: mind_pb2.Snapshot) -> client_server_pb2.Snapshot:
@@ -41,11 +48,47 @@ class ServerAgent(BaseServerAgent):
         copy_protobuf(new_snapshot.feelings, snapshot.feelings, ['hunger', 'thirst', 'exhaustion', 'happiness'])
         return new_snapshot
 
-    def send_snapshot(self, user: mind_pb2.User, snapshot: mind_pb2.Snapshot):
-        url = self.url / 'snapshot'
+    def construct_message(self, user: mind_pb2.User, snapshot: Union[mind_pb2.Snapshot, bytes]) -> bytes:
+        if not isinstance(snapshot, mind_pb2.Snapshot):
+            # serialized snapshot (read by a raw reader), transcode it without parsing
+            return mind_to_client_snapshot(serialize_protobuf(user), snapshot)
         # construct snapshot to send
         server_snapshot = self._construct_snapshot(user, snapshot)
-        snapshot_msg = serialize_protobuf(server_snapshot)
+        return serialize_protobuf(server_snapshot)
+
+    def send_message(self, message: bytes):
+        url = self.url / 'snapshot'
         logger.debug(f'sending snapshot to {url}')
         # send serialized snapshot to server
-        post(url, snapshot_msg)
+        self.http.post(url, message)
+
+    def send_messages(self, messages: list) -> list:
+        if len(messages) == 1:
+            self.send_message(messages[0])
+            return [None]
+        url = self.url / 'snapshots'
+        logger.debug(f'sending {len(messages)} snapshots to {url}')
+        # send all serialized snapshots to server in a single request, and collect the status of each snapshot
+        statuses = json.loads(self.http.post(url, pack_messages(messages)))
+        if len(statuses) != len(messages):
+            raise Exception(f'Server returned {len(statuses)} statuses for {len(messages)} snapshots')
+        return [None if status['status'] == 'ok' else Exception(status.get('error')) for status in statuses]
+
+    def send_sample(self, path: str) -> int:
+        url = self.url / 'sample'
+        logger.info(f'streaming sample file to {url}: {path=}')
+
+        def read_chunks():
+            with open(path, 'rb') as file:
+                while chunk := file.read(SAMPLE_CHUNK_SIZE):
+                    yield chunk
+
+        # the body is a generator, so it is sent chunked, and cannot be replayed by retries
+        http = HTTPClient(pool_size=1, retries=0)
+        try:
+            response = json.loads(http.request('POST', url, expect=None, data=read_chunks()))
+        finally:
+            http.close()
+        if response['status'] != 'ok':
+            raise Exception(f'Server handled only {response["count"]} snapshots: {response["error"]}')
+        return response['count']
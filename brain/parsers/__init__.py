@@ -5,4 +5,5 @@ The parsers package contains:
 - The parsers themselves.
 """
 
-from .framework import run_parser, invoke_parser, get_parsers
+from .framework import run_parser, run_parser_batch, run_parsers, invoke_parser, invoke_parsers, get_parsers, \
+    set_result_cache
@@ -1,19 +1,41 @@
+import functools
 import json
 
 import click
 
 from brain.utils.common import cli_suppress, get_logger
-from . import run_parser, invoke_parser
+from brain.utils.supervisor import Supervisor
+from . import get_parsers, run_parser, invoke_parser, invoke_parsers, set_result_cache
+from .cache import ResultCache
 
 logger = get_logger(__name__)
 
 
+def cache_options(command: callable) -> callable:
+    """
+    Add the result cache options to a command, and set the result cache before running it.
+    """
+
+    @click.option('--cache', 'cache_path', type=click.Path(file_okay=False), default=None,
+                  help='Directory of a cache of the parsers results (by default, results are not cached).')
+    @click.option('--cache-size', type=click.IntRange(min=1), default=1024,
+                  help='Maximal number of cached results.')
+    @functools.wraps(command)
+    def wrapper(*args, cache_path, cache_size, **kwargs):
+        if cache_path:
+            set_result_cache(ResultCache(cache_path, max_entries=cache_size))
+        return command(*args, **kwargs)
+
+    return wrapper
+
+
 @click.group()
 def cli():
     pass
 
 
 @cli.command('parse')
+@cache_options
 @click.argument('parser', type=click.STRING)
 @click.argument('path', type=click.STRING)
 @cli_suppress
@@ -29,16 +51,53 @@ def cli_parse(parser, path):
 
 
 @cli.command('run-parser')
+@cache_options
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=1,
+              help='Maximal number of messages to parse together.')
+@click.option('-t', '--batch-timeout', type=click.IntRange(min=1), default=100,
+              help='Maximal time (in milliseconds) to wait for a batch to fill.')
+@click.option('--prefetch', type=click.IntRange(min=1), default=None,
+              help='Maximal number of messages to receive ahead from the MQ.')
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1,
+              help='Number of worker processes that consume the MQ.')
 @click.argument('parser', type=click.STRING)
 @click.argument('mq', type=click.STRING)
 @cli_suppress
-def cli_run_parser(parser, mq):
+def cli_run_parser(batch_size, batch_timeout, prefetch, workers, parser, mq):
     """
     Run the parser as a service, that consumes messages and publishes results using the given MQ.
+    With several workers, a supervisor process runs the workers, and restarts them if they crash.
+    """
+
+    logger.info(f'running cli run-parser: {parser=}, {mq=}, {batch_size=}, {batch_timeout=}, {prefetch=}, '
+                f'{workers=}')
+    kwargs = dict(batch_size=batch_size, batch_timeout=batch_timeout / 1000, prefetch=prefetch)
+    if workers > 1:
+        Supervisor(invoke_parser, args=(parser, mq), kwargs=kwargs, workers=workers).run()
+    else:
+        invoke_parser(parser, mq, **kwargs)
+
+
+@cli.command('run-parsers')
+@cache_options
+@click.option('-p', '--parser', 'parsers', type=click.STRING, multiple=True,
+              help='Parser to run (can be given several times, by default all the parsers run).')
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=None,
+              help='Maximal number of parsers to run concurrently (by default, one for each parser).')
+@click.option('--processes', is_flag=True, help='Run the parsers in a process pool, instead of a thread pool.')
+@click.option('--prefetch', type=click.IntRange(min=1), default=None,
+              help='Maximal number of messages to receive ahead from the MQ.')
+@click.argument('mq', type=click.STRING)
+@cli_suppress
+def cli_run_parsers(parsers, workers, processes, prefetch, mq):
+    """
+    Run several parsers as a single service, that consumes each snapshot once, and publishes the results of all the
+    parsers using the given MQ.
     """
 
-    logger.info(f'running cli run-parser: {parser=}, {mq=}')
-    invoke_parser(parser, mq)
+    parsers = list(parsers) or get_parsers()
+    logger.info(f'running cli run-parsers: {parsers=}, {mq=}, {workers=}, {processes=}, {prefetch=}')
+    invoke_parsers(parsers, mq, workers=workers, processes=processes, prefetch=prefetch)
 
 
 if __name__ == '__main__':
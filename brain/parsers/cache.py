@@ -0,0 +1,186 @@
+"""
+The cache module provides a content-addressed cache of parsers results, so parsing the same content again (e.g. a
+re-uploaded sample, a redelivered message or a backfill) returns the stored result without running the parser.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+
+_FILE_MARKER = '__cached_file__'
+_ENTRY_FILE = 'entry.json'
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def _map_values(obj, fn: callable):
+    # apply fn to all the values of a nested result (of dictionaries and lists)
+    if isinstance(obj, dict):
+        if set(obj) == {_FILE_MARKER}:
+            return fn(obj)
+        return {key: _map_values(value, fn) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_map_values(value, fn) for value in obj]
+    return fn(obj)
+
+
+class ResultCache:
+    """
+    Content-addressed cache of parsers results, stored in a local directory with LRU eviction.
+
+    A result is stored by a key of the parser name, the parser version, and the hash of its data and of the input
+    file the data refers to (by `file_name`). Files that the parser created in the context directory and appear in the
+    result (e.g. the generated image) are stored with it. On a hit, these files are restored to the new context
+    directory, and the input file is deleted if the parser deleted it.
+
+    Several processes may share the same directory, but each one evicts only the entries it used.
+
+    :param path: the directory of the cache.
+    :param max_entries: maximal number of entries to keep.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1024):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # entries from previous runs, from the least recently used
+        entries = sorted((entry for entry in self.path.iterdir() if entry.is_dir() and not entry.name.startswith('.')),
+                         key=lambda entry: entry.stat().st_mtime)
+        self._entries = collections.OrderedDict((entry.name, None) for entry in entries)
+        self._evict()
+
+    def key(self, parser_name: str, version, data, context) -> str:
+        """
+        Compute the key of a parser run.
+
+        :param parser_name: name of the parser.
+        :param version: version of the parser (changing it invalidates its cached results).
+        :param data: the data for the parser.
+        :param context: the context of the parser.
+        :return: the key, or None if the input file of the data does not exist.
+        """
+
+        digest = hashlib.sha256(json.dumps([parser_name, version, data], sort_keys=True, default=str).encode())
+        input_path = self._input_path(data, context)
+        if input_path:
+            try:
+                with open(input_path, 'rb') as reader:
+                    for chunk in iter(lambda: reader.read(_HASH_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+            except FileNotFoundError:
+                return None
+        return digest.hexdigest()
+
+    @staticmethod
+    def _input_path(data, context) -> str:
+        if isinstance(data, dict) and 'file_name' in data and context.base_path:
+            return context.path(data['file_name'])
+        return None
+
+    def get(self, key: str, data, context):
+        """
+        Get a cached result, and restore its files to the context directory.
+
+        :param key: the key of the parser run.
+        :param data: the data for the parser.
+        :param context: the context of the parser.
+        :return: the result, or None if it is not cached.
+        """
+
+        entry_path = self.path / key
+        try:
+            with open(entry_path / _ENTRY_FILE, 'r') as reader:
+                entry = json.load(reader)
+            for name in entry['files']:
+                shutil.copyfile(entry_path / name, context.path(name))
+        except (OSError, ValueError):
+            # missing, or evicted by another process
+            with self._lock:
+                self.misses += 1
+            return None
+        if entry['consumed']:
+            os.remove(self._input_path(data, context))
+        os.utime(entry_path)
+        with self._lock:
+            self.hits += 1
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+        logger.debug(f'parser result cache hit: {key=}, {self.hits=}, {self.misses=}')
+        return _map_values(entry['result'],
+                           lambda value: context.path(value[_FILE_MARKER]) if isinstance(value, dict) else value)
+
+    def put(self, key: str, result, data, context):
+        """
+        Store a result of a parser run that just ended, with the files it refers to in the context directory.
+
+        :param key: the key of the parser run.
+        :param result: the result of the parser.
+        :param data: the data for the parser.
+        :param context: the context of the parser.
+        """
+
+        input_path = self._input_path(data, context)
+        consumed = input_path is not None and not os.path.exists(input_path)  # the parser deleted its input file
+        files = []
+
+        def mark_file(value):
+            if context.base_path and isinstance(value, str) and os.path.dirname(value) == str(context.base_path) \
+                    and os.path.isfile(value) and value != input_path:
+                files.append(os.path.basename(value))
+                return {_FILE_MARKER: files[-1]}
+            return value
+
+        entry = {'result': _map_values(result, mark_file), 'files': files, 'consumed': consumed}
+        # write the entry aside, and move it into place at once, so other processes never see a partial entry
+        tmp_path = pathlib.Path(tempfile.mkdtemp(dir=self.path, prefix='.'))
+        try:
+            for name in files:
+                shutil.copyfile(context.path(name), tmp_path / name)
+            with open(tmp_path / _ENTRY_FILE, 'w') as writer:
+                json.dump(entry, writer)
+            os.rename(tmp_path, self.path / key)
+        except OSError:
+            # already stored (e.g. by another process)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        with self._lock:
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def run(self, parser_name: str, version, parse_fn: callable, data, context):
+        """
+        Run a parser, or get its result from the cache.
+
+        :param parser_name: name of the parser.
+        :param version: version of the parser.
+        :param parse_fn: the parser.
+        :param data: the data for the parser.
+        :param context: the context of the parser.
+        :return: the result of the parser.
+        """
+
+        key = self.key(parser_name, version, data, context)
+        result = self.get(key, data, context) if key else None
+        if result is None:
+            result = parse_fn(data, context)
+            if key:
+                self.put(key, result, data, context)
+        return result
+
+    def _evict(self):
+        # remove the least recently used entries
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            logger.debug(f'evicting parser result: {key=}')
+            shutil.rmtree(self.path / key, ignore_errors=True)
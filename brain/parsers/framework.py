@@ -2,6 +2,9 @@
 The framework module contains the parsers framework, which including parsers detection, running and invocation.
 """
 
+import ast
+import collections.abc
+import concurrent.futures
 import importlib
 import inspect
 import os
@@ -9,42 +12,94 @@ import pathlib
 import sys
 from typing import Union
 
+from google.protobuf.descriptor import FieldDescriptor
+
 from brain import brain_path
 from brain.autogen import server_parsers_pb2
-from brain.utils.common import normalize_path, get_logger, protobuf2dict, parse_protobuf, get_url_scheme
+from brain.utils.common import normalize_path, get_logger, get_url_scheme, protobuf_field2python
+from brain.utils.transcoder import LEN, VARINT, encode_field, iter_fields
+from .cache import ResultCache
 from .mq_agent import load_mq_agent
 
 logger = get_logger(__name__)
-parsers = {}
+manifest = {}  # parser name -> (module name, function or class name)
+parsers = {}  # loaded parsers
+batch_parsers = {}
+parser_versions = {}
+result_cache = None  # type: ResultCache
 parsers_path = brain_path / 'parsers' / 'parsers'
 
 
+def _scan_parsers(path: pathlib.Path) -> dict:
+    # find the parsers defined in a module by reading its source, without importing it
+    tree = ast.parse(path.read_text(), filename=str(path))
+    functions, fields, found = set(), {}, {}
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name.startswith('parse_'):
+            functions.add(node.name)
+        # look for `parse_x.field = 'name'`
+        elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            for target in node.targets:
+                if isinstance(target, ast.Attribute) and target.attr == 'field' and \
+                        isinstance(target.value, ast.Name):
+                    fields[target.value.id] = node.value.value
+        # look for class with `field = 'name'` member and parse method
+        elif isinstance(node, ast.ClassDef) and node.name.lower().endswith('parser'):
+            methods = {item.name for item in node.body if isinstance(item, ast.FunctionDef)}
+            for item in node.body:
+                if isinstance(item, ast.Assign) and isinstance(item.value, ast.Constant) and 'parse' in methods and \
+                        any(isinstance(target, ast.Name) and target.id == 'field' for target in item.targets):
+                    found[item.value.value] = node.name
+    for name in functions & fields.keys():
+        found[fields[name]] = name
+    return found
+
+
 def load_parsers():
     """
-    Loads all the parsers in the parsers subpackage.
+    Build the manifest of all the parsers in the parsers subpackage.
     Looks for all files in the package and identifies a parser in one of the following ways:
 
     - Function starts with `parse_` (e.g. `parse_pose`) that has `field` attribute.
     - Class end with `Parser` (e.g. `FeelingsParser`) that has `field` member and parse method.
+
+    The modules are not imported: they are scanned for parsers whose `field` is assigned a string literal, and each
+    parser module is imported only when its parser is used (see `get_parser_by_name`).
+
+    A parser may also parse several snapshots at once: a function parser with `parse_batch` attribute, or a class
+    parser with `parse_batch` method. `parse_batch` is called with a list of data items and a list of their contexts,
+    and returns a list of the results. If it raised an exception, the items are parsed one by one, so it should not
+    have side effects (e.g. deleting the files of the items).
+
+    A parser may have a `version` attribute (or member), which should be changed when its results change, so its
+    cached results (see `set_result_cache`) are not used anymore.
     """
 
-    logger.info(f'loading parsers')
-    sys.path.insert(0, str(parsers_path.parent))
-    for path in parsers_path.iterdir():  # iterate over files
+    logger.info(f'loading parsers manifest')
+    for path in sorted(parsers_path.iterdir()):  # iterate over files
         if path.name.startswith('_') or path.suffix != '.py' or path.name == 'framework.py':
             continue
-        module = importlib.import_module(f'{parsers_path.name}.{path.stem}')  # import module
-        for name, obj in module.__dict__.items():
-            # look for parser function
-            if callable(obj) and name.startswith('parse_') and hasattr(obj, 'field'):
-                logger.info(f'found function parser {name} in {module.__name__}')
-                parsers[obj.field] = obj
-            # look for parser class
-            elif inspect.isclass(obj) and name.lower().endswith('parser') and hasattr(obj, 'parse') and \
-                    hasattr(obj, 'field'):
-                logger.info(f'found class parser {name} in {module.__name__}')
-                instance = obj()
-                parsers[obj.field] = instance.parse
+        module_name = f'{parsers_path.name}.{path.stem}'
+        for field, name in _scan_parsers(path).items():
+            logger.debug(f'found parser {name} in {module_name}')
+            manifest[field] = (module_name, name)
+
+
+def _load_parser(parser: str):
+    # import the module of the parser, and register the parser
+    module_name, name = manifest[parser]
+    logger.info(f'loading parser {name} from {module_name}')
+    if str(parsers_path.parent) not in sys.path:
+        sys.path.insert(0, str(parsers_path.parent))
+    obj = getattr(importlib.import_module(module_name), name)  # import module
+    if inspect.isclass(obj):
+        obj = obj()
+        parsers[parser] = obj.parse
+    else:
+        parsers[parser] = obj
+    if hasattr(obj, 'parse_batch'):
+        batch_parsers[parser] = obj.parse_batch
+    parser_versions[parser] = getattr(obj, 'version', 0)
 
 
 load_parsers()
@@ -57,15 +112,72 @@ def get_parsers() -> list:
     :return: list of parsers names.
     """
 
-    return list(parsers.keys())
+    return list(manifest.keys())
 
 
 def get_parser_by_name(parser):
-    try:
-        return parsers[parser]
-    except KeyError:
-        logger.error(f'unsupported parser: {parser}')
-        raise NotImplementedError(f'Unsupported parser: {parser}')
+    if parser not in parsers:
+        if parser not in manifest:
+            logger.error(f'unsupported parser: {parser}')
+            raise NotImplementedError(f'Unsupported parser: {parser}')
+        _load_parser(parser)
+    return parsers[parser]
+
+
+def set_result_cache(cache: ResultCache = None):
+    """
+    Set the cache of the parsers results, so parsing the same content again returns the cached result without
+    running the parser.
+
+    :param cache: the cache, or None to disable caching.
+    """
+
+    global result_cache
+    logger.info(f'setting parsers result cache: {cache.path if cache else None}')
+    result_cache = cache
+
+
+def _call_parser(parser_name: str, parser_data, ctx):
+    # run the parser, or get its result from the cache
+    parse_fn = get_parser_by_name(parser_name)
+    if result_cache is None:
+        return parse_fn(parser_data, ctx)
+    return result_cache.run(parser_name, parser_versions[parser_name], parse_fn, parser_data, ctx)
+
+
+def _call_parser_batch(parser_name: str, items: list, contexts: list) -> tuple:
+    # run the parser with several items at once, the cached results are looked up one by one, and the results and
+    # errors are dictionaries of item index to its result or exception
+    get_parser_by_name(parser_name)
+    if parser_name in batch_parsers and result_cache is not None:
+        version = parser_versions[parser_name]
+        keys = [result_cache.key(parser_name, version, data, ctx) for data, ctx in zip(items, contexts)]
+        results = {i: result_cache.get(key, data, ctx) if key else None
+                   for i, (key, data, ctx) in enumerate(zip(keys, items, contexts))}
+        results = {i: res for i, res in results.items() if res is not None}
+    else:
+        keys, results = None, {}
+    missing = [i for i in range(len(items)) if i not in results]
+    errors = {}
+    if missing and parser_name in batch_parsers:
+        try:
+            parsed = batch_parsers[parser_name]([items[i] for i in missing], [contexts[i] for i in missing])
+        except Exception as error:
+            # parse the items one by one, so a bad item does not fail the others
+            logger.error(f'parser {parser_name} failed with batch of {len(missing)} items: {error}')
+        else:
+            for i, res in zip(missing, parsed):
+                results[i] = res
+                if keys and keys[i]:
+                    result_cache.put(keys[i], res, items[i], contexts[i])
+            missing = []
+    for i in missing:
+        try:
+            results[i] = _call_parser(parser_name, items[i], contexts[i])
+        except Exception as error:
+            logger.error(f'parser {parser_name} failed: {error}')
+            errors[i] = error
+    return results, errors
 
 
 class Context:
@@ -124,6 +236,68 @@ class Context:
         os.remove(self.path(file))
 
 
+# scalar field types that can be decoded directly from their wire value
+_wire_scalars = {FieldDescriptor.TYPE_UINT64: VARINT, FieldDescriptor.TYPE_UINT32: VARINT,
+                 FieldDescriptor.TYPE_STRING: LEN}
+
+
+class SnapshotView(collections.abc.Mapping):
+    """
+    Lazy dictionary view of a serialized snapshot.
+
+    Only the top-level fields of the snapshot are scanned when the view is created. A field is decoded and converted
+    to plain python types (the same as `protobuf2dict` would convert it) only when it is accessed, so parsers do not
+    pay for decoding the fields they do not use.
+
+    :param data: the serialized snapshot.
+    :param message_type: the protobuf class of the snapshot.
+    :raises: ValueError for invalid snapshot.
+    """
+
+    def __init__(self, data: bytes, message_type: type = server_parsers_pb2.Snapshot):
+        self.message_type = message_type
+        self._descriptor = message_type.DESCRIPTOR
+        self._fields = {}  # field number -> list of (wire type, value), one for each occurrence
+        for number, wire_type, value in iter_fields(data):
+            self._fields.setdefault(number, []).append((wire_type, value))
+        self._cache = {}
+
+    def __getitem__(self, name: str):
+        if name not in self._cache:
+            field = self._descriptor.fields_by_name.get(name)
+            if field is None:
+                raise KeyError(name)
+            if field.label != field.LABEL_REPEATED and field.type in _wire_scalars:
+                # simple scalars are decoded directly, the last occurrence wins
+                wire_type, value = self._fields.get(field.number, [(None, None)])[-1]
+                if value is None:
+                    value = field.default_value
+                elif wire_type != _wire_scalars[field.type]:
+                    raise ValueError(f'Invalid snapshot: unexpected wire type {wire_type} of {name}')
+                elif field.type == field.TYPE_STRING:
+                    value = str(value, 'utf-8')
+                elif field.type == field.TYPE_UINT32:
+                    value &= 0xffffffff
+                self._cache[name] = protobuf_field2python(field, value)
+                return self._cache[name]
+            # decode only the occurrences of this field
+            message = self.message_type()
+            message.MergeFromString(b''.join(part for wire_type, value in self._fields.get(field.number, [])
+                                             for part in encode_field(field.number, wire_type, value)))
+            if field.label != field.LABEL_REPEATED and field.message_type and not message.HasField(name):
+                raise KeyError(name)  # unset message fields are omitted, as in protobuf2dict
+            self._cache[name] = protobuf_field2python(field, getattr(message, name))
+        return self._cache[name]
+
+    def __iter__(self):
+        for field in self._descriptor.fields:
+            if field.label == field.LABEL_REPEATED or not field.message_type or field.number in self._fields:
+                yield field.name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
 def run_parser(parser_name: str, data: Union[str, bytes], is_path: bool = False) -> dict:
     """
     Run the parser with the given data.
@@ -142,28 +316,106 @@ def run_parser(parser_name: str, data: Union[str, bytes], is_path: bool = False)
             data = file.read()
 
     logger.info(f'running parser {parser_name}')
-    parse_fn = get_parser_by_name(parser_name)
-    snapshot = parse_protobuf(server_parsers_pb2.Snapshot(), data)
-    dict_snapshot = protobuf2dict(snapshot)
-    parser_data = dict_snapshot[parser_name]
-    path = normalize_path(snapshot.path)
+    get_parser_by_name(parser_name)  # sanity check
+    # decode only the fields we need
+    snapshot = SnapshotView(data)
+    parser_data = snapshot[parser_name]
+    path = normalize_path(snapshot['path'])
     ctx = Context(path)
-    parse_res = parse_fn(parser_data, ctx)
-    # construct and return result that contains also snapshot and user details
+    parse_res = _call_parser(parser_name, parser_data, ctx)
+    return _construct_result(snapshot, parse_res)
+
+
+def _construct_result(snapshot: SnapshotView, parse_res) -> dict:
+    # construct result that contains also snapshot and user details
     return {
-        'uuid': dict_snapshot['uuid'],
-        'datetime': dict_snapshot['datetime'],
-        'user': dict_snapshot['user'],
+        'uuid': snapshot['uuid'],
+        'datetime': snapshot['datetime'],
+        'user': snapshot['user'],
         'result': parse_res
     }
 
 
-def invoke_parser(parser: str, mq_url: str):
+def run_parser_batch(parser_name: str, items: list) -> tuple:
+    """
+    Run the parser with several data items at once.
+    If the parser has `parse_batch`, it is called once with all the items, otherwise the parser is called with each
+    one of them. An item that failed does not affect the other items.
+
+    :param parser_name: parser to run.
+    :param items: list of data items for the parser.
+    :return: (results, errors) tuple, where the results are a dictionary of item index to its parser result (see
+        `run_parser`), and the errors are a dictionary of item index to its exception, for the items that failed.
+    """
+
+    logger.info(f'running parser {parser_name} with batch of {len(items)} items')
+    get_parser_by_name(parser_name)  # sanity check
+    snapshots, parser_data, contexts, errors = {}, [], [], {}
+    for i, data in enumerate(items):
+        try:
+            snapshot = SnapshotView(data)
+            parser_data.append(snapshot[parser_name])
+            contexts.append(Context(normalize_path(snapshot['path'])))
+        except Exception as error:
+            logger.error(f'invalid snapshot for parser {parser_name}: {error}')
+            errors[i] = error
+            continue
+        snapshots[i] = snapshot
+    indices = list(snapshots)  # indices of the decoded items
+    parse_results, parse_errors = _call_parser_batch(parser_name, parser_data, contexts)
+    results = {indices[j]: _construct_result(snapshots[indices[j]], res) for j, res in parse_results.items()}
+    errors.update({indices[j]: error for j, error in parse_errors.items()})
+    return results, errors
+
+
+def _parse(parser_name: str, parser_data, path: str):
+    # run a single parser on its (already decoded) data, possibly in a worker process of a pool
+    return _call_parser(parser_name, parser_data, Context(path))
+
+
+def run_parsers(parser_names: list, data: bytes, executor: concurrent.futures.Executor = None) -> tuple:
+    """
+    Run several parsers with the same snapshot, which is decoded only once.
+    A parser that failed does not affect the other parsers.
+
+    :param parser_names: parsers to run.
+    :param data: the serialized snapshot.
+    :param executor: if given, the parsers run concurrently in the executor (a thread or process pool).
+    :return: (results, errors) tuple, where the results are a dictionary of parser name to its result (see
+        `run_parser`), and the errors are a dictionary of parser name to its exception, for the parsers that failed.
+    """
+
+    logger.info(f'running parsers {parser_names}')
+    for parser_name in parser_names:
+        get_parser_by_name(parser_name)  # sanity check
+    snapshot = SnapshotView(data)
+    path = normalize_path(snapshot['path'])
+    # decode the data of all the parsers here, so only plain python objects are passed to the executor
+    jobs = {parser_name: (parser_name, snapshot[parser_name], path) for parser_name in parser_names}
+    if executor:
+        futures = {parser_name: executor.submit(_parse, *job) for parser_name, job in jobs.items()}
+    results, errors = {}, {}
+    for parser_name, job in jobs.items():
+        try:
+            parse_res = futures[parser_name].result() if executor else _parse(*job)
+        except Exception as error:
+            logger.error(f'parser {parser_name} failed: {error}')
+            errors[parser_name] = error
+            continue
+        results[parser_name] = _construct_result(snapshot, parse_res)
+    return results, errors
+
+
+def invoke_parser(parser: str, mq_url: str, batch_size: int = 1, batch_timeout: float = 0.1, prefetch: int = None):
     """
     Run the parser as a service, that consumes messages and publishes results using the given MQ.
 
     :param parser: name of the parser.
     :param mq_url: address of the MQ to consume and publish.
+    :param batch_size: if greater than 1, consume up to `batch_size` messages and parse them together
+        (see `run_parser_batch`).
+    :param batch_timeout: maximal time (in seconds) to wait for a batch to fill.
+    :param prefetch: maximal number of messages to receive ahead from the MQ.
     """
 
     def callback(body):
@@ -172,9 +424,57 @@ def invoke_parser(parser: str, mq_url: str):
         logger.debug(f'publish result to message queue')
         mq_agent.publish_result(res, parser)  # publish result to MQ
 
+    def batch_callback(bodies):
+        logger.debug(f'calling parser {parser} with {len(bodies)} messages')
+        results, errors = run_parser_batch(parser, bodies)  # run the parser
+        logger.debug(f'publish results to message queue')
+        mq_agent.publish_results([results[i] for i in sorted(results)], parser)  # publish results to MQ
+        return [errors.get(i) for i in range(len(bodies))]  # the MQ agent retries only the failed messages
+
     get_parser_by_name(parser)  # sanity check
     mq_type = get_url_scheme(mq_url)
     mq_agent_module = load_mq_agent(mq_type)
     mq_agent = mq_agent_module.MQAgent(mq_url)
-    logger.info(f'starting to consume mq: {parser=}')
-    mq_agent.consume_snapshots(callback, parser)  # start consuming the MQ
+    logger.info(f'starting to consume mq: {parser=}, {batch_size=}, {batch_timeout=}, {prefetch=}')
+    if batch_size > 1:
+        mq_agent.consume_snapshots_batch(batch_callback, parser, batch_size, batch_timeout, prefetch=prefetch)
+    else:
+        mq_agent.consume_snapshots(callback, parser, prefetch=prefetch)  # start consuming the MQ
+
+
+def invoke_parsers(parser_names: list, mq_url: str, workers: int = None, processes: bool = False,
+                   prefetch: int = None):
+    """
+    Run several parsers as a single service, that consumes each snapshot once, runs all the parsers with it, and
+    publishes their results using the given MQ (each one on the topic of its parser).
+    If some of the parsers failed, the results of the others are published, and then the snapshot is retried only with
+    the parsers that failed (the others may have already deleted their input files, e.g. the image parsers).
+
+    :param parser_names: names of the parsers.
+    :param mq_url: address of the MQ to consume and publish.
+    :param workers: maximal number of parsers to run concurrently (by default, one for each parser).
+    :param processes: run the parsers in a process pool, instead of a thread pool.
+    :param prefetch: maximal number of messages to receive ahead from the MQ.
+    """
+
+    def callback(body, pending):
+        # on retries, run only the parsers that are still pending
+        names = parser_names if pending is None else [name for name in parser_names if name in pending]
+        logger.debug(f'calling parsers {names}')
+        results, errors = run_parsers(names, body, executor)  # run the parsers
+        logger.debug(f'publish results to message queue')
+        for parser_name, res in results.items():
+            mq_agent.publish_result(res, parser_name)  # publish result to MQ
+        return errors  # the MQ agent retries the snapshot with the failed parsers
+
+    for parser_name in parser_names:
+        get_parser_by_name(parser_name)  # sanity check
+    # the parsers share a single queue
+    topic = ','.join(sorted(parser_names))
+    mq_type = get_url_scheme(mq_url)
+    mq_agent_module = load_mq_agent(mq_type)
+    mq_agent = mq_agent_module.MQAgent(mq_url)
+    executor_type = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    logger.info(f'starting to consume mq: {parser_names=}, {topic=}, {workers=}, {processes=}, {prefetch=}')
+    with executor_type(max_workers=workers or len(parser_names)) as executor:
+        mq_agent.consume_snapshots_parts(callback, topic, prefetch=prefetch)  # start consuming the MQ
@@ -16,12 +16,49 @@ class BaseMQAgent(abc.ABC):
         self.url = url
 
     @abc.abstractmethod
-    def consume_snapshots(self, callback: callable, topic: str):
+    def consume_snapshots(self, callback: callable, topic: str, prefetch: int = None):
         """
         Consume snapshots on a dedicated topic.
 
         :param callback: will be called when a new message arrives.
         :param topic: the topic of the consumer - used to identify the relevant parser.
+        :param prefetch: maximal number of snapshots to receive ahead.
+        """
+
+        pass
+
+    def consume_snapshots_batch(self, callback: callable, topic: str, batch_size: int, timeout: float,
+                                prefetch: int = None):
+        """
+        Consume snapshots on a dedicated topic in batches.
+        MQ agents should override it if they can consume several messages at once, by default the batches contain
+        a single snapshot.
+
+        :param callback: will be called with a list of snapshots when a batch is ready, and returns a list of the
+            errors of the snapshots (None for the snapshots that succeeded), so only the failed snapshots are retried.
+        :param topic: the topic of the consumer - used to identify the relevant parser.
+        :param batch_size: maximal number of snapshots in a batch.
+        :param timeout: maximal time (in seconds) to wait for a batch to fill.
+        :param prefetch: maximal number of snapshots to receive ahead.
+        """
+
+        def callback_wrapper(snapshot):
+            [error] = callback([snapshot]) or [None]
+            if error is not None:
+                raise error
+
+        self.consume_snapshots(callback_wrapper, topic, prefetch=prefetch)
+
+    @abc.abstractmethod
+    def consume_snapshots_parts(self, callback: callable, topic: str, prefetch: int = None):
+        """
+        Consume snapshots on a dedicated topic, where each snapshot is handled in several parts (e.g. by several
+        parsers), and a snapshot is retried only with the parts that failed.
+
+        :param callback: will be called with a new snapshot and the names of its parts to handle (None for all of
+            them), and returns a dictionary of part name to its exception, for the parts that failed.
+        :param topic: the topic of the consumer - used to identify the relevant parsers.
+        :param prefetch: maximal number of snapshots to receive ahead.
         """
 
         pass
@@ -36,3 +73,14 @@ class BaseMQAgent(abc.ABC):
         """
 
         pass
+
+    def publish_results(self, results: list, topic: str):
+        """
+        Publish several parsing results to the saver on a dedicated topic.
+
+        :param results: the results to publish (python objects).
+        :param topic: the topic of the publisher (used by the server to identify the result type).
+        """
+
+        for result in results:
+            self.publish_result(result, topic)
@@ -2,29 +2,56 @@
 The RabbitMQ agent module provides a MQ agent with RabbitMQ implementation.
 """
 
-import json
+from furl import furl
 
 from brain.parsers.mq_agent.base_mq_agent import BaseMQAgent
+from brain.utils import codec
 from brain.utils.common import get_logger
-from brain.utils.rabbitmq import RabbitMQ
+from brain.utils.rabbitmq import PartialFailure, RabbitMQ
 
 logger = get_logger(__name__)
+PARTS_HEADER = 'x-brain-parts'  # the parts of a retried snapshot that are left to handle
 
 
 class MQAgent(BaseMQAgent):
     """
     RabbitMQ-based implementation of MQ agent.
+
+    The results are encoded by the codec given in the `codec` argument of the MQ address (JSON by default), and
+    compressed if they are larger than its `compress` argument (in bytes), e.g. `rabbitmq://127.0.0.1:5672?codec=binary`
+    (see `brain.utils.codec`).
     """
 
     def __init__(self, url: str):
         BaseMQAgent.__init__(self, url)
-        logger.info(f'connecting to mq: {url=}')
+        args = furl(url).args
+        self.codec = args.get('codec', 'json')
+        self.compress_threshold = int(args['compress']) if 'compress' in args else None
+        if self.codec not in codec.CODECS:
+            raise NotImplementedError(f'Unsupported codec: {self.codec}')
+        logger.info(f'connecting to mq: {url=}, codec={self.codec}, compress_threshold={self.compress_threshold}')
         self.utils = RabbitMQ(url)
 
-    def consume_snapshots(self, callback: callable, topic: str):
-        self.utils.consume(callback, 'snapshot', [topic])
+    def consume_snapshots(self, callback: callable, topic: str, prefetch: int = None):
+        self.utils.consume(callback, 'snapshot', [topic], prefetch=prefetch)
+
+    def consume_snapshots_parts(self, callback: callable, topic: str, prefetch: int = None):
+        def callback_wrapper(body, headers):
+            parts = headers[PARTS_HEADER].split(',') if PARTS_HEADER in headers else None
+            errors = callback(body, parts)
+            if errors:
+                # retry the snapshot only with the parts that failed
+                raise PartialFailure('Failed parts: ' + ', '.join(f'{name}: {error}' for name, error in errors.items()),
+                                     {PARTS_HEADER: ','.join(errors)})
+
+        self.utils.consume(callback_wrapper, 'snapshot', [topic], prefetch=prefetch, headers=True)
+
+    def consume_snapshots_batch(self, callback: callable, topic: str, batch_size: int, timeout: float,
+                                prefetch: int = None):
+        self.utils.consume_batch(callback, 'snapshot', [topic], batch_size, timeout, prefetch=prefetch)
 
     def publish_result(self, result: dict, topic: str):
-        # convert result to JSON format and publish to MQ
-        result = json.dumps(result)
-        self.utils.publish(result, exchange='saver', queue=f'saver_{topic}')
+        # encode result and publish to MQ, with its content type and encoding
+        data, content_type, content_encoding = codec.encode(result, self.codec, self.compress_threshold)
+        self.utils.publish(data, exchange='saver', queue=f'saver_{topic}', content_type=content_type,
+                           content_encoding=content_encoding)
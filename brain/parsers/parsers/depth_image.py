@@ -1,10 +1,52 @@
-import matplotlib.pyplot as plt
 import numpy as np
+from PIL import Image
 
 from brain.utils.common import get_logger
 
 logger = get_logger(__name__)
 
+# polynomial fit of the viridis colormap (matplotlib's default), by channel
+_VIRIDIS_COEFFICIENTS = np.array([
+    [0.2777273272234177, 0.005407344544966578, 0.3340998053353061],
+    [0.1050930431085774, 1.404613529898575, 1.384590162594685],
+    [-0.3308618287255563, 0.214847559468213, 0.09509516302823659],
+    [-4.634230498983486, -5.799100973351585, -19.33244095627987],
+    [6.228269936347081, 14.17993336680509, 56.69055260068105],
+    [4.776384997670288, -13.74514537774601, -65.35303263337234],
+    [-5.435455855934631, 4.645852612178535, 26.3124352495832],
+])
+
+
+def _build_colormap(coefficients: np.ndarray, size: int = 256) -> np.ndarray:
+    # evaluate the colormap polynomial once for every color of the lookup table
+    t = np.linspace(0, 1, size)[:, None]
+    colors = sum(coefficient * t ** power for power, coefficient in enumerate(coefficients))
+    return (np.clip(colors, 0, 1) * 255).round().astype(np.uint8)
+
+
+COLORMAP = _build_colormap(_VIRIDIS_COEFFICIENTS)
+
+
+def colorize(array: np.ndarray, colormap: np.ndarray = COLORMAP) -> np.ndarray:
+    """
+    Map a depth array to colors: normalize it to the [0, 1] range, and map it through the colormap lookup table.
+    The range is of the finite values only, infinite values get the colors of the range edges, and NaN values get the
+    color of its minimum.
+
+    :param array: 2D depth array.
+    :param colormap: lookup table of colors, an array of shape (N, 3).
+    :return: uint8 RGB array, of the same width and height as the depth array.
+    """
+
+    is_finite = np.isfinite(array)
+    finite = array[is_finite]
+    low, high = (finite.min(), finite.max()) if finite.size else (0, 0)
+    scale = (len(colormap) - 1) / (high - low) if high > low else 0
+    indices = np.zeros(array.shape)  # NaN and -inf values get the first color
+    indices[is_finite] = (finite - low) * scale
+    indices[array == np.inf] = len(colormap) - 1  # also when there is no finite range to scale
+    return colormap[indices.round().astype(np.intp)]
+
 
 def parse_depth_image(data, context):
     """
@@ -20,11 +62,12 @@ def parse_depth_image(data, context):
     width, height, file_name = data['width'], data['height'], data['file_name']
     path = context.path(file_name)
     new_path = context.path('depth_image.jpg')
-    # read raw depth image
-    array = np.load(path).reshape((height, width))
-    # parse and save to JPEG
-    plt.imshow(array)
-    plt.savefig(new_path)
+    # map the float32 depth image, instead of reading it to memory
+    array = np.load(path, mmap_mode='r').reshape((height, width))
+    # color and save to JPEG
+    image = Image.fromarray(colorize(array), 'RGB')
+    image.save(new_path)
+    del array  # release the mapped file before deleting it
     # delete old file
     context.delete(file_name)
     return {'width': width, 'height': height, 'path': new_path}
@@ -21,3 +21,15 @@ class FeelingParser:
 
         logger.info(f'running feelings parser')
         return data
+
+    def parse_batch(self, items, contexts):
+        """
+        Parse several feelings at once.
+
+        :param items: list of the data to parse.
+        :param contexts: the contexts of the items, passed by the parsers context.
+        :return: the given data.
+        """
+
+        logger.info(f'running feelings parser on {len(items)} items')
+        return items
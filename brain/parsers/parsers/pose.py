@@ -17,3 +17,19 @@ def parse_pose(data, context):
 
 
 parse_pose.field = 'pose'
+
+
+def parse_pose_batch(items, contexts):
+    """
+    Parsing several poses at once.
+
+    :param items: list of poses as appear in the snapshots.
+    :param contexts: the contexts of the snapshots, given by the parsers framework.
+    :return: the given poses.
+    """
+
+    logger.info(f'running pose parser on {len(items)} poses')
+    return items
+
+
+parse_pose.parse_batch = parse_pose_batch
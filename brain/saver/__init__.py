@@ -3,4 +3,5 @@ The saver package gets parsed results and saves them to a database. It also allo
 that consumes the results from MQ.
 """
 
-from .saver import Saver, run_saver
+from .journal import Journal, JournalFlusher
+from .saver import JoinBuffer, Saver, SaverPool, run_saver
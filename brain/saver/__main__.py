@@ -34,16 +34,55 @@ def cli_save(database: str, topic: str, path: str):
 
 
 @cli.command('run-saver')
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=1,
+              help='Maximal number of results to save together.')
+@click.option('-t', '--batch-timeout', type=click.IntRange(min=1), default=100,
+              help='Maximal time (in milliseconds) to wait for a batch to fill.')
+@click.option('-j', '--join-timeout', type=click.IntRange(min=1), default=None,
+              help='Join the results of each snapshot, waiting up to this time (in milliseconds) for all of them.')
+@click.option('--join-size', type=click.IntRange(min=1), default=256,
+              help='Maximal number of snapshots to join at once.')
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1,
+              help='Number of threads that save results concurrently.')
+@click.option('--prefetch', type=click.IntRange(min=1), default=None,
+              help='Maximal number of results to receive ahead when saving concurrently.')
+@click.option('--journal', type=click.Path(file_okay=False), default=None,
+              help='Directory of a local journal, to acknowledge results once they were appended to it.')
+@click.option('--journal-batch', type=click.IntRange(min=1), default=1000,
+              help='Maximal number of results to save from the journal at once.')
 @click.argument('database', type=click.STRING)
 @click.argument('mq', type=click.STRING)
 @cli_suppress
-def cli_run_saver(database: str, mq: str):
+def cli_run_saver(batch_size: int, batch_timeout: int, join_timeout: int, join_size: int, workers: int, prefetch: int,
+                  journal: str, journal_batch: int, database: str, mq: str):
     """
     Run the save as a service, saving results to the given `database` and consuming from the given `mq`.
     """
 
-    logger.info(f'running cli run-saver: {database=}, {mq=}')
-    run_saver(database, mq)
+    logger.info(f'running cli run-saver: {database=}, {mq=}, {batch_size=}, {batch_timeout=}, {join_timeout=}, '
+                f'{join_size=}, {workers=}, {prefetch=}, {journal=}, {journal_batch=}')
+    join_timeout = join_timeout / 1000 if join_timeout else None
+    run_saver(database, mq, batch_size=batch_size, batch_timeout=batch_timeout / 1000, join_timeout=join_timeout,
+              join_size=join_size, workers=workers, prefetch=prefetch, journal=journal, journal_batch=journal_batch)
+
+
+@cli.command('migrate')
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=100,
+              help='Number of legacy entries to read at once.')
+@click.option('--delete', is_flag=True, default=False, help='Delete the legacy entries once they were migrated.')
+@click.argument('database', type=click.STRING)
+@cli_suppress
+def cli_migrate(batch_size: int, delete: bool, database: str):
+    """
+    Migrate the data of the given `database` from the legacy layout to the current one.
+    It can run while the saver is running.
+    """
+
+    logger.info(f'running cli migrate: {database=}, {batch_size=}, {delete=}')
+    agent = Saver(database).agent
+    if not hasattr(agent, 'migrate_legacy_collection'):
+        raise NotImplementedError(f'Migration is not supported for database: {database}')
+    print(f'Migrated {agent.migrate_legacy_collection(batch_size=batch_size, delete=delete)} users')
 
 
 if __name__ == '__main__':
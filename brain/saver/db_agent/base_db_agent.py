@@ -29,3 +29,16 @@ class BaseDBAgent(abc.ABC):
         """
 
         pass
+
+    def save_results(self, results: list):
+        """
+        Save several results to the database.
+        DB agents should override it if they can save several results at once, by default the results are saved one
+        by one.
+
+        :param results: list of (topic, user_id, user_data, snapshot_id, timestamp, result) tuples, with the same
+            arguments as `save_result`.
+        """
+
+        for result in results:
+            self.save_result(*result)
@@ -4,6 +4,8 @@ The MongoDB agent module provides a DB agent with MongoDB implementation.
 
 from typing import Any
 
+from pymongo import UpdateOne
+
 from brain.saver.db_agent.base_db_agent import BaseDBAgent
 from brain.utils.common import get_logger
 from brain.utils.mongodb import MongoDB
@@ -11,52 +13,49 @@ from brain.utils.mongodb import MongoDB
 logger = get_logger(__name__)
 
 
+def _user_update(user_id: str, user_data: dict) -> tuple:
+    # the user details are set only on insert
+    return {'_id': user_id}, {'$setOnInsert': {'user_id': user_id, **user_data}}
+
+
+def _snapshot_update(user_id: str, snapshot_id: int, timestamp: int, results: dict) -> tuple:
+    # the snapshot details are set only on insert, and each result is set on its own field, so saving results of
+    # different topics of the same snapshot never overwrite each other
+    return {'user_id': user_id, 'uuid': snapshot_id}, {'$setOnInsert': {'datetime': timestamp},
+                                                       '$set': {f'results.{topic}': result
+                                                                for topic, result in results.items()}}
+
+
 class DBAgent(MongoDB, BaseDBAgent):
     """
     MongoDB-based implementation of DB agent.
 
-    This implementation has single collection that contains an entry per user.
-    Each user entry contains its details, and list of snapshots.
-    Each snapshot entry in the list contains its details and available results.
-    All database update operations are atomic, so there shouldn't be any race conditions.
+    This implementation has a users collection, that contains an entry per user, and a snapshots collection, that
+    contains an entry per snapshot with its details and available results (see `brain.utils.mongodb`).
+    Each result is saved by single-entry upserts, so there shouldn't be any race conditions.
+    The user is upserted with every result (its details are set only on insert), so a user that was deleted from the
+    database is saved again.
     """
 
-    def _create_user_if_not_exist(self, user_id, user_entry):
-        # add user entry to the database if user id does not exist
-        res = self.update_one(
-            {'_id': user_id},
-            {'$setOnInsert': user_entry},
-            upsert=True
-        )
-        return bool(res.upserted_id)
-
-    def _create_snapshot_if_not_exist(self, user_id, snapshot_id, snapshot_entry):
-        # add snapshot entry to snapshots list of a user if snapshot id does not exist
-        res = self.update_one(
-            {'_id': user_id, 'snapshots._id': {'$nin': [snapshot_id]}},
-            {'$push': {'snapshots': snapshot_entry}}
-        )
-        return bool(res.matched_count)
-
-    def _add_result_to_snapshot(self, topic, user_id, snapshot_id, result_entry):
-        # add result to the snapshot results
-        self.update_one(
-            {'_id': user_id, 'snapshots._id': snapshot_id},
-            {'$set': {f'snapshots.$.results.{topic}': result_entry}}
-        )
-
     def save_result(self, topic: str, user_id: int, user_data: dict, snapshot_id: int, timestamp: int, result: Any):
         user_id = str(user_id)
         logger.debug(f'saving result to db: {topic=}, {user_id=}, {user_data=}, {snapshot_id=}, {timestamp=}')
-        # entry contains snapshot details and results
-        snapshot_entry = {'_id': snapshot_id, 'uuid': snapshot_id, 'datetime': timestamp, 'results': {topic: result}}
-        # entry contains user details and the snapshot details of the given snapshot (snapshot_entry)
-        user_entry = {'_id': user_id, 'user_id': user_id, **user_data, 'snapshots': [snapshot_entry]}
-        # try to insert the user entry first
-        if self._create_user_if_not_exist(user_id, user_entry):
-            return  # user entry was added and all the required data is in database now; return
-        # user already exists, try to update only the snapshot entry
-        if self._create_snapshot_if_not_exist(user_id, snapshot_id, snapshot_entry):
-            return  # snapshot entry was added and all the required data is in database now; return
-        # snapshot already exists, just add the result
-        self._add_result_to_snapshot(topic, user_id, snapshot_id, result)
+        self.upsert_one(self.users, *_user_update(user_id, user_data))
+        self.upsert_one(self.snapshots, *_snapshot_update(user_id, snapshot_id, timestamp, {topic: result}))
+
+    def save_results(self, results: list):
+        logger.debug(f'saving {len(results)} results to db')
+        users = {}
+        snapshots = {}
+        for topic, user_id, user_data, snapshot_id, timestamp, result in results:
+            user_id = str(user_id)
+            users[user_id] = user_data
+            # the results of a snapshot are saved by a single update, where the last result of a topic wins
+            _, snapshot_results = snapshots.setdefault((user_id, snapshot_id), (timestamp, {}))
+            snapshot_results[topic] = result
+        # the updates are independent of each other, so they are written unordered, in a single round trip for each
+        # collection
+        self.bulk_upsert(self.users, [UpdateOne(*_user_update(user_id, user_data), upsert=True)
+                                      for user_id, user_data in users.items()])
+        self.bulk_upsert(self.snapshots, [UpdateOne(*_snapshot_update(*key, *value), upsert=True)
+                                          for key, value in snapshots.items()])
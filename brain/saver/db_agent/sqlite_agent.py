@@ -0,0 +1,42 @@
+"""
+The SQLite agent module provides a DB agent with SQLite implementation.
+"""
+
+import json
+from typing import Any
+
+from brain.saver.db_agent.base_db_agent import BaseDBAgent
+from brain.utils.common import get_logger
+from brain.utils.sqlite import SQLite
+
+logger = get_logger(__name__)
+
+
+class DBAgent(SQLite, BaseDBAgent):
+    """
+    SQLite-based implementation of DB agent.
+
+    The results are saved in a single transaction per call (see `brain.utils.sqlite` for the tables). Users and
+    snapshots are inserted only if they do not exist, and results replace the previous result of their topic, so saving
+    the same results again does not change the database.
+    """
+
+    def save_result(self, topic: str, user_id: int, user_data: dict, snapshot_id: int, timestamp: int, result: Any):
+        self.save_results([(topic, user_id, user_data, snapshot_id, timestamp, result)])
+
+    def save_results(self, results: list):
+        logger.debug(f'saving {len(results)} results to db')
+        users, snapshots, snapshot_results = {}, {}, {}
+        for topic, user_id, user_data, snapshot_id, timestamp, result in results:
+            user_id, snapshot_id = str(user_id), str(snapshot_id)
+            users[user_id] = (user_id, user_data.get('username'), user_data.get('birthday'), user_data.get('gender'))
+            snapshots[user_id, snapshot_id] = (user_id, snapshot_id, timestamp)
+            # the last result of a topic wins
+            snapshot_results[user_id, snapshot_id, topic] = (user_id, snapshot_id, topic, json.dumps(result))
+        with self.connection as connection:
+            connection.executemany('INSERT OR IGNORE INTO users (user_id, username, birthday, gender) '
+                                   'VALUES (?, ?, ?, ?)', users.values())
+            connection.executemany('INSERT OR IGNORE INTO snapshots (user_id, snapshot_id, datetime) VALUES (?, ?, ?)',
+                                   snapshots.values())
+            connection.executemany('INSERT OR REPLACE INTO results (user_id, snapshot_id, name, result) '
+                                   'VALUES (?, ?, ?, ?)', snapshot_results.values())
@@ -0,0 +1,265 @@
+"""
+The journal module provides a local write-ahead journal of results, so the saver can acknowledge results as soon as
+they are durably stored, while they are saved to the database in the background. Therefore stalls of the database do
+not back up the message queue.
+"""
+
+import json
+import os
+import pathlib
+import struct
+import threading
+import zlib
+
+from brain.utils import codec
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+
+_HEADER = struct.Struct('<II')  # record size, record crc32
+_CHECKPOINT_FILE = 'checkpoint.json'
+_SEGMENT_PATTERN = 'journal-{:012d}.log'
+_SEGMENT_GLOB = 'journal-*.log'
+
+
+class Journal:
+    """
+    Append-only journal of results, stored in segment files in a local directory.
+
+    Each record holds the arguments of a result for the DB agent, encoded by the binary codec (see
+    `brain.utils.codec`), with its size and checksum. The position of the first record that was not saved yet is kept
+    in a checkpoint file, and segments before it are deleted. A record that was torn by a crash fails its checksum, so
+    it is ignored, and each run appends to a new segment.
+
+    :param path: the directory of the journal.
+    :param segment_size: size (in bytes) of a segment, after which a new one is started.
+    :param sync: sync each append to the disk, so the records survive a crash of the machine (and not only of the
+        process).
+    """
+
+    def __init__(self, path: str, segment_size: int = 64 << 20, sync: bool = True):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.sync = sync
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        self.position = self._load_checkpoint()  # (segment, offset) of the first record that was not saved
+        segments = self._segments()
+        self._segment = max(segments + [self.position[0]]) + 1
+        self._writer = open(self._segment_path(self._segment), 'ab')
+        self._end = (self._segment, 0)  # (segment, offset) after the last appended record
+        logger.info(f'opened journal: {path=}, position={self.position}, segments={len(segments)}')
+
+    def _segment_path(self, segment: int) -> pathlib.Path:
+        return self.path / _SEGMENT_PATTERN.format(segment)
+
+    def _segments(self) -> list:
+        return sorted(int(entry.stem.split('-')[1]) for entry in self.path.glob(_SEGMENT_GLOB))
+
+    def _load_checkpoint(self) -> tuple:
+        try:
+            with open(self.path / _CHECKPOINT_FILE, 'r') as reader:
+                checkpoint = json.load(reader)
+            return checkpoint['segment'], checkpoint['offset']
+        except FileNotFoundError:
+            return 0, 0
+
+    def append(self, results: list):
+        """
+        Append results to the journal, and return once they are durably stored.
+
+        :param results: list of (topic, user_id, user_data, snapshot_id, timestamp, result) tuples, with the arguments
+            of `BaseDBAgent.save_result`.
+        """
+
+        records = bytearray()
+        for result in results:
+            payload, _, _ = codec.encode(list(result), 'binary')
+            records += _HEADER.pack(len(payload), zlib.crc32(payload))
+            records += payload
+        with self._lock:
+            self._writer.write(records)
+            self._writer.flush()
+            if self.sync:
+                os.fsync(self._writer.fileno())
+            self._end = (self._segment, self._writer.tell())
+            if self._end[1] >= self.segment_size:
+                self._writer.close()
+                self._segment += 1
+                self._writer = open(self._segment_path(self._segment), 'ab')
+                self._end = (self._segment, 0)
+            self._appended.notify_all()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait for records that were not read yet.
+
+        :param timeout: maximal time (in seconds) to wait.
+        :return: whether there are such records.
+        """
+
+        with self._lock:
+            return self._appended.wait_for(lambda: self._end > self.position, timeout)
+
+    def read(self, max_records: int) -> tuple:
+        """
+        Read the records from the checkpoint position.
+
+        :param max_records: maximal number of records to read.
+        :return: (records, position) tuple, where the records are lists of the arguments of
+            `BaseDBAgent.save_result`, and the position is the one after them (to `commit` once they are saved).
+        """
+
+        with self._lock:
+            end = self._end
+        segment, offset = self.position
+        records = []
+        while len(records) < max_records and (segment, offset) < end:
+            limit = end[1] if segment == end[0] else None
+            try:
+                with open(self._segment_path(segment), 'rb') as reader:
+                    reader.seek(offset)
+                    while len(records) < max_records and (limit is None or offset < limit):
+                        record = self._read_record(reader)
+                        if record is None:
+                            break
+                        records.append(record)
+                        offset = reader.tell()
+                    else:
+                        continue  # more records to read
+            except FileNotFoundError:
+                pass
+            # the end of a previous segment (or a torn record at its end)
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    @staticmethod
+    def _read_record(reader) -> list:
+        header = reader.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        size, crc = _HEADER.unpack(header)
+        payload = reader.read(size)
+        if len(payload) < size or zlib.crc32(payload) != crc:
+            logger.error(f'ignoring torn journal record: {reader.name}')
+            return None
+        return codec.decode(payload, codec.BINARY_CONTENT_TYPE)
+
+    def commit(self, position: tuple):
+        """
+        Store the checkpoint position (after the saved records), and delete the segments before it.
+
+        :param position: the position returned by `read`.
+        """
+
+        segment, offset = position
+        tmp_path = self.path / f'.{_CHECKPOINT_FILE}'
+        with open(tmp_path, 'w') as writer:
+            json.dump({'segment': segment, 'offset': offset}, writer)
+            writer.flush()
+            if self.sync:
+                os.fsync(writer.fileno())
+        os.replace(tmp_path, self.path / _CHECKPOINT_FILE)
+        self.position = position
+        for old_segment in self._segments():
+            if old_segment < segment:
+                self._segment_path(old_segment).unlink()
+
+    def close(self):
+        """
+        Close the journal.
+        """
+
+        with self._lock:
+            self._writer.close()
+
+
+class JournalFlusher:
+    """
+    The JournalFlusher class saves the records of a journal to the database in batches, by a background thread, and
+    commits the journal after each saved batch.
+
+    If saving a batch failed (e.g. the database is down), it is retried after a delay, which is doubled on each failure.
+    A batch that was saved but not committed (e.g. on a crash) is saved again on the next run, which is safe as saving
+    results is idempotent.
+
+    :param journal: the journal.
+    :param saver: the saver to save the results with.
+    :param batch_size: maximal number of results to save at once.
+    :param interval: maximal time (in seconds) to wait for new results before checking whether to stop.
+    :param retry_delay: delay (in seconds) before the first retry of a failed batch.
+    :param max_retry_delay: maximal delay (in seconds) before a retry.
+    """
+
+    def __init__(self, journal: Journal, saver, batch_size: int = 1000, interval: float = 0.1, retry_delay: float = 1,
+                 max_retry_delay: float = 30):
+        self.journal = journal
+        self.saver = saver
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.saved = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def flush(self) -> int:
+        """
+        Save all the records of the journal (raises an exception if saving failed).
+
+        :return: the number of saved records.
+        """
+
+        count = 0
+        while True:
+            records, position = self.journal.read(self.batch_size)
+            if records:
+                self.saver.agent.save_results([tuple(record) for record in records])
+            if position != self.journal.position:
+                self.journal.commit(position)
+            count += len(records)
+            self.saved += len(records)
+            if len(records) < self.batch_size:
+                return count
+
+    def run(self):
+        """
+        Save the records of the journal as they are appended, until stopped.
+        """
+
+        delay = self.retry_delay
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                self.flush()
+                delay = self.retry_delay
+            except Exception as error:
+                logger.error(f'failed saving journal records, retrying in {delay} seconds: {error}')
+                if self._stop.wait(delay) and stopping:
+                    return
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            if stopping:
+                return
+            self.journal.wait(self.interval)
+
+    def start(self):
+        """
+        Start saving the records of the journal in the background.
+        """
+
+        logger.info(f'starting journal flusher: {self.batch_size=}')
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stop saving, after a last attempt to save the records of the journal.
+
+        :param timeout: maximal time (in seconds) to wait.
+        """
+
+        logger.info(f'stopping journal flusher')
+        self._stop.set()
+        self._thread.join(timeout)
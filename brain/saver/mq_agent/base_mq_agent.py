@@ -25,3 +25,42 @@ class BaseMQAgent(abc.ABC):
         """
 
         pass
+
+    def consume_results_batch(self, callback: callable, topics: list, batch_size: int, timeout: float):
+        """
+        Consume results from multiple topics in batches. The messages of a batch are acknowledged only after the
+        callback returned.
+        MQ agents should override it if they can consume several messages at once, by default the batches contain
+        a single result.
+
+        :param callback: will be called with a list of (topic name, message) tuples when a batch is ready, and returns a
+            list of the errors of the messages (None for the messages that succeeded), so only the failed messages are
+            retried.
+        :param topics: topics to consume.
+        :param batch_size: maximal number of results in a batch.
+        :param timeout: maximal time (in seconds) to wait for a batch to fill.
+        """
+
+        def callback_wrapper(topic, data):
+            [error] = callback([(topic, data)]) or [None]
+            if error is not None:
+                raise error
+
+        self.consume_results(callback_wrapper, topics)
+
+    def consume_results_deferred(self, callback: callable, topics: list, tick: float = None,
+                                 on_tick: callable = None, prefetch: int = None):
+        """
+        Consume results from multiple topics, where each message is acknowledged by the callback on its own, possibly
+        after the callback returned (e.g. when it is saved together with results that arrive later).
+        MQ agents that support deferred acknowledgements should override it.
+
+        :param callback: will be called when a new message has arrived, with the topic name, the message, and an `ack`
+            function to call once it was handled (from any thread), with the exception if its handling failed.
+        :param topics: topics to consume.
+        :param tick: interval (in seconds) of calling `on_tick`.
+        :param on_tick: if given, will be called periodically, from the consuming thread.
+        :param prefetch: if given, maximal number of unacknowledged results to receive ahead.
+        """
+
+        raise NotImplementedError(f'Deferred acknowledgements are not supported by {self.__class__.__name__}')
@@ -11,6 +11,7 @@ logger = get_logger(__name__)
 class MQAgent(BaseMQAgent):
     """
     RabbitMQ-based implementation of MQ agent.
+    The results are decoded by their content type, so results of all the codecs are consumed (see `brain.utils.codec`).
     """
 
     def __init__(self, url: str):
@@ -26,4 +27,26 @@ class MQAgent(BaseMQAgent):
 
         # consume in 'direct' exchange - publisher also provides queue name in addition to exchange,
         # and the message will be sent to the specific queue consumer in this exchange.
-        self.utils.consume(callback_wrapper, 'saver', [f'saver_{topic}' for topic in topics], exchange_type='direct')
+        self.utils.consume(callback_wrapper, 'saver', [f'saver_{topic}' for topic in topics], exchange_type='direct',
+                           decode=True)
+
+    def consume_results_batch(self, callback: callable, topics: list, batch_size: int, timeout: float):
+        def callback_wrapper(messages):
+            # parsers-saver queue convention is <topic>_saver
+            items = [(queue[len('saver_'):], data) for queue, data in messages]
+            logger.debug(f'consumed {len(items)} new results')
+            return callback(items)
+
+        self.utils.consume_batch(callback_wrapper, 'saver', [f'saver_{topic}' for topic in topics], batch_size, timeout,
+                                 exchange_type='direct', decode=True)
+
+    def consume_results_deferred(self, callback: callable, topics: list, tick: float = None,
+                                 on_tick: callable = None, prefetch: int = None):
+        def callback_wrapper(message, ack):
+            queue, data = message
+            topic = queue[len('saver_'):]  # parsers-saver queue convention is <topic>_saver
+            logger.debug(f'consumed new results: {topic=}')
+            return callback(topic, data, ack)
+
+        self.utils.consume_deferred(callback_wrapper, 'saver', [f'saver_{topic}' for topic in topics],
+                                    exchange_type='direct', prefetch=prefetch, tick=tick, on_tick=on_tick, decode=True)
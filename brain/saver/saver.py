@@ -2,11 +2,16 @@
 The saver module contains the main logic of the saver, which is, to save results and run the saver as a service.
 """
 
+import collections
 import json
+import queue
+import threading
+import time
 
 from brain.parsers import get_parsers
 from brain.utils.common import get_logger, get_url_scheme
 from .db_agent import load_db_agent
+from .journal import Journal, JournalFlusher
 from .mq_agent import load_mq_agent
 
 logger = get_logger(__name__)
@@ -31,28 +36,263 @@ class Saver:
         Save results to a dedicated topic in the database.
 
         :param topic: the topic of the provided data.
-        :param data: data to save, in JSON format.
+        :param data: data to save, in JSON format, or already decoded by its codec (see `brain.utils.codec`).
         """
 
         logger.debug(f'saving data for {topic=}')
-        data = json.loads(data)  # load data from JSON format
+        self.agent.save_result(*self._load(topic, data))
+
+    def save_batch(self, items: list) -> list:
+        """
+        Save several results to the database at once. An invalid result does not affect the other results.
+
+        :param items: list of (topic, data) tuples, as given to `save`.
+        :return: list of the errors of the results (None for the results that were saved).
+        """
+
+        logger.debug(f'saving batch of {len(items)} results')
+        loaded, errors = self._load_batch(items)
+        if loaded:
+            self.agent.save_results(loaded)
+        return errors
+
+    @classmethod
+    def _load_batch(cls, items: list) -> tuple:
+        # load each result on its own, and get the arguments of the DB agent of the valid ones and the errors of all
+        loaded, errors = [], []
+        for topic, data in items:
+            try:
+                loaded.append(cls._load(topic, data))
+            except Exception as error:
+                logger.error(f'invalid result: {topic=}, {error=}')
+                errors.append(error)
+            else:
+                errors.append(None)
+        return loaded, errors
+
+    @staticmethod
+    def _load(topic: str, data) -> tuple:
+        # load data from JSON format (unless it was already decoded), and get the arguments of the DB agent
+        if isinstance(data, (str, bytes)):
+            data = json.loads(data)
         snapshot_id, timestamp, user_data, result = data['uuid'], data['datetime'], data['user'], data['result']
         user_id = user_data.pop('user_id')
-        self.agent.save_result(topic, user_id, user_data, snapshot_id, timestamp, result)
+        return topic, user_id, user_data, snapshot_id, timestamp, result
+
+
+class JoinBuffer:
+    """
+    The JoinBuffer class holds the results of each snapshot in memory, until the results of all the topics of the
+    snapshot arrived, or it waited `timeout` seconds, and then saves them together (by a single update of the
+    snapshot, see `BaseDBAgent.save_results`). Each result is acknowledged only after it was saved.
+
+    The buffer holds up to `max_snapshots` snapshots: when a result of a new snapshot arrives to a full buffer, the
+    snapshot that arrived first is saved partially, and its other results are saved when they arrive.
+
+    :param saver: the saver to save the results with.
+    :param topics: the topics of a complete snapshot.
+    :param timeout: maximal time (in seconds) to hold a snapshot (checked by `expire`).
+    :param max_snapshots: maximal number of snapshots to hold.
+    """
+
+    def __init__(self, saver: Saver, topics: list, timeout: float = 5, max_snapshots: int = 256):
+        self.saver = saver
+        self.topics = set(topics)
+        self.timeout = timeout
+        self.max_snapshots = max_snapshots
+        self.complete = 0
+        self.partial = 0
+        # (user id, snapshot id) -> (arrival time, {topic: arguments of the DB agent}, acknowledge functions),
+        # ordered by arrival
+        self._snapshots = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def add(self, topic: str, data: str, ack: callable = None):
+        """
+        Add a result to the buffer, and save its snapshot if it is complete.
+
+        :param topic: the topic of the provided data.
+        :param data: data to save (see `Saver.save`).
+        :param ack: if given, will be called once the result was saved, with the exception if saving it failed.
+        """
+
+        args = self.saver._load(topic, data)
+        _, user_id, _, snapshot_id, _, _ = args
+        key = str(user_id), snapshot_id
+        if key not in self._snapshots:
+            if len(self._snapshots) >= self.max_snapshots:
+                oldest = next(iter(self._snapshots))
+                logger.debug(f'join buffer is full, saving partial snapshot: {oldest=}')
+                self._flush(oldest)
+            self._snapshots[key] = (time.monotonic(), {}, [])
+        _, results, acks = self._snapshots[key]
+        results[topic] = args  # the last result of a topic wins
+        acks.append(ack)
+        if self.topics.issubset(results):
+            self._flush(key)
+
+    def expire(self):
+        """
+        Save the snapshots that waited `timeout` seconds, even if they are partial.
+        """
 
+        deadline = time.monotonic() - self.timeout
+        expired = [key for key, (arrival, _, _) in self._snapshots.items() if arrival <= deadline]
+        if expired:
+            logger.debug(f'saving {len(expired)} expired snapshots')
+        for key in expired:
+            self._flush(key)
 
-def run_saver(db_url, mq_url):
+    def flush(self):
+        """
+        Save all the snapshots in the buffer, even if they are partial.
+        """
+
+        for key in list(self._snapshots):
+            self._flush(key)
+
+    def _flush(self, key: tuple):
+        _, results, acks = self._snapshots.pop(key)
+        if self.topics.issubset(results):
+            self.complete += 1
+        else:
+            self.partial += 1
+        error = None
+        try:
+            self.saver.agent.save_results(list(results.values()))
+        except Exception as exception:
+            logger.error(f'failed saving snapshot: {key=}, {exception=}')
+            error = exception
+        for ack in acks:
+            if ack is not None:
+                ack(error)
+
+
+class SaverPool:
+    """
+    The SaverPool class saves results concurrently by `workers` threads, so the latency of the database is not
+    serialized. The results of the same snapshot are saved by the same thread, in the order they were added, and the
+    results of different snapshots are saved in parallel.
+
+    :param saver: the saver to save the results with.
+    :param workers: number of saving threads.
+    """
+
+    def __init__(self, saver: Saver, workers: int = 4):
+        self.saver = saver
+        self.workers = workers
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(results_queue,), daemon=True)
+                         for results_queue in self._queues]
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, topic: str, data: str, ack: callable = None):
+        """
+        Add a result to be saved by the thread of its snapshot.
+
+        :param topic: the topic of the provided data.
+        :param data: data to save (see `Saver.save`).
+        :param ack: if given, will be called (from the saving thread) once the result was saved, with the exception if
+            saving it failed.
+        """
+
+        args = self.saver._load(topic, data)
+        _, user_id, _, snapshot_id, _, _ = args
+        self._queues[hash((str(user_id), snapshot_id)) % self.workers].put((args, ack))
+
+    def close(self):
+        """
+        Wait for the added results to be saved, and stop the threads.
+        """
+
+        for results_queue in self._queues:
+            results_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, results_queue: queue.Queue):
+        while True:
+            item = results_queue.get()
+            if item is None:
+                return
+            args, ack = item
+            error = None
+            try:
+                self.saver.agent.save_result(*args)
+            except Exception as exception:
+                logger.error(f'failed saving result: {exception=}')
+                error = exception
+            if ack is not None:
+                ack(error)
+
+
+def run_saver(db_url, mq_url, batch_size: int = 1, batch_timeout: float = 0.1, join_timeout: float = None,
+              join_size: int = 256, workers: int = 1, prefetch: int = None, journal: str = None,
+              journal_batch: int = 1000):
     """
     Run the saver as a service.
 
     :param db_url: address of the database.
     :param mq_url: address of the MQ to consume results from.
+    :param batch_size: if greater than 1, consume up to `batch_size` results and save them together (see
+        `Saver.save_batch`). The results are acknowledged only after they were saved.
+    :param batch_timeout: maximal time (in seconds) to wait for a batch to fill.
+    :param join_timeout: if given, join the results of each snapshot, and save them together once all of them arrived,
+        or after about `join_timeout` seconds (see `JoinBuffer`). The results are acknowledged only after they were
+        saved. Cannot be used with `batch_size`.
+    :param join_size: maximal number of snapshots to join at once.
+    :param workers: if greater than 1, save the results concurrently by `workers` threads (see `SaverPool`). The
+        results are acknowledged only after they were saved. Cannot be used with `batch_size` or `join_timeout`.
+    :param prefetch: maximal number of unacknowledged results to receive ahead when saving concurrently (by default,
+        16 per worker).
+    :param journal: if given, a directory of a journal (see `Journal`): the results are acknowledged once they were
+        appended to the journal, and saved from it in the background (see `JournalFlusher`). Can be used with
+        `batch_size` (to append the results of a batch together), and cannot be used with `join_timeout` or `workers`.
+    :param journal_batch: maximal number of results to save from the journal at once.
     """
 
-    logger.info(f'running saver: {db_url=}, {mq_url=}')
+    logger.info(f'running saver: {db_url=}, {mq_url=}, {batch_size=}, {batch_timeout=}, {join_timeout=}, '
+                f'{join_size=}, {workers=}, {prefetch=}, {journal=}, {journal_batch=}')
+    if sum([batch_size > 1 and not journal, bool(join_timeout), workers > 1, bool(journal)]) > 1:
+        raise Exception('Only one of batches, joining snapshots, workers and journal can be used')
     saver = Saver(db_url)
     mq_type = get_url_scheme(mq_url)
     mq_agent_module = load_mq_agent(mq_type)
     mq_agent = mq_agent_module.MQAgent(mq_url)
     logger.info(f'starting to consume data from mq')
-    mq_agent.consume_results(saver.save, topics)
+    if journal:
+        journal = Journal(journal)
+        flusher = JournalFlusher(journal, saver, batch_size=journal_batch)
+        flusher.start()
+        try:
+            if batch_size > 1:
+                def append_batch(items):
+                    loaded, errors = saver._load_batch(items)
+                    if loaded:
+                        journal.append(loaded)
+                    return errors
+
+                mq_agent.consume_results_batch(append_batch, topics, batch_size, batch_timeout)
+            else:
+                mq_agent.consume_results(lambda topic, data: journal.append([saver._load(topic, data)]), topics)
+        finally:
+            flusher.stop()
+            journal.close()
+    elif workers > 1:
+        pool = SaverPool(saver, workers)
+        try:
+            mq_agent.consume_results_deferred(pool.add, topics, prefetch=prefetch or 16 * workers)
+        finally:
+            pool.close()
+    elif join_timeout:
+        buffer = JoinBuffer(saver, topics, timeout=join_timeout, max_snapshots=join_size)
+        # receive enough results ahead to fill the buffer
+        mq_agent.consume_results_deferred(buffer.add, topics, join_timeout / 2, buffer.expire,
+                                          prefetch=join_size * len(topics))
+    elif batch_size > 1:
+        mq_agent.consume_results_batch(saver.save_batch, topics, batch_size, batch_timeout)
+    else:
+        mq_agent.consume_results(saver.save, topics)
@@ -30,6 +30,19 @@ class BaseClientAgent(abc.ABC):
 
         pass
 
+    @abc.abstractmethod
+    def register_snapshots_handler(self, handler: callable):
+        """
+        Register with the given snapshots handler: whenever a batch of snapshots is received, the handler will be
+        called with the list of parsed snapshots, and the publish function.
+        The handler should return a list with the error of each snapshot that could not be handled (None for
+        snapshots that were handled successfully).
+
+        :param handler: the handler function
+        """
+
+        pass
+
     @abc.abstractmethod
     def run(self, host: str, port: int):
         """
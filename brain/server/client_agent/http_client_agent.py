@@ -6,7 +6,8 @@ import flask
 
 from brain.autogen import client_server_pb2
 from brain.server.client_agent.base_client_agent import BaseClientAgent
-from brain.utils.common import get_logger, parse_protobuf
+from brain.server.sample_reader import read_sample
+from brain.utils.common import get_logger, parse_protobuf, unpack_messages
 
 logger = get_logger(__name__)
 
@@ -14,22 +15,42 @@ logger = get_logger(__name__)
 class ClientAgent(BaseClientAgent):
     """
     HTTP-based implementation of client agent.
+
+    - `POST /snapshot` - a single snapshot.
+    - `POST /snapshots` - a batch of snapshots, passed to the snapshots handlers.
+    - `POST /sample` - a whole sample file (might be gzip compressed, and might be sent chunked), which is read while
+      it streams in. Each of its snapshots is passed to the snapshot handlers.
     """
 
     def __init__(self, publish: callable = None):
         BaseClientAgent.__init__(self, publish=publish)
         self.app = flask.Flask(__name__)  # use flask for the server
         self.snapshot_handlers = []
+        self.snapshots_handlers = []
 
         @self.app.route('/snapshot', methods=['POST'])
         def handle_snapshot():
             # pass to instance method.
             return self.handle_snapshot()
 
+        @self.app.route('/snapshots', methods=['POST'])
+        def handle_snapshots():
+            # pass to instance method.
+            return self.handle_snapshots()
+
+        @self.app.route('/sample', methods=['POST'])
+        def handle_sample():
+            # pass to instance method.
+            return self.handle_sample()
+
     def register_snapshot_handler(self, handler: callable):
         logger.info(f'detected new snapshot handler: {handler=}')
         self.snapshot_handlers.append(handler)  # add snapshot handler
 
+    def register_snapshots_handler(self, handler: callable):
+        logger.info(f'detected new snapshots handler: {handler=}')
+        self.snapshots_handlers.append(handler)  # add snapshots handler
+
     def handle_snapshot(self):
         logger.debug(f'received new snapshot message')
         snapshot_msg = flask.request.data
@@ -47,6 +68,65 @@ class ClientAgent(BaseClientAgent):
 
         return 'Snapshot handled successfully'
 
+    def handle_snapshots(self):
+        """
+        Handle a batch of snapshots, sent as length-prefixed sequence of snapshot messages.
+        Responds with a JSON list that contains the status of each snapshot in the batch:
+        `{"status": "ok"}` or `{"status": "error", "error": "<error message>"}`.
+        """
+
+        logger.debug(f'received new snapshots batch')
+        try:
+            messages = unpack_messages(flask.request.data)
+        except ValueError as error:
+            logger.error(f'error while unpacking batch: {error}. aborting (400)')
+            return flask.abort(400)
+
+        statuses = [None] * len(messages)
+        snapshots, positions = [], []
+        for i, message in enumerate(messages):
+            try:
+                # parse snapshot
+                snapshots.append(parse_protobuf(client_server_pb2.Snapshot(), message))
+                positions.append(i)
+            except Exception as error:
+                logger.error(f'error while parsing message #{i} of batch: {error}')
+                statuses[i] = {'status': 'error', 'error': f'Invalid snapshot message: {error}'}
+
+        # calling the registered handlers
+        for handler in self.snapshots_handlers:
+            errors = handler(snapshots, self.publish) or []
+            for i, error in zip(positions, errors):
+                if error and not statuses[i]:
+                    statuses[i] = {'status': 'error', 'error': str(error)}
+
+        statuses = [status or {'status': 'ok'} for status in statuses]
+        return flask.jsonify(statuses)
+
+    def handle_sample(self):
+        """
+        Handle a whole sample file, read from the request body without buffering it.
+        Responds with a JSON object that contains the number of handled snapshots:
+        `{"status": "ok", "count": <count>}`, or `{"status": "error", "count": <count>, "error": "<error message>"}`
+        (with 400 status code) if the sample file is invalid, in which case only the first `count` snapshots were
+        handled.
+        """
+
+        logger.info(f'receiving new sample stream')
+        count = 0
+        try:
+            for snapshot in read_sample(flask.request.stream):
+                # calling the registered handlers
+                for handler in self.snapshot_handlers:
+                    handler(snapshot, self.publish)
+                count += 1
+        except Exception as error:
+            logger.error(f'error while reading sample stream after {count} snapshots: {error}')
+            return flask.jsonify({'status': 'error', 'count': count, 'error': str(error)}), 400
+
+        logger.info(f'sample stream handled successfully: {count=}')
+        return flask.jsonify({'status': 'ok', 'count': count})
+
     def run(self, host: str, port: int):
         logger.info(f'starting to run flask app: {host=}, {port=}')
         self.app.run(host=host, port=port)  # simply run the flask app
@@ -26,3 +26,21 @@ class BaseMQAgent(abc.ABC):
         """
 
         pass
+
+    def publish_many(self, snapshots: list) -> list:
+        """
+        Publish several snapshots to the parsers via the MQ at once, where each snapshot is published even if
+        publishing the previous ones failed.
+        MQ agents should override it if they can publish snapshots more efficiently than one by one.
+
+        :param snapshots: snapshots to send in server_parsers_pb2.Snapshot format.
+        :return: list with the error of each snapshot that was not published (None for published snapshots).
+        """
+
+        errors = [None] * len(snapshots)
+        for i, snapshot in enumerate(snapshots):
+            try:
+                self.publish_snapshot(snapshot)
+            except Exception as error:
+                errors[i] = error
+        return errors
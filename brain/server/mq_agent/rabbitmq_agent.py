@@ -28,3 +28,16 @@ class MQAgent(BaseMQAgent):
         # take a lock (server is multithreaded) and send snapshot
         with self.mq_lock:
             self.utils.publish(snapshot_msg, exchange='snapshot')
+
+    def publish_many(self, snapshots: list) -> list:
+        snapshots_msgs = [serialize_protobuf(snapshot) for snapshot in snapshots]
+        errors = [None] * len(snapshots)
+        # serialize before taking the lock, and then send all snapshots with a single lock
+        with self.mq_lock:
+            for i, snapshot_msg in enumerate(snapshots_msgs):
+                try:
+                    self.utils.publish(snapshot_msg, exchange='snapshot')
+                except Exception as error:
+                    logger.error(f'error while publishing snapshot #{i} of batch: {error}')
+                    errors[i] = error
+        return errors
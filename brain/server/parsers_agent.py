@@ -3,20 +3,18 @@ The parsers agent provides an interface for the server to construct messages to
 It should provide only `construct_parsers_message` as its interface.
 """
 
+from typing import Union
+
 import numpy as np
 
 from brain import data_path
 from brain.autogen import server_parsers_pb2, client_server_pb2
-from brain.utils.common import normalize_path, get_logger
+from brain.utils.common import normalize_path, get_logger, parse_protobuf, serialize_protobuf
+from brain.utils.transcoder import client_to_parsers_snapshot
 
 logger = get_logger(__name__)
 
 
-def copy_protobuf(item_a, item_b, attrs):
-    for attr in attrs:
-        setattr(item_a, attr, getattr(item_b, attr))
-
-
 def handle_color_image(snapshot, data):
     # save color image blob as raw file to disk
     path = normalize_path(snapshot.path)
@@ -27,37 +25,35 @@ def handle_color_image(snapshot, data):
 
 
 def handle_depth_image(snapshot, data):
-    # save depth image blob as raw file to disk
+    # save depth image blob as float32 .npy file to disk, the data is the raw float32 array as sent in the message,
+    # so it is written as is, without converting it
     path = normalize_path(snapshot.path)
-    image_file = 'depth_image.raw'
-    image_file_path = str(path / image_file)
-    array = np.array(data).astype(np.float)
-    np.save(image_file_path, array)
-    snapshot.depth_image.file_name = image_file + '.npy'
+    image_file = 'depth_image.npy'
+    array = np.frombuffer(data, dtype='<f4')
+    np.save(str(path / image_file), array)
+    snapshot.depth_image.file_name = image_file
 
 
-def construct_parsers_message(snapshot: client_server_pb2.Snapshot, snapshot_uuid: int) -> server_parsers_pb2.Snapshot:
+def construct_parsers_message(snapshot: Union[client_server_pb2.Snapshot, bytes],
+                              snapshot_uuid: int) -> server_parsers_pb2.Snapshot:
     """
     Construct a message to the parsers.
 
     The main change being done at this point, is to save blobs such as color and depth image to the disk,
     and provide a path to the file on disk instead of the actual data being stored as part of the message so far.
+    The message is transcoded at the wire level (see `brain.utils.transcoder`), so the blobs are never decoded.
 
-    :param snapshot: snapshot in client_server_pb2.Snapshot format.
+    :param snapshot: snapshot in client_server_pb2.Snapshot format, or serialized.
     :param snapshot_uuid: uuid of the snapshot.
     :return: the constructed message in server_parsers_pb2.Snapshot format.
     """
 
     logger.debug(f'constructing message for parsers')
-    parsers_snapshot = server_parsers_pb2.Snapshot()
+    snapshot_msg = serialize_protobuf(snapshot) if isinstance(snapshot, client_server_pb2.Snapshot) else snapshot
+    parsers_msg, color_data, depth_data = client_to_parsers_snapshot(snapshot_msg)
+    # the parsers message is small, as it does not contain the blobs
+    parsers_snapshot = parse_protobuf(server_parsers_pb2.Snapshot(), parsers_msg)
     parsers_snapshot.uuid = snapshot_uuid
-    copy_protobuf(parsers_snapshot, snapshot, ['datetime'])
-    copy_protobuf(parsers_snapshot.user, snapshot.user, ['user_id', 'username', 'birthday', 'gender'])
-    copy_protobuf(parsers_snapshot.pose.translation, snapshot.pose.translation, ['x', 'y', 'z'])
-    copy_protobuf(parsers_snapshot.pose.rotation, snapshot.pose.rotation, ['x', 'y', 'z', 'w'])
-    copy_protobuf(parsers_snapshot.color_image, snapshot.color_image, ['width', 'height'])
-    copy_protobuf(parsers_snapshot.depth_image, snapshot.depth_image, ['width', 'height'])
-    copy_protobuf(parsers_snapshot.feelings, snapshot.feelings, ['hunger', 'thirst', 'exhaustion', 'happiness'])
 
     # before saving blobs to the disk, we must find a directory to saves file to.
     # we will use the <data-path>/<user-id>/<snapshot-id>/ directory (and create it if not exists).
@@ -73,8 +69,6 @@ def construct_parsers_message(snapshot: client_server_pb2.Snapshot, snapshot_uui
     # provide base path as part of the message, and certain results will contains file name.
     parsers_snapshot.path = str(snapshot_dir)
 
-    if parsers_snapshot.color_image:
-        handle_color_image(parsers_snapshot, snapshot.color_image.data)
-    if parsers_snapshot.depth_image:
-        handle_depth_image(parsers_snapshot, snapshot.depth_image.data)
+    handle_color_image(parsers_snapshot, b'' if color_data is None else color_data)
+    handle_depth_image(parsers_snapshot, b'' if depth_data is None else depth_data)
     return parsers_snapshot
@@ -0,0 +1,66 @@
+"""
+The sample reader module lets the server read a whole sample file by itself, as it streams in, and convert its
+snapshots into the client_server format, instead of having the client construct and send each snapshot separately.
+"""
+
+import gzip
+
+from brain.autogen import client_server_pb2
+from brain.utils.common import get_logger, parse_protobuf, serialize_protobuf
+from brain.utils.sample import SampleReader
+from brain.utils.streams import StreamReader
+from brain.utils.transcoder import mind_to_client_snapshot
+
+logger = get_logger(__name__)
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_sample_stream(stream) -> StreamReader:
+    """
+    Wrap a stream of a sample file (e.g. an HTTP request body) so it can be read by the readers.
+    The sample file might be gzip compressed, which is detected by its magic bytes.
+
+    :param stream: the sample file stream.
+    :return: a stream of the uncompressed sample file.
+    """
+
+    head = StreamReader(stream).read(len(_GZIP_MAGIC))
+    sample_stream = StreamReader(stream, prefix=head)
+    if head == _GZIP_MAGIC:
+        logger.debug(f'sample stream is gzip compressed')
+        return StreamReader(gzip.GzipFile(fileobj=sample_stream, mode='rb'))
+    return sample_stream
+
+
+def convert_snapshot(user_msg: bytes, snapshot_msg: bytes) -> client_server_pb2.Snapshot:
+    """
+    Convert a snapshot read from a sample file into the client_server format.
+    The snapshot is transcoded at the wire level (see `brain.utils.transcoder`), and parsed only once.
+
+    :param user_msg: the user of the sample file, serialized.
+    :param snapshot_msg: snapshot serialized in mind_pb2.Snapshot format.
+    :return: the snapshot in client_server_pb2.Snapshot format.
+    """
+
+    return parse_protobuf(client_server_pb2.Snapshot(), mind_to_client_snapshot(user_msg, snapshot_msg))
+
+
+def read_sample(stream):
+    """
+    Read a sample file from a stream, while it streams in, and generate its snapshots.
+
+    :param stream: the sample file stream (might be gzip compressed).
+    :return: generator of snapshots in client_server_pb2.Snapshot format.
+    :raises: ValueError for invalid sample file.
+    """
+
+    reader = SampleReader(open_sample_stream(stream))
+    user = reader.read_user()
+    logger.info(f'reading sample stream of user_id={user.user_id}')
+    user_msg = serialize_protobuf(user)
+    while True:
+        snapshot_msg = reader.read_raw_snapshot()
+        if not snapshot_msg:
+            break
+        yield convert_snapshot(user_msg, snapshot_msg)
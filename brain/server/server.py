@@ -15,23 +15,43 @@ from ..utils.consts import config
 logger = get_logger(__name__)
 
 
-def construct_publish(mq_url: str) -> callable:
+class Publisher:
     """
-    Construct a `publish` function that publishes a given snapshot to the MQ.
+    The Publisher class publishes snapshots to the MQ. It is called with a single snapshot, as a publish function, and
+    publishes several snapshots at once by `publish_many`.
 
     :param mq_url: address of the MQ.
-    :return: the publish function.
     """
 
-    logger.info(f'constructing publish function: {mq_url=}')
-    mq_type = get_url_scheme(mq_url)
-    mq_agent_module = load_mq_agent(mq_type)
-    mq_agent = mq_agent_module.MQAgent(mq_url)
+    def __init__(self, mq_url: str):
+        mq_type = get_url_scheme(mq_url)
+        mq_agent_module = load_mq_agent(mq_type)
+        self.mq_agent = mq_agent_module.MQAgent(mq_url)
+
+    def __call__(self, snapshot):
+        self.mq_agent.publish_snapshot(snapshot)  # publish to MQ
+
+    def publish_many(self, snapshots: list) -> list:
+        """
+        Publish several snapshots to the MQ at once.
 
-    def _publish(snapshot):
-        mq_agent.publish_snapshot(snapshot)  # publish to MQ
+        :param snapshots: snapshots to publish.
+        :return: list with the error of each snapshot that was not published (None for published snapshots).
+        """
 
-    return _publish
+        return self.mq_agent.publish_many(snapshots)  # publish all snapshots to MQ at once
+
+
+def construct_publish(mq_url: str) -> Publisher:
+    """
+    Construct a `publish` function that publishes a given snapshot to the MQ.
+
+    :param mq_url: address of the MQ.
+    :return: the publish function (see `Publisher`).
+    """
+
+    logger.info(f'constructing publish function: {mq_url=}')
+    return Publisher(mq_url)
 
 
 # server is multithreaded, access this common resource only with lock
@@ -39,15 +59,28 @@ snapshot_lock = threading.Lock()
 snapshot_counter = 0
 
 
-def generate_snapshot_uuid():
-    # take a lock and increase the number of snapshots by one
+def generate_snapshot_uuid(count=1):
+    # take a lock and increase the number of snapshots by count, the uuids are uuid, uuid + 1, ..., uuid + count - 1
     global snapshot_counter
     with snapshot_lock:
         uuid = snapshot_counter
-        snapshot_counter += 1
+        snapshot_counter += count
     return uuid
 
 
+def build_parsers_message(snapshot: client_server_pb2.Snapshot, snapshot_uuid: int):
+    """
+    Build the message to the parsers of an incoming snapshot.
+
+    :param snapshot: the snapshot object, in client_server_pb2.Snapshot format.
+    :param snapshot_uuid: the uuid of the snapshot.
+    :return: the message to the parsers, in server_parsers_pb2.Snapshot format.
+    """
+
+    logger.info(f'handling new snapshot, user_id={snapshot.user.user_id}, {snapshot_uuid=}')
+    return construct_parsers_message(snapshot, snapshot_uuid)
+
+
 def handle_snapshot(snapshot: client_server_pb2.Snapshot, publish: callable):
     """
     Handle an incoming snapshot: sends is to the provided publish function.
@@ -56,14 +89,54 @@ def handle_snapshot(snapshot: client_server_pb2.Snapshot, publish: callable):
     :param publish: publish function, will be sent by client agent.
     """
 
-    snapshot_uuid = generate_snapshot_uuid()
-    logger.info(f'handling new snapshot, user_id={snapshot.user.user_id}, {snapshot_uuid=}')
     # construct message to send to the parsers
-    parsers_msg = construct_parsers_message(snapshot, snapshot_uuid)
+    parsers_msg = build_parsers_message(snapshot, generate_snapshot_uuid())
     logger.debug(f'publishing snapshot to rabbitmq')
     publish(parsers_msg)  # publish the message with the given publish function
 
 
+def handle_snapshots(snapshots: list, publish: callable) -> list:
+    """
+    Handle a batch of incoming snapshots: construct their messages to the parsers, and publish them together
+    (by `Publisher.publish_many`, or by calling the publish function for each snapshot if it is not a `Publisher`).
+
+    :param snapshots: list of snapshots, in client_server_pb2.Snapshot format.
+    :param publish: publish function, will be sent by client agent.
+    :return: list with the error of each snapshot that could not be handled (None for handled snapshots), so only
+        the snapshots that were not published are reported as failed.
+    """
+
+    first_uuid = generate_snapshot_uuid(len(snapshots))
+    logger.info(f'handling {len(snapshots)} new snapshots, {first_uuid=}')
+    errors = [None] * len(snapshots)
+    parsers_msgs, handled = [], []
+    for i, snapshot in enumerate(snapshots):
+        try:
+            # construct message to send to the parsers
+            parsers_msgs.append(build_parsers_message(snapshot, first_uuid + i))
+            handled.append(i)
+        except Exception as error:
+            logger.error(f'error while handling snapshot #{i} of batch: {error}')
+            errors[i] = error
+
+    logger.debug(f'publishing {len(parsers_msgs)} snapshots to rabbitmq')
+    if isinstance(publish, Publisher):
+        publish_errors = publish.publish_many(parsers_msgs)
+    else:
+        publish_errors = []
+        for parsers_msg in parsers_msgs:
+            try:
+                publish(parsers_msg)
+                publish_errors.append(None)
+            except Exception as error:
+                publish_errors.append(error)
+    for i, error in zip(handled, publish_errors):
+        if error is not None:
+            logger.error(f'error while publishing snapshot #{i} of batch: {error}')
+            errors[i] = error
+    return errors
+
+
 def run_server(host: str, port: int, publish: callable):
     """
     Run the server with a given publish function.
@@ -78,4 +151,5 @@ def run_server(host: str, port: int, publish: callable):
     client_agent_module = load_client_agent(protocol)
     client_agent = client_agent_module.ClientAgent(publish=publish)
     client_agent.register_snapshot_handler(handle_snapshot)
+    client_agent.register_snapshots_handler(handle_snapshots)
     client_agent.run(host, port)
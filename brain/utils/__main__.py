@@ -0,0 +1,83 @@
+import json
+
+import click
+
+from brain.utils.common import cli_suppress, get_logger, get_url_scheme
+from brain.utils.consts import *
+from .rabbitmq import RabbitMQ
+
+logger = get_logger(__name__)
+
+
+def connect(mq: str) -> RabbitMQ:
+    if get_url_scheme(mq) != MQType.RABBITMQ.value:
+        raise NotImplementedError(f'Unsupported MQ type: {get_url_scheme(mq)}')
+    return RabbitMQ(mq)
+
+
+@click.group()
+@click.option('-m', '--mq', type=click.STRING, default=MQ_URL, help='MQ address.')
+@click.pass_context
+@cli_suppress
+def cli(ctx, mq):
+    """
+    All the commands have the `-m/--mq` flag which refers to the MQ address
+    """
+
+    ctx.ensure_object(dict)
+    ctx.obj['mq'] = mq
+
+
+@cli.command('dead-letters')
+@click.option('-n', '--count', type=click.IntRange(min=1), default=None, help='Maximal number of dead letters.')
+@click.pass_context
+@cli_suppress
+def cli_dead_letters(ctx, count):
+    """
+    Print the dead letters (messages that failed too many times), without removing them.
+    """
+
+    mq = ctx.obj['mq']
+    logger.info(f'running cli dead-letters: {mq=}, {count=}')
+    rabbit = connect(mq)
+    for dead_letter in rabbit.get_dead_letters(count):
+        dead_letter['size'] = len(dead_letter.pop('body'))
+        print(json.dumps(dead_letter))
+    rabbit.close()
+
+
+@cli.command('replay-dead-letters')
+@click.option('-q', '--queue', type=click.STRING, default=None, help='Replay only the dead letters of this queue.')
+@click.option('-n', '--count', type=click.IntRange(min=1), default=None,
+              help='Maximal number of dead letters to replay.')
+@click.pass_context
+@cli_suppress
+def cli_replay_dead_letters(ctx, queue, count):
+    """
+    Publish the dead letters again to the queues they were consumed from.
+    """
+
+    mq = ctx.obj['mq']
+    logger.info(f'running cli replay-dead-letters: {mq=}, {queue=}, {count=}')
+    rabbit = connect(mq)
+    print(f'Replayed {rabbit.replay_dead_letters(queue, count)} dead letters')
+    rabbit.close()
+
+
+@cli.command('purge-dead-letters')
+@click.pass_context
+@cli_suppress
+def cli_purge_dead_letters(ctx):
+    """
+    Delete all the dead letters.
+    """
+
+    mq = ctx.obj['mq']
+    logger.info(f'running cli purge-dead-letters: {mq=}')
+    rabbit = connect(mq)
+    print(f'Deleted {rabbit.purge_dead_letters()} dead letters')
+    rabbit.close()
+
+
+if __name__ == '__main__':
+    cli(prog_name='utils')
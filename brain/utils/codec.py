@@ -0,0 +1,169 @@
+"""
+The codec module encodes and decodes the messages between the parsers and the saver.
+
+A message is encoded by a codec, and optionally compressed, and both are identified by the message properties (the
+content type and the content encoding), so the consumer decodes each message by them. Therefore publishers can switch
+codecs gradually: a consumer handles messages of all the codecs, and messages without a content type are JSON.
+
+The codecs are:
+
+- json: JSON text.
+- binary: a compact binary encoding of the same values (None, booleans, integers, floats, strings, bytes, lists and
+  dictionaries), where numbers are stored in binary form and strings are not escaped.
+"""
+
+import json
+import struct
+import zlib
+
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/x-brain-binary'
+ZLIB_ENCODING = 'zlib'
+CODECS = {'json': JSON_CONTENT_TYPE, 'binary': BINARY_CONTENT_TYPE}
+
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _BYTES, _LIST, _DICT = b'NTFidsblm'
+_DOUBLE = struct.Struct('<d')
+
+
+def _pack_size(size: int, out: bytearray):
+    # unsigned varint: 7 bits per byte, from the least significant ones
+    while size >= 0x80:
+        out.append(size & 0x7f | 0x80)
+        size >>= 7
+    out.append(size)
+
+
+def _pack(obj, out: bytearray):
+    if obj is None:
+        out.append(_NONE)
+    elif obj is True:
+        out.append(_TRUE)
+    elif obj is False:
+        out.append(_FALSE)
+    elif isinstance(obj, int):
+        out.append(_INT)
+        _pack_size(obj << 1 if obj >= 0 else (-obj << 1) - 1, out)  # zigzag, so small negative numbers are short
+    elif isinstance(obj, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        out.append(_STR)
+        _pack_size(len(data), out)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        out.append(_BYTES)
+        _pack_size(len(obj), out)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        out.append(_LIST)
+        _pack_size(len(obj), out)
+        for value in obj:
+            _pack(value, out)
+    elif isinstance(obj, dict):
+        out.append(_DICT)
+        _pack_size(len(obj), out)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f'Object of type {type(obj).__name__} is not supported by the binary codec')
+
+
+def _unpack_size(data: bytes, offset: int) -> tuple:
+    size = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        size |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return size, offset
+        shift += 7
+
+
+def _unpack(data: bytes, offset: int) -> tuple:
+    # return the value at the offset, and the offset after it
+    tag = data[offset]
+    offset += 1
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, offset)[0], offset + _DOUBLE.size
+    size, offset = _unpack_size(data, offset)
+    if tag == _INT:
+        return size >> 1 if not size & 1 else -((size + 1) >> 1), offset
+    if tag == _STR:
+        return str(data[offset:offset + size], 'utf-8'), offset + size
+    if tag == _BYTES:
+        return bytes(data[offset:offset + size]), offset + size
+    if tag == _LIST:
+        values = []
+        for _ in range(size):
+            value, offset = _unpack(data, offset)
+            values.append(value)
+        return values, offset
+    if tag == _DICT:
+        values = {}
+        for _ in range(size):
+            key, offset = _unpack(data, offset)
+            values[key], offset = _unpack(data, offset)
+        return values, offset
+    raise ValueError(f'Invalid binary message: unknown tag {tag!r} at offset {offset - 1}')
+
+
+def encode(obj, codec: str = 'json', compress_threshold: int = None) -> tuple:
+    """
+    Encode a message.
+
+    :param obj: the message (python object).
+    :param codec: the codec name (see `CODECS`).
+    :param compress_threshold: if given, compress messages whose encoding is larger than this size (in bytes).
+    :return: (data, content type, content encoding) tuple, where the content encoding is None if the data is not
+        compressed.
+    :raises: NotImplementedError if the codec is unsupported.
+    """
+
+    if codec not in CODECS:
+        raise NotImplementedError(f'Unsupported codec: {codec}')
+    if codec == 'json':
+        data = json.dumps(obj).encode()
+    else:
+        data = bytearray()
+        _pack(obj, data)
+        data = bytes(data)
+    if compress_threshold is not None and len(data) > compress_threshold:
+        return zlib.compress(data), CODECS[codec], ZLIB_ENCODING
+    return data, CODECS[codec], None
+
+
+def decode(data: bytes, content_type: str = None, content_encoding: str = None):
+    """
+    Decode a message by its content type and content encoding.
+
+    :param data: the encoded message.
+    :param content_type: the content type of the message (JSON if not given).
+    :param content_encoding: the content encoding of the message (not compressed if not given).
+    :return: the message (python object).
+    :raises: NotImplementedError if the content type or the content encoding is unsupported.
+    """
+
+    if content_encoding == ZLIB_ENCODING:
+        data = zlib.decompress(data)
+    elif content_encoding:
+        raise NotImplementedError(f'Unsupported content encoding: {content_encoding}')
+    if not content_type or content_type == JSON_CONTENT_TYPE:
+        return json.loads(data)
+    if content_type == BINARY_CONTENT_TYPE:
+        obj, offset = _unpack(memoryview(data), 0)
+        if offset != len(data):
+            raise ValueError(f'Invalid binary message: {len(data) - offset} extra bytes')
+        return obj
+    raise NotImplementedError(f'Unsupported content type: {content_type}')
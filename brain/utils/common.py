@@ -2,15 +2,19 @@
 Provides some common utilities.
 """
 
+import base64
 import functools
 import gzip
 import logging
+import math
 import pathlib
+import struct
 import sys
 from typing import Union
 
 from furl import furl
 from google.protobuf import json_format
+from google.protobuf.descriptor import FieldDescriptor
 from google.protobuf.message import Message
 
 from brain import log_path
@@ -86,6 +90,12 @@ def get_file_stream_type(file_format):
         return open
     if file_format == FileFormat.GZIP.value:
         return gzip.open
+    if file_format == FileFormat.MMAP.value:
+        from brain.utils.streams import MappedFile
+        return MappedFile
+    if file_format == FileFormat.PGZIP.value:
+        from brain.utils.streams import ParallelGzipFile
+        return ParallelGzipFile
     raise NotImplementedError(f'Unsupported file format: {file_format}')
 
 
@@ -135,3 +145,107 @@ def protobuf2dict(pb_object: Message) -> dict:
 
     return json_format.MessageToDict(pb_object, including_default_value_fields=True,
                                      preserving_proto_field_name=True)
+
+
+_INT64_TYPES = {FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64}
+_FLOAT_TYPES = {FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE}
+_FLOAT32 = struct.Struct('<f')
+
+
+def _round_float32(value: float) -> float:
+    # the value of a float (32 bit) field is rounded to its shortest decimal representation (of at least 6 digits)
+    # that is the same float, as json_format rounds it
+    for precision in range(6, 10):
+        rounded = float(f'{value:.{precision}g}')
+        if _FLOAT32.unpack(_FLOAT32.pack(rounded))[0] == value:
+            return rounded
+    return value
+
+
+def protobuf_field2python(field: FieldDescriptor, value):
+    """
+    Convert a value of a protobuf field to plain python types, exactly as `protobuf2dict` would convert it.
+
+    :param field: the field descriptor.
+    :param value: the field value.
+    :return: the converted value.
+    """
+
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        return [_protobuf_value2python(field, item) for item in value]
+    return _protobuf_value2python(field, value)
+
+
+def _protobuf_value2python(field: FieldDescriptor, value):
+    cpp_type = field.cpp_type
+    if cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        return protobuf2python(value)
+    if cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        enum_value = field.enum_type.values_by_number.get(value)
+        return enum_value.name if enum_value else value
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return base64.b64encode(value).decode('utf-8')
+    if cpp_type in _INT64_TYPES:
+        return str(value)
+    if cpp_type in _FLOAT_TYPES:
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        if math.isnan(value):
+            return 'NaN'
+        if cpp_type == FieldDescriptor.CPPTYPE_FLOAT:
+            return _round_float32(value)
+    return value
+
+
+def protobuf2python(pb_object: Message) -> dict:
+    """
+    Convert protobuf object to a dictionary of plain python types.
+    The result is the same as of `protobuf2dict`, but it is converted directly, without json_format.
+
+    :param pb_object: protobuf object to convert.
+    :return: dictionary representation of the protobuf object.
+    """
+
+    result = {}
+    for field in pb_object.DESCRIPTOR.fields:
+        if field.label != FieldDescriptor.LABEL_REPEATED and \
+                (field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE or field.containing_oneof) and \
+                not pb_object.HasField(field.name):
+            continue  # unset message fields are omitted
+        result[field.name] = protobuf_field2python(field, getattr(pb_object, field.name))
+    return result
+
+
+def pack_messages(messages: list) -> bytes:
+    """
+    Pack several messages into a single length-prefixed sequence (4 bytes of size before each message).
+
+    :param messages: list of messages (bytes).
+    :return: the packed messages.
+    """
+
+    return b''.join(struct.pack('I', len(message)) + message for message in messages)
+
+
+def unpack_messages(data: bytes) -> list:
+    """
+    Unpack a length-prefixed sequence of messages, packed by `pack_messages`.
+
+    :param data: the packed messages.
+    :return: list of messages (bytes).
+    :raises: ValueError if the data is not a valid sequence of messages.
+    """
+
+    messages = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        if offset + 4 > len(view):
+            raise ValueError(f'Invalid messages: expected 4 bytes header at offset {offset}')
+        size, = struct.unpack_from('I', view, offset)
+        offset += 4
+        if offset + size > len(view):
+            raise ValueError(f'Invalid messages: expected {size} bytes message at offset {offset}')
+        messages.append(bytes(view[offset:offset + size]))
+        offset += size
+    return messages
@@ -28,12 +28,16 @@ GUI_FURL = furl(GUI_URL)
 MQ_FURL = furl(MQ_URL)
 
 DB_NAME = 'brain'
-COLLECTION_NAME = 'users_and_snapshots'
+USERS_COLLECTION_NAME = 'users'
+SNAPSHOTS_COLLECTION_NAME = 'snapshots'
+COLLECTION_NAME = 'users_and_snapshots'  # legacy layout, see brain.utils.mongodb
 
 
 class FileFormat(Enum):
     NATIVE = config['formats']['native']
     GZIP = config['formats']['gzip']
+    MMAP = config['formats']['mmap']
+    PGZIP = config['formats']['pgzip']
 
 
 class MessageFormat(Enum):
@@ -46,6 +50,7 @@ class ProtocolType(Enum):
 
 class DBType(Enum):
     MONGODB = config['db_types']['mongodb']
+    SQLITE = config['db_types']['sqlite']
 
 
 class MQType(Enum):
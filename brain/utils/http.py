@@ -1,34 +1,148 @@
 """
 The HTTP module provides interface for HTTP requests, and return-code handling.
+
+Requests are sent by `HTTPClient`, which keeps a pool of keep-alive connections, and retries failed requests.
+The `get` and `post` functions use a shared client.
 """
 
+import random
+import time
+from typing import Union
+
 import requests
+import requests.adapters
+import urllib3.exceptions
 
 from brain.utils.common import get_logger
 
 logger = get_logger(__name__)
 
 
+class HTTPClient:
+    """
+    HTTP client that reuses its connections (keep-alive), and retries failed requests with a jittered exponential
+    backoff. An idempotent request (e.g. GET) is retried on connection errors, timeouts and 5xx return-codes.
+    A non-idempotent request (e.g. POST) is retried only if it was not sent, i.e. if the connection could not be
+    established, as otherwise the server may have handled it already.
+    The client can be shared by multiple threads.
+
+    :param pool_size: maximal number of connections to keep open per host.
+    :param retries: maximal number of retries per request.
+    :param backoff: base delay (in seconds) between retries. The n-th retry waits a random delay between 0 and
+        `backoff * 2 ** n` seconds.
+    :param timeout: timeout (in seconds) for each request, either a single value or (connect, read) tuple.
+    """
+
+    def __init__(self, pool_size: int = 10, retries: int = 3, backoff: float = 0.1,
+                 timeout: Union[float, tuple] = (3.05, 30)):
+        logger.debug(f'initializing http client: {pool_size=}, {retries=}, {backoff=}, {timeout=}')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _wait(self, attempt: int):
+        # full jitter: random delay up to the exponential backoff, so retrying clients do not retry together
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _not_sent(error: Exception) -> bool:
+        # whether the request failed before it was sent, as the connection could not be established
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, requests.ConnectionError) and isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def request(self, method: str, url: str, expect: int = 200, idempotent: bool = None, **kwargs) -> str:
+        """
+        Execute a request, retry if it failed, and check for expected return-code.
+
+        :param method: HTTP method (e.g. 'GET').
+        :param url: request this url.
+        :param expect: expected return-code. An exception will be raised if different code was returned.
+        :param idempotent: whether the request can be sent again after it was (possibly) handled. By default, only
+            GET, HEAD, OPTIONS, PUT and DELETE requests are idempotent.
+        :param kwargs: passed to `requests.Session.request` (e.g. `data`).
+        :return: response text.
+        """
+
+        url = str(url)
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+        logger.debug(f'{method} request: {url=}, {expect=}, {idempotent=}')
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt == self.retries or not (idempotent or self._not_sent(error)):
+                    logger.error(f'{method} {url} failed: {error}')
+                    raise
+                logger.warning(f'{method} {url} failed: {error}, retrying ({attempt + 1}/{self.retries})')
+            else:
+                if response.status_code < 500 or attempt == self.retries or not idempotent:
+                    break
+                logger.warning(f'{method} {url} failed with exit-code {response.status_code}, '
+                               f'retrying ({attempt + 1}/{self.retries})')
+            self._wait(attempt)
+
+        if expect and response.status_code != expect:
+            logger.error(f'{method} {url} failed with exit-code {response.status_code}')
+            raise Exception(f'{method} {url} failed with exit-code {response.status_code}')
+        return response.text
+
+    def get(self, url: str, expect: int = 200) -> str:
+        """
+        Execute GET request, and check for expected return-code.
+
+        :param url: request this url.
+        :param expect: expected return-code. An exception will be raised if different code was returned.
+        :return: response text.
+        """
+
+        return self.request('GET', url, expect=expect)
+
+    def post(self, url: str, data, expect: int = 200, idempotent: bool = False) -> str:
+        """
+        Execute POST request, and check for expected return-code.
+
+        :param url: request this url.
+        :param data: data to send with the POST request.
+        :param expect: expected return-code. An exception will be raised if different code was returned.
+        :param idempotent: whether the request can be retried after it was sent (see `request`).
+        :return: the response text.
+        """
+
+        return self.request('POST', url, expect=expect, idempotent=idempotent, data=data)
+
+    def close(self):
+        """
+        Close all the open connections.
+        """
+
+        self.session.close()
+
+
+default_client = HTTPClient()
+
+
 def get(url: str, expect: int = 200) -> str:
     """
-    Execute GET request, and check for expected return-code.
+    Execute GET request using the shared client, and check for expected return-code.
 
     :param url: request this url.
     :param expect: expected return-code. An exception will be raised if different code was returned.
     :return: response text.
     """
 
-    logger.debug(f'GET request: {url=}, {expect=}')
-    response = requests.get(url)
-    if expect and response.status_code != expect:
-        logger.error(f'GET {url} failed with exit-code {response.status_code}')
-        raise Exception(f'GET {url} failed with exit-code {response.status_code}')
-    return response.text
+    return default_client.get(url, expect=expect)
 
 
 def post(url, data, expect=200):
     """
-    Execute POST request, and check for expected return-code.
+    Execute POST request using the shared client, and check for expected return-code.
 
     :param url: request this url.
     :param data:  data to send with the POST request.
@@ -36,9 +150,4 @@ def post(url, data, expect=200):
     :return: the response text.
     """
 
-    logger.debug(f'POST request: {url=}, {expect=}')
-    response = requests.post(url, data)
-    if expect and response.status_code != expect:
-        logger.error(f'POST {url} failed with exit-code {response.status_code}')
-        raise Exception(f'POST {url} failed with exit-code {response.status_code}')
-    return response.text
+    return default_client.post(url, data, expect=expect)
@@ -1,19 +1,34 @@
 """
 The MongoDB module provides a common interface for a MongoDB connection and operations.
+
+The data is stored in two collections:
+
+- users: an entry per user, with its details, keyed by the user id.
+- snapshots: an entry per snapshot, with its details and available results, keyed by the user id and the snapshot
+  id (uuid).
+
+Older versions stored the snapshots of each user inside the user entry, in a single collection, and
+`migrate_legacy_collection` moves such data to the current layout.
 """
 
 import pymongo
+import pymongo.collection
 import pymongo.database
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from brain.utils.common import get_logger
 from brain.utils.consts import *
 
 logger = get_logger(__name__)
 
+_DUPLICATE_KEY_ERROR = 11000
+
 
 class MongoDB:
     """
-    The Mongodb class first connect to the data, and provides multiple database operations.
+    The Mongodb class first connect to the data, creates the indexes of the collections, and provides their
+    collection objects.
 
     :param url: database address.
     """
@@ -23,26 +38,93 @@ class MongoDB:
         self.url = url
         self.client = pymongo.MongoClient(self.url)
         self.db = self.client[DB_NAME]
-        self.collection = self.db[COLLECTION_NAME]
+        self.users = self.db[USERS_COLLECTION_NAME]
+        self.snapshots = self.db[SNAPSHOTS_COLLECTION_NAME]
+        self.create_indexes()
+
+    def create_indexes(self):
+        """
+        Create the indexes of the collections, if they do not exist.
+        """
+
+        # a snapshot is identified by its user and uuid, and the snapshots of a user are listed by their datetime
+        self.snapshots.create_index([('user_id', ASCENDING), ('uuid', ASCENDING)], unique=True)
+        self.snapshots.create_index([('user_id', ASCENDING), ('datetime', ASCENDING)])
 
-    def find(self, *args, **kwargs):
+    @staticmethod
+    def upsert_one(collection: pymongo.collection.Collection, query: dict, update):
         """
-        Find in database. Args, kwargs and return value are like pymongo.database.Collection.find
+        Update a single entry, or insert it if it does not exist.
+        If a concurrent upsert inserted the same entry first (which fails on a unique index), it is retried, as now it
+        updates the entry.
+
+        :param collection: the collection.
+        :param query: the query of the entry.
+        :param update: the update (document or pipeline).
         """
 
-        return self.collection.find(*args, **kwargs)
+        try:
+            collection.update_one(query, update, upsert=True)
+        except DuplicateKeyError:
+            logger.debug(f'entry was inserted concurrently, retrying: {query=}')
+            collection.update_one(query, update, upsert=True)
 
-    def find_one(self, *args, **kwargs):
+    @staticmethod
+    def bulk_upsert(collection: pymongo.collection.Collection, operations: list):
         """
-        Find a single entry in database. Args, kwargs and return value are like pymongo.database.Collection.find_one.
+        Write several independent upserts in a single round trip (unordered).
+        Upserts that failed because a concurrent upsert inserted the same entry first are retried (see `upsert_one`).
+
+        :param collection: the collection.
+        :param operations: list of pymongo.UpdateOne operations with upsert.
         """
 
-        return self.collection.find_one(*args, **kwargs)
+        while operations:
+            try:
+                collection.bulk_write(operations, ordered=False)
+                return
+            except BulkWriteError as error:
+                errors = error.details['writeErrors']
+                if any(write_error['code'] != _DUPLICATE_KEY_ERROR for write_error in errors):
+                    raise
+                logger.debug(f'entries were inserted concurrently, retrying {len(errors)} upserts')
+                operations = [operations[write_error['index']] for write_error in errors]
 
-    def update_one(self, *args, **kwargs):
+    def migrate_legacy_collection(self, batch_size: int = 100, delete: bool = False) -> int:
         """
-        Updates a single entry in database. Args, kwargs and return value are like
-        pymongo.database.Collection.update_one.
+        Migrate the data of the legacy collection (a single entry per user, that contains its snapshots) to the
+        current layout.
+
+        The migration is online: it can run while the saver saves new results, as it never overwrites them, and it
+        can be stopped and run again, as each user is migrated by idempotent updates.
+
+        :param batch_size: number of users to read from the legacy collection at once.
+        :param delete: delete each legacy user entry once it was migrated.
+        :return: the number of migrated users.
         """
 
-        return self.collection.update_one(*args, **kwargs)
+        legacy = self.db[COLLECTION_NAME]
+        logger.info(f'migrating legacy collection: {legacy.name}, {batch_size=}, {delete=}')
+        count = 0
+        for user_entry in legacy.find({}, batch_size=batch_size):
+            user_id = user_entry['_id']
+            snapshots = user_entry.pop('snapshots', [])
+            user_entry['user_id'] = user_id
+            self.upsert_one(self.users, {'_id': user_id}, {'$setOnInsert': user_entry})
+            # results saved in the current layout are newer than the legacy ones, so they take precedence
+            operations = [UpdateOne(
+                {'user_id': user_id, 'uuid': snapshot['uuid']},
+                [{'$set': {
+                    'datetime': {'$ifNull': ['$datetime', {'$literal': snapshot['datetime']}]},
+                    'results': {'$mergeObjects': [{'$literal': snapshot.get('results', {})},
+                                                  {'$ifNull': ['$results', {}]}]},
+                }}],
+                upsert=True,
+            ) for snapshot in snapshots]
+            self.bulk_upsert(self.snapshots, operations)
+            if delete:
+                legacy.delete_one({'_id': user_id})
+            count += 1
+            logger.debug(f'migrated legacy user entry: {user_id=}, snapshots={len(snapshots)}')
+        logger.info(f'migrated {count} legacy user entries')
+        return count
@@ -2,26 +2,64 @@
 The RabbitMQ module provides an interface for RabbitMQ.
 """
 
+import functools
+import threading
 import time
 
 import pika
 from furl import furl
 
+from brain.utils import codec
 from brain.utils.common import get_logger
 
 logger = get_logger(__name__)
 
+DEAD_LETTERS_QUEUE = 'dead_letters'
+ATTEMPTS_HEADER = 'x-brain-attempts'
+ERROR_HEADER = 'x-brain-error'
+QUEUE_HEADER = 'x-brain-queue'
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 1
+DEFAULT_MAX_RETRY_DELAY = 60
+
+
+class PartialFailure(Exception):
+    """
+    Raised by a consume callback when only a part of the handling of a message failed. The message is retried (see
+    `RabbitMQ`) with the given headers added, e.g. to describe the part that is left, so the retry handles only it.
+
+    :param message: the error message.
+    :param headers: headers to add to the retried message.
+    """
+
+    def __init__(self, message: str, headers: dict):
+        Exception.__init__(self, message)
+        self.headers = headers
+
 
 class RabbitMQ:
     """
     The RabbitMQ class connects to the MQ, and allows consuming and publishing to the MQ.
 
+    A message whose consume callback failed is retried with exponential delay: it is moved to a retry queue of the
+    delay, which returns it to the consumed queue when the delay expires. The number of attempts is tracked in the
+    message headers, and after `max_attempts` failed attempts the message is moved to the dead letters queue, where
+    it can be inspected and replayed.
+
     :param url: address of the MQ.
+    :param max_attempts: maximal number of attempts to consume a message.
+    :param retry_delay: delay (in seconds) before the first retry, doubled on each retry.
+    :param max_retry_delay: maximal delay (in seconds) before a retry.
     """
 
-    def __init__(self, url: str):
-        logger.info(f'initializing RabbitMQ connection: {url=}')
+    def __init__(self, url: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS, retry_delay: float = DEFAULT_RETRY_DELAY,
+                 max_retry_delay: float = DEFAULT_MAX_RETRY_DELAY):
+        logger.info(f'initializing RabbitMQ connection: {url=}, {max_attempts=}, {retry_delay=}, {max_retry_delay=}')
         self.url = url
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._retry_queues = set()
         _url = furl(url)
         host, port = _url.host, _url.port
         self.connection = self.connect(host, port)
@@ -64,7 +102,67 @@ class RabbitMQ:
         self.channel.close()
         self.connection.close()
 
-    def consume(self, callback: callable, exchange: str, queues: list, exchange_type: str = 'fanout'):
+    def _declare(self, exchange: str, queues: list, exchange_type: str, prefetch: int = None):
+        # declare the exchange and the queues, and bind them together
+        if exchange:
+            self.channel.exchange_declare(exchange=exchange, exchange_type=exchange_type)
+        for queue in queues:
+            self.channel.queue_declare(queue=queue)
+            if exchange:
+                self.channel.queue_bind(exchange=exchange, queue=queue)
+        if prefetch:
+            # limit the number of unacknowledged messages delivered to this consumer
+            self.channel.basic_qos(prefetch_count=prefetch)
+
+    def _retry_queue(self, queue: str, delay: float) -> str:
+        # declare a queue that holds messages for `delay` seconds, and then returns them to the consumed queue
+        delay_ms = int(delay * 1000)
+        retry_queue = f'{queue}.retry.{delay_ms}'
+        if retry_queue not in self._retry_queues:
+            self.channel.queue_declare(queue=retry_queue, arguments={
+                'x-message-ttl': delay_ms,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue,
+            })
+            self._retry_queues.add(retry_queue)
+        return retry_queue
+
+    def _reject(self, queue: str, properties: pika.BasicProperties, body: bytes, error: Exception):
+        """
+        Handle a message whose consume callback failed: publish it to a retry queue, or to the dead letters queue if it
+        reached the maximal number of attempts. The message should be acknowledged afterwards.
+
+        :param queue: the consumed queue.
+        :param properties: the message properties.
+        :param body: the message body.
+        :param error: the error of the callback, its headers are added to the message if it is `PartialFailure`.
+        """
+
+        headers = dict(properties.headers or {})
+        if isinstance(error, PartialFailure):
+            headers.update(error.headers)
+        attempts = headers.get(ATTEMPTS_HEADER, 0) + 1
+        headers.update({ATTEMPTS_HEADER: attempts, ERROR_HEADER: str(error)[:1024], QUEUE_HEADER: queue})
+        properties = pika.BasicProperties(content_type=properties.content_type,
+                                          content_encoding=properties.content_encoding, headers=headers)
+        if attempts >= self.max_attempts:
+            logger.error(f'moving message to dead letters: {queue=}, {attempts=}, {error=}')
+            self.channel.queue_declare(queue=DEAD_LETTERS_QUEUE)
+            self.channel.basic_publish('', DEAD_LETTERS_QUEUE, body, properties)
+        else:
+            delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+            logger.error(f'retrying message: {queue=}, {attempts=}, {delay=}, {error=}')
+            self.channel.basic_publish('', self._retry_queue(queue, delay), body, properties)
+
+    @staticmethod
+    def _body(properties: pika.BasicProperties, body: bytes, decode: bool):
+        # the message body, decoded by its content type and content encoding if needed (see `brain.utils.codec`)
+        if decode:
+            return codec.decode(body, properties.content_type, properties.content_encoding)
+        return body
+
+    def consume(self, callback: callable, exchange: str, queues: list, exchange_type: str = 'fanout',
+                prefetch: int = None, decode: bool = False, headers: bool = False):
         """
         Consume the MQ.
 
@@ -72,47 +170,278 @@ class RabbitMQ:
         :param exchange: exchange name (if '' will be ignored).
         :param queues: queues to consume.
         :param exchange_type: currently supported are 'fanout' and 'direct'
+        :param prefetch: if given, maximal number of unacknowledged messages to receive ahead.
+        :param decode: pass the messages decoded by their content type (see `brain.utils.codec`), instead of the raw
+            bodies.
+        :param headers: pass the message headers (a dictionary) to the callback as well, after the body (e.g. the
+            headers of a `PartialFailure` on a retried message).
         """
 
-        logger.info(f'preparing to consuming mq: {callback=}, {exchange=}, {queues=}, {exchange_type=}')
-        if exchange:
-            self.channel.exchange_declare(exchange=exchange, exchange_type=exchange_type)
-        for queue in queues:
-            self.channel.queue_declare(queue=queue)
-            if exchange:
-                self.channel.queue_bind(exchange=exchange, queue=queue)
+        logger.info(f'preparing to consuming mq: {callback=}, {exchange=}, {queues=}, {exchange_type=}, {prefetch=}, '
+                    f'{decode=}, {headers=}')
+        self._declare(exchange, queues, exchange_type, prefetch)
 
-        def wrapper(channel, method, properties, body):
+        def wrapper(queue, channel, method, properties, body):
             try:
+                args = [self._body(properties, body, decode)]
                 if exchange and exchange_type == 'direct':
                     # for direct exchange, pass the queue name as well
-                    res = callback(method.routing_key, body)
-                else:
-                    # for any other type, pass only the body.
-                    res = callback(body)
-                channel.basic_ack(delivery_tag=method.delivery_tag)
+                    args.insert(0, method.routing_key)
+                if headers:
+                    args.append(dict(properties.headers or {}))
+                res = callback(*args)
             except Exception as error:
                 logger.error(f'exception in consume callback: {error}')
-                channel.basic_nack(delivery_tag=method.delivery_tag)
+                self._reject(queue, properties, body, error)
                 res = None
+            channel.basic_ack(delivery_tag=method.delivery_tag)
             return res
 
         for queue in queues:
-            self.channel.basic_consume(queue=queue, auto_ack=False, on_message_callback=wrapper)
+            self.channel.basic_consume(queue=queue, auto_ack=False,
+                                       on_message_callback=functools.partial(wrapper, queue))
+        logger.info(f'starting to consume mq')
+        self.channel.start_consuming()
+
+    def consume_batch(self, callback: callable, exchange: str, queues: list, batch_size: int, timeout: float,
+                      exchange_type: str = 'fanout', prefetch: int = None, decode: bool = False):
+        """
+        Consume the MQ in batches: collect up to `batch_size` messages, or the messages that arrived within `timeout`
+        seconds since the first one, and pass them together to the callback. The messages of a batch are acknowledged
+        together once the callback returns. The callback reports the messages that failed, and only they are retried
+        (see `consume`), so a poison message does not fail the other messages of its batch. If the callback raised an
+        exception, all the messages of the batch are retried.
+
+        :param callback: will be called with the list of the messages of each batch (the bodies, or (queue, body)
+            tuples for direct exchange), and returns a list of the errors of the messages (None for the messages that
+            succeeded), or None if all of them succeeded.
+        :param exchange: exchange name (if '' will be ignored).
+        :param queues: queues to consume.
+        :param batch_size: maximal number of messages in a batch.
+        :param timeout: maximal time (in seconds) to wait for a batch to fill.
+        :param exchange_type: currently supported are 'fanout' and 'direct'
+        :param prefetch: maximal number of unacknowledged messages to receive ahead, at least `batch_size`.
+        :param decode: pass the messages decoded by their content type (see `consume`).
+        """
+
+        prefetch = max(prefetch or 0, batch_size)
+        logger.info(f'preparing to consuming mq in batches: {callback=}, {exchange=}, {queues=}, {batch_size=}, '
+                    f'{timeout=}, {exchange_type=}, {prefetch=}, {decode=}')
+        self._declare(exchange, queues, exchange_type, prefetch)
+        batch = []  # messages of the current batch
+        deliveries = []  # (queue, properties, body) of the messages of the current batch
+        last_tag = None  # delivery tag of the last message in the batch
+        timer = None
+
+        def flush():
+            nonlocal batch, deliveries, last_tag, timer
+            if timer is not None:
+                self.connection.remove_timeout(timer)
+                timer = None
+            if not batch:
+                return
+            messages, messages_deliveries, tag = batch, deliveries, last_tag
+            batch, deliveries, last_tag = [], [], None
+            try:
+                errors = callback(messages) or [None] * len(messages)
+            except Exception as error:
+                logger.error(f'exception in consume callback: {error}')
+                errors = [error] * len(messages)
+            # retry only the messages that failed
+            for (queue, properties, body), error in zip(messages_deliveries, errors):
+                if error is not None:
+                    self._reject(queue, properties, body, error)
+            # acknowledge all the messages up to the last one at once
+            self.channel.basic_ack(delivery_tag=tag, multiple=True)
+
+        def message_of(routing_key, properties, body):
+            message = self._body(properties, body, decode)
+            if exchange and exchange_type == 'direct':
+                # for direct exchange, pass the queue name as well
+                return routing_key, message
+            return message
+
+        def on_timeout():
+            nonlocal timer
+            timer = None
+            flush()
+
+        def wrapper(queue, channel, method, properties, body):
+            nonlocal last_tag, timer
+            try:
+                message = message_of(method.routing_key, properties, body)
+            except Exception as error:
+                # a message that cannot be decoded is retried on its own, and does not fail the batch
+                logger.error(f'exception while decoding message: {error}')
+                self._reject(queue, properties, body, error)
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                return
+            batch.append(message)
+            deliveries.append((queue, properties, body))
+            last_tag = method.delivery_tag
+            if len(batch) >= batch_size:
+                flush()
+            elif timer is None:
+                timer = self.connection.call_later(timeout, on_timeout)
+
+        for queue in queues:
+            self.channel.basic_consume(queue=queue, auto_ack=False,
+                                       on_message_callback=functools.partial(wrapper, queue))
+        logger.info(f'starting to consume mq')
+        self.channel.start_consuming()
+
+    def consume_deferred(self, callback: callable, exchange: str, queues: list, exchange_type: str = 'fanout',
+                         prefetch: int = None, tick: float = None, on_tick: callable = None, decode: bool = False):
+        """
+        Consume the MQ, where the callback acknowledges each message on its own, possibly later (e.g. once it was
+        handled together with messages that arrive afterwards). A message that was not acknowledged is redelivered if
+        the consumer stopped.
+
+        :param callback: will be called when consuming new message, with the message (the body, or (queue, body)
+            tuple for direct exchange), and an `ack` function to call once the message was handled, with the exception
+            if its handling failed (then it is retried, see `consume`). `ack` can be called from any thread, as the
+            acknowledgement is passed to the consuming thread.
+        :param exchange: exchange name (if '' will be ignored).
+        :param queues: queues to consume.
+        :param exchange_type: currently supported are 'fanout' and 'direct'
+        :param prefetch: if given, maximal number of unacknowledged messages to receive ahead.
+        :param tick: interval (in seconds) of calling `on_tick`.
+        :param on_tick: if given, will be called periodically (e.g. to handle messages that waited too long).
+        :param decode: pass the messages decoded by their content type (see `consume`).
+        """
+
+        logger.info(f'preparing to consuming mq with deferred acknowledgements: {callback=}, {exchange=}, {queues=}, '
+                    f'{exchange_type=}, {prefetch=}, {tick=}, {decode=}')
+        self._declare(exchange, queues, exchange_type, prefetch)
+        consuming_thread = threading.current_thread()
+
+        def wrapper(queue, channel, method, properties, body):
+            def acknowledge(error: Exception = None):
+                if error is not None:
+                    self._reject(queue, properties, body, error)
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+
+            def ack(error: Exception = None):
+                # the channel is not thread-safe, so other threads pass the acknowledgement to the consuming thread
+                if threading.current_thread() is consuming_thread:
+                    acknowledge(error)
+                else:
+                    self.connection.add_callback_threadsafe(functools.partial(acknowledge, error))
+
+            try:
+                message = self._body(properties, body, decode)
+                if exchange and exchange_type == 'direct':
+                    message = method.routing_key, message
+                callback(message, ack)
+            except Exception as error:
+                logger.error(f'exception in consume callback: {error}')
+                ack(error)
+
+        def on_timer():
+            try:
+                on_tick()
+            except Exception as error:
+                logger.error(f'exception in consume tick: {error}')
+            self.connection.call_later(tick, on_timer)
+
+        for queue in queues:
+            self.channel.basic_consume(queue=queue, auto_ack=False,
+                                       on_message_callback=functools.partial(wrapper, queue))
+        if on_tick is not None:
+            self.connection.call_later(tick, on_timer)
         logger.info(f'starting to consume mq')
         self.channel.start_consuming()
 
-    def publish(self, data, exchange='', queue=''):
+    def publish(self, data, exchange='', queue='', content_type: str = None, content_encoding: str = None):
         """
         Publish message to the MQ. Either exchange or queue must be provided.
 
         :param data: data to send.
         :param exchange: exchange name to publish data to.
         :param queue: queue to publish data to.
+        :param content_type: if given, the content type of the data (see `brain.utils.codec`).
+        :param content_encoding: if given, the content encoding of the data (see `brain.utils.codec`).
         """
 
         if not exchange and not queue:
             logger.error(f'queue or exchange were not given')
             raise Exception('Queue or exchange were not given')
-        logger.debug(f'publishing to mq: {exchange=}, {queue=}')
-        self.channel.basic_publish(exchange, queue, data)
+        logger.debug(f'publishing to mq: {exchange=}, {queue=}, {content_type=}, {content_encoding=}')
+        properties = None
+        if content_type or content_encoding:
+            properties = pika.BasicProperties(content_type=content_type, content_encoding=content_encoding)
+        self.channel.basic_publish(exchange, queue, data, properties)
+
+    def _get_dead_letters(self):
+        # generate the dead letters, without acknowledging them
+        self.channel.queue_declare(queue=DEAD_LETTERS_QUEUE)
+        while True:
+            method, properties, body = self.channel.basic_get(DEAD_LETTERS_QUEUE, auto_ack=False)
+            if method is None:
+                break
+            yield method, properties, body
+
+    def get_dead_letters(self, count: int = None) -> list:
+        """
+        Inspect the dead letters, and leave them in the dead letters queue.
+
+        :param count: maximal number of dead letters to return (by default, all of them).
+        :return: list of dead letters, each one is a dictionary with its `queue`, `attempts`, `error` and `body`.
+        """
+
+        dead_letters, last_tag = [], None
+        for method, properties, body in self._get_dead_letters():
+            headers = properties.headers or {}
+            dead_letters.append({'queue': headers.get(QUEUE_HEADER), 'attempts': headers.get(ATTEMPTS_HEADER),
+                                 'error': headers.get(ERROR_HEADER), 'body': body})
+            last_tag = method.delivery_tag
+            if count is not None and len(dead_letters) >= count:
+                break
+        if last_tag is not None:
+            # return all the messages to the queue
+            self.channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+        return dead_letters
+
+    def replay_dead_letters(self, queue: str = None, count: int = None) -> int:
+        """
+        Replay dead letters: publish them again to the queues they were consumed from, with a new count of attempts.
+
+        :param queue: if given, replay only the dead letters of this queue.
+        :param count: maximal number of dead letters to replay (by default, all of them).
+        :return: the number of replayed dead letters.
+        """
+
+        replayed, skipped_tag = 0, None
+        for method, properties, body in self._get_dead_letters():
+            headers = dict(properties.headers or {})
+            original_queue = headers.pop(QUEUE_HEADER, None)
+            if not original_queue or (queue and original_queue != queue):
+                skipped_tag = method.delivery_tag  # returned to the queue below
+                continue
+            for header in [ATTEMPTS_HEADER, ERROR_HEADER]:
+                headers.pop(header, None)
+            logger.info(f'replaying dead letter: queue={original_queue}')
+            self.channel.basic_publish('', original_queue, body,
+                                       pika.BasicProperties(content_type=properties.content_type,
+                                                            content_encoding=properties.content_encoding,
+                                                            headers=headers))
+            self.channel.basic_ack(delivery_tag=method.delivery_tag)
+            replayed += 1
+            if count is not None and replayed >= count:
+                break
+        if skipped_tag is not None:
+            # return the skipped messages to the queue
+            self.channel.basic_nack(delivery_tag=skipped_tag, multiple=True, requeue=True)
+        return replayed
+
+    def purge_dead_letters(self) -> int:
+        """
+        Delete all the dead letters.
+
+        :return: the number of deleted dead letters.
+        """
+
+        self.channel.queue_declare(queue=DEAD_LETTERS_QUEUE)
+        frame = self.channel.queue_purge(DEAD_LETTERS_QUEUE)
+        logger.info(f'purged dead letters: count={frame.method.message_count}')
+        return frame.method.message_count
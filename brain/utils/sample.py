@@ -0,0 +1,96 @@
+"""
+The sample module reads the mind format of sample files, used by both the client reader and the server (which reads
+sample files as they stream in).
+
+A sample file is a sequence of messages, each one prefixed by its size (4 bytes): the user (mind_pb2.User), followed
+by the snapshots (mind_pb2.Snapshot).
+"""
+
+import struct
+
+from brain.autogen import mind_pb2
+from brain.utils.common import parse_protobuf
+
+
+class SampleReader:
+    """
+    The sample reader class reads the messages of a sample file in mind format from a file stream.
+
+    The messages are passed to `parse_protobuf` as returned by the file stream, so when the file stream returns
+    memoryview slices (e.g. `brain.utils.streams.MappedFile`), the messages are parsed without being copied.
+
+    :param file_stream: file stream of the sample file.
+    """
+
+    def __init__(self, file_stream):
+        self.file_stream = file_stream
+
+    def _read_msg(self):
+        # read 4 bytes of message size
+        size = self.file_stream.read(4)
+        if not size:
+            return b''
+
+        ln = len(size)
+        if ln != 4:
+            raise ValueError(f'Invalid file format: expected to read 4 bytes header, but only {ln} were read')
+        size, = struct.unpack('I', size)
+
+        # read <size> bytes of the message
+        msg = self.file_stream.read(size)
+        ln = len(msg)
+        if ln < size:
+            raise ValueError(f'Invalid file format: expected to read {size} bytes message, but only {ln} were read')
+
+        return msg
+
+    def read_user(self) -> mind_pb2.User:
+        """
+        Read message from the sample file and parse it as user message.
+
+        :return: the parsed user as mind_pb2.User object.
+        :raises: ValueError for invalid file format.
+        """
+
+        msg = self._read_msg()
+        if not msg:
+            raise ValueError(f'Invalid file format: reached EOF before reading the user')
+
+        user = parse_protobuf(mind_pb2.User(), msg)
+        return user
+
+    def read_snapshot(self) -> mind_pb2.Snapshot:
+        """
+        Read message from the sample file and parse it as snapshot message.
+
+        :return: the parsed snapshot as mind_pb2.Snapshot object.
+        """
+
+        msg = self._read_msg()
+        if not msg:
+            return None
+
+        return parse_protobuf(mind_pb2.Snapshot(), msg)
+
+    def read_raw_snapshot(self) -> bytes:
+        """
+        Read message from the sample file without parsing it.
+
+        :return: the snapshot message, serialized in mind_pb2.Snapshot format.
+        """
+
+        msg = self._read_msg()
+        if not msg:
+            return None
+
+        return msg
+
+    def skip_snapshot(self) -> bool:
+        """
+        Read message from the sample file without parsing it.
+
+        :return: True if a message was read, False if reached EOF.
+        :raises: ValueError for invalid file format.
+        """
+
+        return bool(self._read_msg())
@@ -0,0 +1,83 @@
+"""
+The SQLite module provides a common interface for an embedded SQLite database, so the brain can run without a database
+server (e.g. on a single node, or for local analytics).
+
+The data is stored in three tables:
+
+- users: a row per user, with its details, keyed by the user id.
+- snapshots: a row per snapshot, with its details, keyed by the user id and the snapshot id (uuid), and indexed by the
+  user id and the datetime.
+- results: a row per result of a snapshot, keyed by the user id, the snapshot id, and the result name, where the
+  result is stored in JSON format.
+
+The address of the database is `sqlite://` followed by the path of the database file, e.g. `sqlite:///tmp/brain.db`
+(absolute) or `sqlite://brain.db` (relative).
+"""
+
+import sqlite3
+import threading
+
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT,
+    birthday INTEGER,
+    gender TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    user_id TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL,
+    datetime,
+    PRIMARY KEY (user_id, snapshot_id)
+);
+CREATE INDEX IF NOT EXISTS snapshots_datetime ON snapshots (user_id, datetime);
+CREATE TABLE IF NOT EXISTS results (
+    user_id TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (user_id, snapshot_id, name)
+);
+'''
+
+
+class SQLite:
+    """
+    The SQLite class opens the database, creates its tables and indexes, and provides a connection per thread (as
+    SQLite connections cannot be shared between threads).
+
+    The database is in WAL mode, so readers do not block the writer, and the writers wait for each other for up to
+    `timeout` seconds.
+
+    :param url: database address.
+    :param timeout: maximal time (in seconds) to wait for the database to be unlocked.
+    """
+
+    def __init__(self, url: str, timeout: float = 30):
+        logger.info(f'opening SQLite: {url=}')
+        self.url = url
+        self.path = url.split('://', 1)[1].split('?', 1)[0]
+        self.timeout = timeout
+        self._local = threading.local()
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        The connection of the current thread (opened on first use).
+        """
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            # in WAL mode, committed transactions survive a crash of the process, and are synced on checkpoints
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
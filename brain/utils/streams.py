@@ -0,0 +1,432 @@
+"""
+The streams module provides file stream types, that can be used instead of `open` and `gzip.open` for reading
+sample files. All of them expose the same `read`, `seek`, `tell` and `close` interface as regular file objects.
+"""
+
+import collections
+import concurrent.futures
+import io
+import itertools
+import mmap
+import os
+import queue
+import threading
+import zlib
+
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+
+_GZIP_MAGIC = b'\x1f\x8b\x08'  # gzip magic bytes and deflate compression method
+
+
+class MappedFile:
+    """
+    Read-only file stream backed by a memory map of the whole file.
+
+    Reading does not copy the data: `read` returns `memoryview` slices of the mapped file, which can be passed
+    directly to `parse_protobuf`. The mapped pages are backed by the file itself, so the kernel can drop them at any
+    time, and the memory usage does not grow with the file size.
+
+    :param path: path of the file to map.
+    :param mode: must be 'rb', the file is mapped read-only.
+    """
+
+    def __init__(self, path: str, mode: str = 'rb'):
+        if mode != 'rb':
+            raise ValueError(f'Unsupported mode for mapped file: {mode}')
+        logger.debug(f'mapping file: {path=}')
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            # empty files cannot be mapped, just expose an empty view
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        if self._mmap is not None and hasattr(self._mmap, 'madvise'):
+            # sample files are read from start to end, let the kernel read ahead and drop pages behind us
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        self._view = memoryview(self._mmap if self._mmap is not None else b'')
+        self._size = size
+        self._offset = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, size: int = -1) -> memoryview:
+        """
+        Read up to `size` bytes from the current position (or until EOF if `size` is negative).
+
+        :param size: number of bytes to read.
+        :return: memoryview of the read bytes, without copying them.
+        """
+
+        start = self._offset
+        end = self._size if size is None or size < 0 else min(start + size, self._size)
+        self._offset = end
+        return self._view[start:end]
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """
+        Change the stream position, like `io.IOBase.seek`.
+
+        :param offset: offset relatively to `whence`.
+        :param whence: io.SEEK_SET, io.SEEK_CUR or io.SEEK_END.
+        :return: the new absolute position.
+        """
+
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._offset, io.SEEK_END: self._size}[whence]
+        self._offset = max(0, min(base + offset, self._size))
+        return self._offset
+
+    def tell(self) -> int:
+        """
+        :return: the current stream position.
+        """
+
+        return self._offset
+
+    def close(self):
+        """
+        Close the stream and unmap the file.
+        If some of the returned views are still alive, the mapping will be released when they are garbage collected.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                logger.debug(f'mapped file is still referenced, leaving it to the garbage collector')
+
+
+class StreamReader:
+    """
+    Read-only wrapper of a non-seekable stream, whose `read` might return less bytes than requested before EOF
+    (e.g. a chunked HTTP request body). `read(size)` of the wrapper returns exactly `size` bytes, unless it reached
+    EOF, as expected by the readers.
+
+    :param stream: the wrapped stream.
+    :param prefix: bytes that were already read from the stream, and should be read before the rest of it.
+    """
+
+    def __init__(self, stream, prefix: bytes = b''):
+        self._stream = stream
+        self._prefix = prefix
+        self._position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read `size` bytes (or until EOF if `size` is negative).
+
+        :param size: number of bytes to read.
+        :return: the read bytes, less than `size` bytes only if reached EOF.
+        """
+
+        if size is None or size < 0:
+            data = self._prefix + self._stream.read()
+            self._prefix = b''
+            self._position += len(data)
+            return data
+        parts = [self._prefix[:size]]
+        self._prefix = self._prefix[size:]
+        remaining = size - len(parts[0])
+        while remaining:
+            part = self._stream.read(remaining)
+            if not part:
+                break
+            parts.append(part)
+            remaining -= len(part)
+        data = b''.join(parts)
+        self._position += len(data)
+        return data
+
+    def tell(self) -> int:
+        """
+        :return: number of bytes read so far.
+        """
+
+        return self._position
+
+    def close(self):
+        """
+        Close the stream.
+        """
+
+        self.closed = True
+
+
+def _inflate_member(data: memoryview, position: int, chunk_size: int):
+    # inflate a single gzip member that starts at the given position, feeding the inflater with small pieces so
+    # the inflated chunks stay small. yields the inflated chunks, and returns the position where the member ends.
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip header and trailer
+    size = len(data)
+    while not inflater.eof:
+        if position >= size:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+        piece = data[position:position + chunk_size]
+        position += len(piece)
+        chunk = inflater.decompress(piece)
+        if chunk:
+            yield chunk
+    return position - len(inflater.unused_data)
+
+
+class ParallelGzipFile:
+    """
+    Read-only gzip file stream, that inflates the file ahead of the reader in background threads.
+    zlib releases the GIL while inflating, so the inflation runs concurrently with the reader.
+
+    - Files with multiple gzip members (e.g. written by `pigz`, or concatenated gzip files) are split on the member
+      boundaries into blocks, and the blocks are inflated concurrently by a pool of threads.
+    - Single-member files are inflated by a single background thread into a bounded read-ahead buffer.
+
+    Member boundaries are found by looking for the gzip magic bytes. As the magic might also appear inside the
+    compressed data, a block is used only if it was inflated into complete members, and otherwise its data is
+    inflated serially from the last known member boundary.
+
+    :param path: path of the gzip file.
+    :param mode: must be 'rb'.
+    :param workers: number of threads to inflate blocks (defaults to the number of CPUs).
+    :param block_size: minimal size (in bytes) of compressed data to inflate as a single block.
+    :param read_ahead: maximal number of inflated blocks waiting to be read.
+    """
+
+    chunk_size = 1 << 18  # size of compressed pieces fed to the inflater
+    max_block_ratio = 64  # blocks that inflate to more than block_size * max_block_ratio are inflated serially
+
+    def __init__(self, path: str, mode: str = 'rb', workers: int = None, block_size: int = 1 << 20,
+                 read_ahead: int = None):
+        if mode != 'rb':
+            raise ValueError(f'Unsupported mode for parallel gzip file: {mode}')
+        logger.debug(f'opening parallel gzip file: {path=}, {workers=}, {block_size=}')
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._data = memoryview(self._mmap if self._mmap is not None else b'')
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.read_ahead = read_ahead or 2 * self.workers
+        self._blocks = self._find_blocks()
+        self.closed = False
+        self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _find_blocks(self) -> list:
+        # split the file into blocks of at least block_size bytes, on possible member boundaries
+        size = len(self._data)
+        if not size:
+            return []
+        blocks = []
+        start = 0
+        candidate = self._mmap.find(_GZIP_MAGIC, self.block_size)
+        while candidate != -1:
+            blocks.append((start, candidate))
+            start = candidate
+            candidate = self._mmap.find(_GZIP_MAGIC, start + self.block_size)
+        blocks.append((start, size))
+        return blocks
+
+    def _inflate_block(self, start: int, end: int):
+        # inflate a block of complete gzip members, returns None if the block does not end on a member boundary
+        # (or if it is too big to be kept in memory), in which case it should be inflated serially.
+        data = self._data[:end]
+        limit = self.block_size * self.max_block_ratio
+        chunks, total, position = [], 0, start
+        try:
+            while position < end:
+                members = _inflate_member(data, position, self.chunk_size)
+                while True:
+                    try:
+                        chunk = next(members)
+                    except StopIteration as stop:
+                        position = stop.value
+                        break
+                    chunks.append(chunk)
+                    total += len(chunk)
+                    if total > limit:
+                        return None
+        except (zlib.error, EOFError):
+            return None
+        return b''.join(chunks)
+
+    def _inflate_serial(self, position: int, boundaries: set):
+        # inflate member by member from a known member boundary, until reaching a block boundary (or EOF).
+        # yields the inflated chunks, and returns the position it stopped at.
+        size = len(self._data)
+        while position < size:
+            position = yield from _inflate_member(self._data, position, self.chunk_size)
+            if position in boundaries:
+                break
+        return position
+
+    def _inflate(self):
+        # generate the inflated data of the whole file, in order
+        if len(self._blocks) <= 1:
+            # single block, nothing to parallelize
+            yield from self._inflate_serial(0, set())
+            return
+
+        boundaries = {start for start, _ in self._blocks}
+        blocks = iter(self._blocks)
+        pending = collections.deque()
+        pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        try:
+            def submit():
+                for start, end in itertools.islice(blocks, 1):
+                    pending.append((start, end, pool.submit(self._inflate_block, start, end)))
+
+            for _ in range(self.read_ahead):
+                submit()
+            position = 0  # known member boundary, everything before it was already inflated
+            while pending:
+                start, end, future = pending.popleft()
+                submit()
+                if start < position:
+                    # already inflated serially
+                    future.cancel()
+                    continue
+                data = future.result()
+                if data is None:
+                    # the block does not end on a member boundary, inflate serially until reaching one
+                    position = yield from self._inflate_serial(position, boundaries)
+                    continue
+                yield data
+                position = end
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    def _produce(self, chunks: queue.Queue, stop: threading.Event):
+        # background thread: inflate the file into the chunks queue, ends with None or with the raised exception
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        inflated = self._inflate()
+        try:
+            for chunk in inflated:
+                if not put(chunk):
+                    return
+            put(None)
+        except Exception as error:
+            logger.error(f'error while inflating gzip file: {error}')
+            put(error)
+        finally:
+            inflated.close()
+
+    def _start(self):
+        # start inflating from the beginning of the file
+        self._chunks = queue.Queue(self.read_ahead)
+        self._stop = threading.Event()
+        self._chunk, self._offset = memoryview(b''), 0  # current inflated chunk and read offset in it
+        self._position = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._produce, args=(self._chunks, self._stop), daemon=True)
+        self._thread.start()
+
+    def _halt(self):
+        # stop the background thread
+        self._stop.set()
+        self._thread.join()
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read up to `size` inflated bytes (or until EOF if `size` is negative).
+
+        :param size: number of bytes to read.
+        :return: the read bytes.
+        """
+
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        parts = []
+        remaining = -1 if size is None or size < 0 else size
+        while remaining:
+            if self._offset >= len(self._chunk):
+                # current chunk was fully read, take the next one
+                if self._eof:
+                    break
+                chunk = self._chunks.get()
+                if isinstance(chunk, Exception):
+                    self._eof = True
+                    raise chunk
+                if chunk is None:
+                    self._eof = True
+                    break
+                self._chunk, self._offset = memoryview(chunk), 0
+            end = len(self._chunk) if remaining < 0 else min(len(self._chunk), self._offset + remaining)
+            parts.append(self._chunk[self._offset:end])
+            if remaining > 0:
+                remaining -= end - self._offset
+            self._offset = end
+        data = b''.join(parts)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """
+        Change the stream position in the inflated data. Seeking backwards restarts the inflation.
+
+        :param offset: offset relatively to `whence`.
+        :param whence: io.SEEK_SET or io.SEEK_CUR.
+        :return: the new absolute position.
+        """
+
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise ValueError('Seek from end not supported')
+        if offset < self._position:
+            self._halt()
+            self._start()
+        while self._position < offset:
+            if not self.read(min(offset - self._position, self.block_size)):
+                break
+        return self._position
+
+    def tell(self) -> int:
+        """
+        :return: the current stream position in the inflated data.
+        """
+
+        return self._position
+
+    def close(self):
+        """
+        Close the stream, stop inflating and unmap the file.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        self._halt()
+        self._chunk = memoryview(b'')
+        self._data.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                logger.debug(f'gzip file is still referenced, leaving it to the garbage collector')
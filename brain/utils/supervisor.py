@@ -0,0 +1,105 @@
+"""
+The supervisor module runs a service in several worker processes, restarts workers that crashed, and shuts them down
+gracefully when the supervisor is terminated.
+"""
+
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+
+from brain.utils.common import get_logger
+
+logger = get_logger(__name__)
+
+
+def _run_worker(target: callable, args: tuple, kwargs: dict):
+    # worker process entry point: terminate by raising SystemExit, so the worker can clean up (e.g. close its
+    # connections, which makes the MQ redeliver its unacknowledged messages to the other workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    target(*args, **kwargs)
+
+
+class Supervisor:
+    """
+    The supervisor forks `workers` processes that run `target(*args, **kwargs)`, and keeps them running:
+
+    - A worker that exited (e.g. crashed) is restarted after `restart_delay` seconds.
+    - On SIGTERM or SIGINT (or when `stop` is called), the workers are terminated, and killed if they did not exit
+      within `shutdown_timeout` seconds.
+
+    :param target: the function each worker runs.
+    :param args: positional arguments for the target.
+    :param kwargs: keyword arguments for the target.
+    :param workers: number of worker processes.
+    :param restart_delay: time (in seconds) to wait before restarting a worker that exited.
+    :param shutdown_timeout: time (in seconds) to wait for the workers to exit on shutdown.
+    """
+
+    def __init__(self, target: callable, args: tuple = (), kwargs: dict = None, workers: int = 1,
+                 restart_delay: float = 1, shutdown_timeout: float = 10):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.processes = []
+        self.restarts = 0
+        self._stop = threading.Event()
+
+    def _start_worker(self) -> multiprocessing.Process:
+        process = multiprocessing.Process(target=_run_worker, args=(self.target, self.args, self.kwargs), daemon=True)
+        process.start()
+        logger.info(f'started worker: pid={process.pid}')
+        return process
+
+    def stop(self, *args):
+        """
+        Stop the supervisor and its workers (can be used as a signal handler).
+        """
+
+        logger.info(f'stopping supervisor')
+        self._stop.set()
+
+    def run(self):
+        """
+        Start the workers, and supervise them until stopped.
+        Signal handlers are installed only when running in the main thread.
+        """
+
+        logger.info(f'starting supervisor: target={self.target.__name__}, workers={self.workers}')
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        self.processes = [self._start_worker() for _ in range(self.workers)]
+        exited = {}  # index of exited worker -> time it was noticed
+        try:
+            while not self._stop.wait(0.1):
+                for i, process in enumerate(self.processes):
+                    if process.is_alive():
+                        continue
+                    if i not in exited:
+                        logger.error(f'worker exited: pid={process.pid}, exitcode={process.exitcode}')
+                        exited[i] = time.monotonic()
+                    elif time.monotonic() - exited[i] >= self.restart_delay:
+                        del exited[i]
+                        self.processes[i] = self._start_worker()
+                        self.restarts += 1
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        # terminate the workers gracefully, and kill the ones that did not exit in time
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f'worker did not exit in time, killing it: pid={process.pid}')
+                process.kill()
+                process.join()
+        logger.info(f'all workers exited')
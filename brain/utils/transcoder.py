@@ -0,0 +1,211 @@
+"""
+The transcoder module converts protobuf messages between the formats of the different components (mind,
+client_server and server_parsers) at the wire level, without decoding them.
+
+The formats differ mostly in their field numbers, so a message is converted by scanning its top-level fields,
+rewriting their tags, and splicing the byte ranges of their values together. Large values (such as the images data)
+are never decoded nor converted to python objects, and they are copied only once, when the new message is joined.
+"""
+
+# wire types
+VARINT = 0
+I64 = 1
+LEN = 2
+I32 = 5
+
+_fixed_sizes = {I64: 8, I32: 4}
+
+
+def read_varint(data: memoryview, offset: int) -> tuple:
+    """
+    Read a varint from the data.
+
+    :param data: the data to read from.
+    :param offset: offset of the varint.
+    :return: (value, offset after the varint).
+    :raises: ValueError if the data ended before the end of the varint.
+    """
+
+    value, shift = 0, 0
+    size = len(data)
+    while True:
+        if offset >= size:
+            raise ValueError(f'Invalid message: truncated varint at offset {offset}')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_varint(value: int) -> bytes:
+    """
+    Encode a non-negative integer as a varint.
+
+    :param value: the integer.
+    :return: the encoded varint.
+    """
+
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_tag(field: int, wire_type: int) -> bytes:
+    """
+    Encode the tag of a field.
+
+    :param field: field number.
+    :param wire_type: wire type of the field.
+    :return: the encoded tag.
+    """
+
+    return encode_varint(field << 3 | wire_type)
+
+
+def iter_fields(data):
+    """
+    Scan the top-level fields of a serialized message, without decoding their values.
+
+    :param data: the serialized message.
+    :return: generator of (field number, wire type, value) tuples. The value is a memoryview of the field value,
+        without the length prefix of LEN fields. The value of VARINT fields is the decoded integer.
+    :raises: ValueError for invalid message.
+    """
+
+    data = memoryview(data)
+    size = len(data)
+    offset = 0
+    while offset < size:
+        key, offset = read_varint(data, offset)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == VARINT:
+            value, offset = read_varint(data, offset)
+            yield field, wire_type, value
+            continue
+        if wire_type == LEN:
+            length, offset = read_varint(data, offset)
+        elif wire_type in _fixed_sizes:
+            length = _fixed_sizes[wire_type]
+        else:
+            raise ValueError(f'Invalid message: unsupported wire type {wire_type} of field {field}')
+        if offset + length > size:
+            raise ValueError(f'Invalid message: field {field} exceeds the end of the message')
+        yield field, wire_type, data[offset:offset + length]
+        offset += length
+
+
+def encode_field(field: int, wire_type: int, value) -> list:
+    """
+    Encode a field, as returned by `iter_fields`.
+
+    :param field: field number.
+    :param wire_type: wire type of the field.
+    :param value: the value, as returned by `iter_fields`.
+    :return: list of the encoded parts of the field, to be joined into a message.
+    """
+
+    if wire_type == VARINT:
+        return [encode_tag(field, wire_type) + encode_varint(value)]
+    if wire_type == LEN:
+        return [encode_tag(field, wire_type) + encode_varint(len(value)), value]
+    return [encode_tag(field, wire_type), value]
+
+
+def transcode(data, fields: dict, extract: tuple = (), present: tuple = ()) -> tuple:
+    """
+    Rewrite the top-level fields of a serialized message.
+
+    :param data: the serialized message.
+    :param fields: mapping of the field numbers of the message to their new field numbers. Fields that are not in
+        the mapping are dropped.
+    :param extract: field numbers whose values should be returned instead of being written to the new message.
+    :param present: field numbers of sub-messages that should be present in the new message. The ones that are
+        missing are written empty, as setting their fields one by one would do.
+    :return: (list of the parts of the new message, dict of the extracted fields). Each extracted field is a list
+        of (wire type, value) tuples, one for each occurrence of the field.
+    :raises: ValueError for invalid message.
+    """
+
+    parts, extracted, written = [], {}, set()
+    for field, wire_type, value in iter_fields(data):
+        if field in extract:
+            extracted.setdefault(field, []).append((wire_type, value))
+        elif field in fields:
+            parts.extend(encode_field(fields[field], wire_type, value))
+            written.add(fields[field])
+    for field in present:
+        if field not in written:
+            parts.extend(encode_field(field, LEN, b''))
+    return parts, extracted
+
+
+def join_floats(values: list):
+    """
+    Get the raw little-endian float32 data of a repeated float field (as extracted by `transcode`).
+    proto3 packs repeated floats, so it is usually a single view of the message itself.
+
+    :param values: the extracted (wire type, value) tuples of the field.
+    :return: the float32 data.
+    """
+
+    if len(values) == 1 and values[0][0] == LEN:
+        return values[0][1]
+    # packed and unpacked values of a repeated float field are both the raw floats
+    return b''.join(value for _, value in values)
+
+
+# field numbers of the snapshot in the different formats
+MIND_TO_CLIENT_SNAPSHOT = {1: 1, 2: 3, 3: 4, 4: 5, 5: 6}
+CLIENT_SNAPSHOT_MESSAGES = (3, 4, 5, 6)
+CLIENT_SNAPSHOT_USER = 2
+CLIENT_TO_PARSERS_SNAPSHOT = {1: 2, 2: 4, 3: 5, 6: 8}
+PARSERS_SNAPSHOT_MESSAGES = (4, 5, 8)
+CLIENT_COLOR_IMAGE, CLIENT_DEPTH_IMAGE = 4, 5
+PARSERS_COLOR_IMAGE, PARSERS_DEPTH_IMAGE = 6, 7
+IMAGE_FIELDS, IMAGE_DATA = {1: 1, 2: 2}, 3
+
+
+def mind_to_client_snapshot(user_msg, snapshot_msg) -> bytes:
+    """
+    Transcode a snapshot from a sample file (mind format) into the client_server format.
+
+    :param user_msg: the user of the sample file, serialized in mind_pb2.User format.
+    :param snapshot_msg: the snapshot, serialized in mind_pb2.Snapshot format.
+    :return: the snapshot serialized in client_server_pb2.Snapshot format.
+    :raises: ValueError for invalid message.
+    """
+
+    parts, _ = transcode(snapshot_msg, MIND_TO_CLIENT_SNAPSHOT, present=CLIENT_SNAPSHOT_MESSAGES)
+    # the user message has the same fields in both formats
+    parts.extend(encode_field(CLIENT_SNAPSHOT_USER, LEN, memoryview(user_msg)))
+    return b''.join(parts)
+
+
+def client_to_parsers_snapshot(snapshot_msg) -> tuple:
+    """
+    Transcode a snapshot from the client_server format into the server_parsers format, and extract the images data.
+    The images are written without their data, so their file names should be added by the caller.
+
+    :param snapshot_msg: the snapshot, serialized in client_server_pb2.Snapshot format.
+    :return: (the snapshot serialized in server_parsers_pb2.Snapshot format, color image data or None,
+        depth image float32 data or None). The images data are views of `snapshot_msg`.
+    :raises: ValueError for invalid message.
+    """
+
+    parts, images = transcode(snapshot_msg, CLIENT_TO_PARSERS_SNAPSHOT,
+                              extract=(CLIENT_COLOR_IMAGE, CLIENT_DEPTH_IMAGE), present=PARSERS_SNAPSHOT_MESSAGES)
+    color_data = depth_data = None
+    if CLIENT_COLOR_IMAGE in images:
+        image_parts, data = transcode(images[CLIENT_COLOR_IMAGE][-1][1], IMAGE_FIELDS, extract=(IMAGE_DATA,))
+        parts.extend(encode_field(PARSERS_COLOR_IMAGE, LEN, b''.join(image_parts)))
+        color_data = data[IMAGE_DATA][-1][1] if IMAGE_DATA in data else memoryview(b'')
+    if CLIENT_DEPTH_IMAGE in images:
+        image_parts, data = transcode(images[CLIENT_DEPTH_IMAGE][-1][1], IMAGE_FIELDS, extract=(IMAGE_DATA,))
+        parts.extend(encode_field(PARSERS_DEPTH_IMAGE, LEN, b''.join(image_parts)))
+        depth_data = join_floats(data[IMAGE_DATA]) if IMAGE_DATA in data else memoryview(b'')
+    return b''.join(parts), color_data, depth_data
@@ -0,0 +1,105 @@
+"""
+Benchmark the wire-level transcoder (brain.utils.transcoder) against the field by field copying of the snapshots,
+on snapshots with full HD (1920x1080) color and depth images.
+
+Usage:
+    python scripts/benchmark_transcoder.py [-n ROUNDS]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from brain.autogen import client_server_pb2, mind_pb2, server_parsers_pb2  # noqa: E402
+from brain.client.server_agent.http_server_agent import ServerAgent, copy_protobuf  # noqa: E402
+from brain.utils.transcoder import client_to_parsers_snapshot, mind_to_client_snapshot  # noqa: E402
+
+WIDTH, HEIGHT = 1920, 1080
+
+
+def gen_sample():
+    user = mind_pb2.User(user_id=42, username='Dan Gittik', birthday=699746400, gender=mind_pb2.User.MALE)
+    snapshot = mind_pb2.Snapshot(datetime=1575446887339)
+    snapshot.pose.translation.x, snapshot.pose.translation.y, snapshot.pose.translation.z = 0.48, 0.007, -1.1
+    snapshot.pose.rotation.x, snapshot.pose.rotation.w = -0.1, 0.94
+    snapshot.color_image.width, snapshot.color_image.height = WIDTH, HEIGHT
+    snapshot.color_image.data = os.urandom(WIDTH * HEIGHT * 3)
+    snapshot.depth_image.width, snapshot.depth_image.height = WIDTH, HEIGHT
+    snapshot.depth_image.data[:] = np.random.uniform(0, 10, WIDTH * HEIGHT).astype(np.float32).tolist()
+    snapshot.feelings.hunger, snapshot.feelings.happiness = random.random(), random.random()
+    return user, snapshot
+
+
+def client_copy(user, snapshot_msg):
+    # the previous client path: parse the snapshot, and copy it field by field
+    snapshot = mind_pb2.Snapshot()
+    snapshot.ParseFromString(snapshot_msg)
+    return ServerAgent._construct_snapshot(user, snapshot).SerializeToString()
+
+
+def client_transcode(user, snapshot_msg):
+    return mind_to_client_snapshot(user.SerializeToString(), snapshot_msg)
+
+
+def server_copy(snapshot_msg):
+    # the previous server path: parse the snapshot, copy it field by field, and convert the depth image to an array
+    snapshot = client_server_pb2.Snapshot()
+    snapshot.ParseFromString(snapshot_msg)
+    parsers_snapshot = server_parsers_pb2.Snapshot()
+    copy_protobuf(parsers_snapshot, snapshot, ['datetime'])
+    copy_protobuf(parsers_snapshot.user, snapshot.user, ['user_id', 'username', 'birthday', 'gender'])
+    copy_protobuf(parsers_snapshot.pose.translation, snapshot.pose.translation, ['x', 'y', 'z'])
+    copy_protobuf(parsers_snapshot.pose.rotation, snapshot.pose.rotation, ['x', 'y', 'z', 'w'])
+    copy_protobuf(parsers_snapshot.color_image, snapshot.color_image, ['width', 'height'])
+    copy_protobuf(parsers_snapshot.depth_image, snapshot.depth_image, ['width', 'height'])
+    copy_protobuf(parsers_snapshot.feelings, snapshot.feelings, ['hunger', 'thirst', 'exhaustion', 'happiness'])
+    color_data = snapshot.color_image.data
+    depth_array = np.array(snapshot.depth_image.data).astype(float)
+    return parsers_snapshot, color_data, depth_array
+
+
+def server_transcode(snapshot_msg):
+    parsers_msg, color_data, depth_data = client_to_parsers_snapshot(snapshot_msg)
+    parsers_snapshot = server_parsers_pb2.Snapshot()
+    parsers_snapshot.ParseFromString(parsers_msg)
+    depth_array = np.frombuffer(depth_data, dtype='<f4')
+    return parsers_snapshot, color_data, depth_array
+
+
+def measure(function, *args, rounds):
+    function(*args)  # warm up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(*args)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--rounds', type=int, default=10, help='Number of rounds to run each path.')
+    args = parser.parse_args()
+
+    user, snapshot = gen_sample()
+    snapshot_msg = snapshot.SerializeToString()
+    client_msg = client_transcode(user, snapshot_msg)
+    print(f'snapshot of {WIDTH}x{HEIGHT} images: {len(snapshot_msg) / 2 ** 20:.1f}MB')
+
+    for name, copy_path, transcode_path, path_args in [
+        ('client (mind -> client_server)', client_copy, client_transcode, (user, snapshot_msg)),
+        ('server (client_server -> server_parsers)', server_copy, server_transcode, (client_msg,)),
+    ]:
+        copy_time = measure(copy_path, *path_args, rounds=args.rounds)
+        transcode_time = measure(transcode_path, *path_args, rounds=args.rounds)
+        print(f'{name}:')
+        print(f'    field copy: {copy_time * 1000:8.2f}ms')
+        print(f'    transcoder: {transcode_time * 1000:8.2f}ms ({copy_time / transcode_time:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -28,12 +28,13 @@ def resources_path():
     return _resources_path
 
 
-def write_sample(user, snapshots, path):
-    # given a user and snapshot, write it to sample file in mind.gz format
-    file_path = str(path / 'sample.mind.gz')
+def write_sample(user, snapshots, path, compress=True):
+    # given a user and snapshot, write it to sample file in mind.gz (or native mind) format
+    file_path = str(path / ('sample.mind.gz' if compress else 'sample.mind'))
     user_raw = user.SerializeToString()
     snapshots_raw = [snapshot.SerializeToString() for snapshot in snapshots]
-    with gzip.open(file_path, 'wb') as file:
+    open_file = gzip.open if compress else open
+    with open_file(file_path, 'wb') as file:
         file.write(struct.pack('I', len(user_raw)) + user_raw)
         for snapshot_raw in snapshots_raw:
             file.write(struct.pack('I', len(snapshot_raw)) + snapshot_raw)
@@ -50,6 +51,15 @@ def random_sample(tmp_path):
     return user, snapshots, file_path
 
 
+@pytest.fixture
+def random_native_sample(tmp_path):
+    # generate random sample and write it to file without compression
+    user = gen_user(mind_pb2.User())
+    snapshots = [gen_snapshot_for_client() for _ in range(5)]
+    file_path = write_sample(user, snapshots, tmp_path, compress=False)
+    return user, snapshots, file_path
+
+
 @pytest.fixture(scope='session', autouse=True)
 def run_containers():
     # run required docker containers (mongodb, rabbitmq) before all tests
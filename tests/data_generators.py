@@ -10,6 +10,7 @@ import numpy as np
 from PIL import Image
 
 from brain.autogen import mind_pb2, client_server_pb2, server_parsers_pb2
+from brain.saver.db_agent import sqlite_agent
 from brain.utils.consts import *
 from .utils import normalize_path, align_protobuf, dict_projection
 
@@ -30,7 +31,9 @@ def gen_user(user=None):
     if user:
         user.user_id, user.username, user.birthday, user.gender = user_id, username, birthday, gender
         return user
-    return {'user_id': user_id, 'username': username, 'birthday': birthday, 'gender': gender}
+    # the gender is passed by its name, as in the results of the parsers
+    return {'user_id': user_id, 'username': username, 'birthday': birthday,
+            'gender': mind_pb2.User.Gender.Name(gender)}
 
 
 def gen_pose(pose=None):
@@ -110,7 +113,7 @@ def gen_depth_image_raw(path, depth_image=None):
     # generate random depth image data and save as raw file
     width, height, data = gen_depth_image_base()
     path = normalize_path(path)
-    array = np.array(data).astype(np.float)
+    array = np.array(data, dtype=np.float32)
     np.save(str(path / 'depth_image'), array)
     file_name = 'depth_image.npy'
     if depth_image:
@@ -266,7 +269,32 @@ def gen_db_data(path, num_users, num_snapshots, database=None):
             db_entry['snapshots'].append(snapshot)
         db_data.append(db_entry)
     if database:
-        coll = database[COLLECTION_NAME]
-        coll.insert_many(db_data)
-        return db_data, coll
+        insert_db_data(database, db_data)
+        return db_data, database
     return db_data
+
+
+def insert_db_data(database, db_data):
+    # insert entries of users with their snapshots (as generated by gen_db_data) to the users and snapshots collections
+    users = [{key: value for key, value in entry.items() if key != 'snapshots'} for entry in db_data]
+    snapshots = [{'user_id': entry['user_id'], 'uuid': snapshot['uuid'], 'datetime': snapshot['datetime'],
+                  'results': snapshot['results']} for entry in db_data for snapshot in entry['snapshots']]
+    if users:
+        database[USERS_COLLECTION_NAME].insert_many(users)
+    if snapshots:
+        database[SNAPSHOTS_COLLECTION_NAME].insert_many(snapshots)
+
+
+def insert_sqlite_data(url, db_data):
+    # insert entries of users with their snapshots (as generated by gen_db_data) to a SQLite database
+    agent = sqlite_agent.DBAgent(url)
+    with agent.connection as connection:
+        connection.executemany('INSERT INTO users (user_id, username, birthday, gender) VALUES (?, ?, ?, ?)',
+                               [(entry['user_id'], entry['username'], entry['birthday'], entry['gender'])
+                                for entry in db_data])
+    results = []
+    for entry in db_data:
+        for snapshot in entry['snapshots']:
+            for topic, result in snapshot['results'].items():
+                results.append((topic, entry['user_id'], {}, snapshot['uuid'], snapshot['datetime'], result))
+    agent.save_results(results)
@@ -8,14 +8,27 @@ import brain.api.__main__
 from brain.api.__main__ import cli
 from brain.api.api import app, init_db_agent, run_api_server, common_api_wrapper
 from brain.utils.consts import *
-from .data_generators import gen_db_data
+from .data_generators import gen_db_data, insert_db_data, insert_sqlite_data
 from .utils import run_flask_in_thread, normalize_path
 
 
+@pytest.fixture(scope='module', params=[DBType.MONGODB.value, DBType.SQLITE.value])
+def db_url(request, tmp_path_factory):
+    # the API is tested with each of the databases
+    if request.param == DBType.SQLITE.value:
+        return f'sqlite://{tmp_path_factory.mktemp("sqlite") / "brain.db"}'
+    return DB_URL
+
+
 @pytest.fixture(scope='module')
-def populated_db(database, tmp_path_factory):
+def populated_db(db_url, database, tmp_path_factory):
     path = tmp_path_factory.mktemp('api')
-    return gen_db_data(path, 5, 5, database=database)
+    if db_url == DB_URL:
+        db_data, _ = gen_db_data(path, 5, 5, database=database)
+    else:
+        db_data = gen_db_data(path, 5, 5)
+        insert_sqlite_data(db_url, db_data)
+    return db_data, db_url
 
 
 def api_get_and_compare(url, code=200):
@@ -26,16 +39,16 @@ def api_get_and_compare(url, code=200):
 
 
 def test_get_users(populated_db):
-    db_data, collection = populated_db
-    init_db_agent(DB_URL)
+    db_data, db_url = populated_db
+    init_db_agent(db_url)
     expected = [{'user_id': entry['user_id'], 'username': entry['username']} for entry in db_data]
     res = api_get_and_compare('/users')
     assert res.json == expected
 
 
 def test_get_user(populated_db):
-    db_data, collection = populated_db
-    init_db_agent(DB_URL)
+    db_data, db_url = populated_db
+    init_db_agent(db_url)
     entry = random.choice(db_data)
     user_id = entry['user_id']
     expected = {'user_id': user_id, 'username': entry['username'], 'birthday': entry['birthday'],
@@ -45,18 +58,19 @@ def test_get_user(populated_db):
 
 
 def test_get_snapshots(populated_db):
-    db_data, collection = populated_db
-    init_db_agent(DB_URL)
+    db_data, db_url = populated_db
+    init_db_agent(db_url)
     entry = random.choice(db_data)
     user_id = entry['user_id']
-    expected = [{'uuid': snapshot['uuid'], 'datetime': snapshot['datetime']} for snapshot in entry['snapshots']]
+    expected = [{'uuid': snapshot['uuid'], 'datetime': snapshot['datetime']}
+                for snapshot in sorted(entry['snapshots'], key=lambda snapshot: snapshot['datetime'])]
     res = api_get_and_compare(f'/users/{user_id}/snapshots')
     assert res.json == expected
 
 
 def test_get_snapshot(populated_db):
-    db_data, collection = populated_db
-    init_db_agent(DB_URL)
+    db_data, db_url = populated_db
+    init_db_agent(db_url)
     entry = random.choice(db_data)
     user_id = entry['user_id']
     snapshot = random.choice(entry['snapshots'])
@@ -67,8 +81,8 @@ def test_get_snapshot(populated_db):
 
 
 def test_get_result(populated_db):
-    db_data, collection = populated_db
-    init_db_agent(DB_URL)
+    db_data, db_url = populated_db
+    init_db_agent(db_url)
     entry = random.choice(db_data)
     user_id = entry['user_id']
     snapshot = random.choice(entry['snapshots'])
@@ -79,8 +93,8 @@ def test_get_result(populated_db):
 
 
 def test_get_result_data(populated_db):
-    db_data, collection = populated_db
-    init_db_agent(DB_URL)
+    db_data, db_url = populated_db
+    init_db_agent(db_url)
     entry = random.choice(db_data)
     user_id = entry['user_id']
     snapshot = random.choice(entry['snapshots'])
@@ -98,8 +112,9 @@ def test_get_result_data(populated_db):
 
 
 @pytest.fixture
-def api_server_in_thread():
-    yield from run_flask_in_thread(app, API_URL, lambda: run_api_server(API_HOST, API_PORT, DB_URL))
+def api_server_in_thread(populated_db):
+    db_data, db_url = populated_db
+    yield from run_flask_in_thread(app, API_URL, lambda: run_api_server(API_HOST, API_PORT, db_url))
 
 
 def test_run_api_server(populated_db, api_server_in_thread):
@@ -151,18 +166,23 @@ def test_common_api_wrapper(mock_flask_abort):
 
 
 @pytest.fixture
-def populated_db_no_save(tmp_path):
-    return gen_db_data(tmp_path, 1, 1)
-
-
-def test_get_snapshot_result_data_file_name(database, populated_db_no_save):
-    db_data = populated_db_no_save
-    collection = database[COLLECTION_NAME]
+def populated_db_no_path(db_url, database, tmp_path):
+    # a result without the path of its data file
+    db_data = gen_db_data(tmp_path, 1, 1)
+    db_data[0]['snapshots'][0]['results']['color_image'].pop('path')
+    if db_url == DB_URL:
+        insert_db_data(database, db_data)
+    else:
+        db_url = f'sqlite://{tmp_path / "brain.db"}'
+        insert_sqlite_data(db_url, db_data)
+    return db_data, db_url
+
+
+def test_get_snapshot_result_data_file_name(populated_db_no_path):
+    db_data, db_url = populated_db_no_path
+    init_db_agent(db_url)
     u_entry = db_data[0]
     s_entry = u_entry['snapshots'][0]
-    r_entry = s_entry['results']['color_image']
-    r_entry.pop('path')
-    collection.insert_many(db_data)
     user_id = u_entry['user_id']
     snapshot_id = s_entry['uuid']
     url = f'/users/{user_id}/snapshots/{snapshot_id}/color_image/data'
@@ -170,7 +190,8 @@ def test_get_snapshot_result_data_file_name(database, populated_db_no_save):
 
 
 def test_get_snapshot_result_data_file_path(populated_db):
-    db_data, collection = populated_db
+    db_data, db_url = populated_db
+    init_db_agent(db_url)
     u_entry = db_data[0]
     s_entry = u_entry['snapshots'][0]
     r_entry = s_entry['results']['color_image']
@@ -183,23 +204,32 @@ def test_get_snapshot_result_data_file_path(populated_db):
 
 
 @pytest.fixture
-def partially_populated_db(database):
+def partially_populated_db(db_url, database, tmp_path):
     db_data = [
         {'_id': '1', 'user_id': '1', 'username': 'abc', 'birthday': 123, 'gender': 'MALE', 'snapshots': []},
         {'_id': '2', 'user_id': '2', 'username': 'abc', 'birthday': 123, 'gender': 'MALE',
          'snapshots': [{'_id': '1', 'uuid': '1', 'datetime': 123, 'results': {'feelings': {}}}]}
     ]
-    collection = database[COLLECTION_NAME]
-    backup = list(collection.find({}))
-    collection.drop()
-    collection.insert_many(db_data)
-    yield
-    collection.drop()
-    collection.insert_many(backup)
+    if db_url != DB_URL:
+        db_url = f'sqlite://{tmp_path / "brain.db"}'
+        insert_sqlite_data(db_url, db_data)
+        yield db_url
+        return
+    collections = [database[USERS_COLLECTION_NAME], database[SNAPSHOTS_COLLECTION_NAME]]
+    backups = [list(collection.find({})) for collection in collections]
+    for collection in collections:
+        collection.delete_many({})
+    insert_db_data(database, db_data)
+    yield db_url
+    for collection, backup in zip(collections, backups):
+        collection.delete_many({})
+        if backup:
+            collection.insert_many(backup)
 
 
 def test_user_not_exist(partially_populated_db):
-    init_db_agent(DB_URL)
+    init_db_agent(partially_populated_db)
+    assert api_get_and_compare('/users/1/snapshots').json == []
     api_get_and_compare('/users/3/snapshots', code=404)
     api_get_and_compare('/users/3/snapshots/1', code=404)
     api_get_and_compare('/users/3/snapshots/1/color_image', code=404)
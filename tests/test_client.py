@@ -1,10 +1,14 @@
+import json
+
 import pytest
 from click.testing import CliRunner
 
-import brain.client.server_agent.http_server_agent
+import brain.utils.http
 from brain.autogen import client_server_pb2
-from brain.client import upload_sample
+from brain.client import upload_sample, build_index, import_sample, UploadError
 from brain.client.__main__ import cli
+from brain.client.reader import Reader
+from brain.utils.common import unpack_messages
 from brain.utils.consts import *
 
 
@@ -12,11 +16,11 @@ from brain.utils.consts import *
 def mock_server(monkeypatch):
     calls = []
 
-    def mock_post(url, data):
+    def mock_post(self, url, data, expect=200):
         calls.append((url, data))
         return 200
 
-    monkeypatch.setattr(brain.client.server_agent.http_server_agent, 'post', mock_post)
+    monkeypatch.setattr(brain.utils.http.HTTPClient, 'post', mock_post)
     return calls
 
 
@@ -37,6 +41,150 @@ def test_client(random_sample, mock_server):
         assert str(result.feelings) == str(snapshot.feelings)
 
 
+def test_pipelined_client(random_sample, mock_server):
+    user, snapshots, file_path = random_sample
+    assert upload_sample(SERVER_HOST, SERVER_PORT, file_path, concurrency=3) == len(snapshots)
+    calls = mock_server
+    assert len(calls) == len(snapshots)
+    # snapshots are sent concurrently, so they might arrive in any order
+    datetimes = set()
+    for url, data in calls:
+        result = client_server_pb2.Snapshot()
+        result.ParseFromString(data)
+        assert str(result.user) == str(user)
+        datetimes.add(result.datetime)
+    assert datetimes == {snapshot.datetime for snapshot in snapshots}
+
+
+def test_pipelined_client_errors(random_sample, monkeypatch):
+    user, snapshots, file_path = random_sample
+    failed_datetime = snapshots[2].datetime
+
+    def mock_post(self, url, data, expect=200):
+        result = client_server_pb2.Snapshot()
+        result.ParseFromString(data)
+        if result.datetime == failed_datetime:
+            raise Exception('POST failed')
+
+    monkeypatch.setattr(brain.utils.http.HTTPClient, 'post', mock_post)
+    with pytest.raises(UploadError) as error:
+        upload_sample(SERVER_HOST, SERVER_PORT, file_path, concurrency=2)
+    assert error.value.count == len(snapshots) - 1
+    assert [n for n, _ in error.value.errors] == [2]
+    assert 'POST failed' in str(error.value)
+
+
+def test_batched_client(random_sample, monkeypatch):
+    user, snapshots, file_path = random_sample
+    failed_datetime = snapshots[1].datetime
+    batches = []
+
+    def mock_post(self, url, data, expect=200):
+        # batches are sent to /snapshots, and a single snapshot is sent to /snapshot
+        messages = unpack_messages(data) if str(url).endswith('/snapshots') else [data]
+        batches.append((url, messages))
+        statuses = []
+        for message in messages:
+            result = client_server_pb2.Snapshot()
+            result.ParseFromString(message)
+            assert str(result.user) == str(user)
+            statuses.append({'status': 'error', 'error': 'Invalid snapshot'} if result.datetime == failed_datetime
+                            else {'status': 'ok'})
+        return json.dumps(statuses)
+
+    monkeypatch.setattr(brain.utils.http.HTTPClient, 'post', mock_post)
+    with pytest.raises(UploadError) as error:
+        upload_sample(SERVER_HOST, SERVER_PORT, file_path, batch_size=2)
+    assert error.value.count == len(snapshots) - 1
+    assert [n for n, _ in error.value.errors] == [1]
+    # the last snapshot is left alone in its batch
+    assert [len(messages) for _, messages in batches] == [2, 2, 1]
+
+
+def test_import_sample(random_sample, monkeypatch):
+    user, snapshots, file_path = random_sample
+    calls = []
+
+    def mock_request(self, method, url, expect=200, data=None):
+        calls.append((method, url, b''.join(data)))
+        return json.dumps({'status': 'ok', 'count': len(snapshots)})
+
+    monkeypatch.setattr(brain.utils.http.HTTPClient, 'request', mock_request)
+    assert import_sample(SERVER_HOST, SERVER_PORT, file_path) == len(snapshots)
+    (method, url, data), = calls
+    assert method == 'POST'
+    assert str(url).endswith('/sample')
+    with open(file_path, 'rb') as file:
+        assert data == file.read()
+
+
+def test_mapped_reader(random_native_sample):
+    user, snapshots, file_path = random_native_sample
+    reader = Reader(file_path, FileFormat.MMAP.value, MessageFormat.MIND.value)
+    assert reader.user == user
+    assert list(reader) == snapshots
+    reader.file_stream.close()
+
+
+def test_parallel_gzip_reader(random_sample):
+    user, snapshots, file_path = random_sample
+    reader = Reader(file_path, FileFormat.PGZIP.value, MessageFormat.MIND.value)
+    assert reader.user == user
+    assert list(reader) == snapshots
+
+
+def test_index(random_sample):
+    user, snapshots, file_path = random_sample
+    assert build_index(file_path) == len(snapshots)
+    reader = Reader(file_path, FileFormat.GZIP.value, MessageFormat.MIND.value)
+    assert len(reader.index) == len(snapshots)
+    assert reader[3] == snapshots[3]
+    assert reader[-1] == snapshots[-1]
+    reader.seek(1)
+    assert next(reader) == snapshots[1]
+    assert list(reader[1:3]) == snapshots[1:3]
+    parts = reader.split(3)
+    assert len(parts) == 3
+    assert [snapshot for part in parts for snapshot in part] == snapshots[2:]
+    with pytest.raises(IndexError):
+        reader.seek(len(snapshots) + 1)
+    with pytest.raises(IndexError):
+        reader[len(snapshots)]
+    # seeking to the end of the sample file
+    reader.seek(len(snapshots))
+    assert list(reader) == []
+    reader.close()
+
+
+def test_index_empty_ranges(random_sample):
+    user, snapshots, file_path = random_sample
+    build_index(file_path)
+    reader = Reader(file_path, FileFormat.GZIP.value, MessageFormat.MIND.value)
+    assert list(reader[len(snapshots):]) == []
+    assert list(Reader(file_path, FileFormat.GZIP.value, MessageFormat.MIND.value, start=len(snapshots))) == []
+    # a large snapshot at the end leaves the last range empty
+    reader.index.sizes[-1] = sum(reader.index.sizes) * 10
+    parts = reader.split(len(snapshots) + 2)
+    assert (len(snapshots), len(snapshots)) in [(part.position, part.stop) for part in parts]
+    assert [snapshot for part in parts for snapshot in part] == snapshots
+    reader.close()
+
+
+def test_upload_from_index(random_sample, mock_server):
+    user, snapshots, file_path = random_sample
+    build_index(file_path)
+    assert upload_sample(SERVER_HOST, SERVER_PORT, file_path, start=2) == len(snapshots) - 2
+    assert len(mock_server) == len(snapshots) - 2
+
+
+def test_cli_build_index(random_sample):
+    user, snapshots, file_path = random_sample
+    runner = CliRunner()
+    result = runner.invoke(cli, ['build-index', file_path])
+    assert result.exit_code == 0, result.exception
+    assert f'Successfully indexed {len(snapshots)} snapshots' in result.output
+
+
 def test_cli(resources_path, mock_server):
     sample_path = resources_path / 'tests_sample.mind.gz'
     runner = CliRunner()
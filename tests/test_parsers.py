@@ -1,16 +1,29 @@
+import collections
+import concurrent.futures
 import json
 import os
+import shutil
+import subprocess
+import sys
 
+import numpy as np
 import pytest
+from PIL import Image
 from click.testing import CliRunner
 
 import brain.parsers
 import brain.parsers.mq_agent.rabbitmq_agent
-from brain.parsers import run_parser, invoke_parser
+from brain.parsers import run_parser, run_parser_batch, run_parsers, invoke_parser, invoke_parsers, set_result_cache
+from brain.parsers.cache import ResultCache
 from brain.parsers.__main__ import cli
-from brain.parsers.framework import Context
+from brain import project_path
+from brain.parsers.framework import Context, SnapshotView, _scan_parsers
 from brain.parsers.mq_agent import load_mq_agent
+from brain.parsers.mq_agent.rabbitmq_agent import PARTS_HEADER
+from brain.parsers.parsers.depth_image import COLORMAP, colorize
+from brain.utils import codec
 from brain.utils.consts import *
+from brain.utils.rabbitmq import PartialFailure
 from .data_generators import gen_snapshot_for_parsers, PARSERS
 from .utils import protobuf2dict
 
@@ -42,13 +55,40 @@ def verify_color_image(result, snapshot):
 
 
 def verify_depth_image(result, snapshot):
+    assert result['width'] == snapshot.depth_image.width
+    assert result['height'] == snapshot.depth_image.height
     assert os.path.isfile(result['path'])
+    # the image is not padded
+    with Image.open(result['path']) as image:
+        assert image.size == (result['width'], result['height'])
 
 
 def verify_feelings(result, snapshot):
     assert result == protobuf2dict(snapshot.feelings)
 
 
+def test_parsers_manifest(tmp_path):
+    assert sorted(brain.parsers.get_parsers()) == sorted(PARSERS)
+    module = tmp_path / 'module.py'
+    module.write_text(
+        'def parse_a(data, context):\n    pass\n\n\nparse_a.field = "a"\n\n\n'
+        'def parse_helper(data):\n    pass\n\n\n'
+        'class BParser:\n    field = "b"\n\n    def parse(self, data, context):\n        pass\n\n\n'
+        'class CParser:\n    field = "c"\n'
+    )
+    assert _scan_parsers(module) == {'a': 'parse_a', 'b': 'BParser'}
+
+
+def test_lazy_parsers():
+    # only the parser that is used is imported
+    code = 'import sys; from brain.parsers.framework import get_parser_by_name; ' \
+           'assert "parsers.pose" not in sys.modules; get_parser_by_name("pose"); ' \
+           'print(sorted(name for name in sys.modules if name.startswith("parsers.")), "PIL" in sys.modules)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=project_path, check=True, capture_output=True,
+                            text=True).stdout
+    assert output.splitlines()[-1] == "['parsers.pose'] False"
+
+
 def test_pose(random_snapshot):
     snapshot, data, _ = random_snapshot
     result = run_parser('pose', data)
@@ -70,6 +110,43 @@ def test_depth_image(random_snapshot):
     verify_depth_image(result['result'], snapshot)
 
 
+def test_snapshot_view(random_snapshot):
+    snapshot, data, _ = random_snapshot
+    view = SnapshotView(data)
+    assert view['pose'] == protobuf2dict(snapshot.pose)
+    assert view['uuid'] == str(snapshot.uuid)
+    assert dict(view) == protobuf2dict(snapshot)
+    with pytest.raises(KeyError):
+        view['sound']
+    # unset message fields are omitted
+    snapshot.ClearField('feelings')
+    view = SnapshotView(snapshot.SerializeToString())
+    assert 'feelings' not in view
+    assert dict(view) == protobuf2dict(snapshot)
+
+
+def test_colorize():
+    array = np.array([[0, 1], [2, 4]], dtype=np.float32)
+    colors = colorize(array)
+    assert colors.shape == (2, 2, 3)
+    assert colors.dtype == np.uint8
+    assert colors[0, 0].tolist() == COLORMAP[0].tolist()
+    assert colors[1, 1].tolist() == COLORMAP[-1].tolist()
+    assert colors[1, 0].tolist() == COLORMAP[128].tolist()
+    # constant image
+    assert (colorize(np.ones((3, 3))) == COLORMAP[0]).all()
+    # non-finite values do not affect the range of the finite ones
+    array = np.array([[0, 2, 4], [np.inf, -np.inf, np.nan]], dtype=np.float32)
+    colors = colorize(array)
+    assert colors[0].tolist() == COLORMAP[[0, 128, 255]].tolist()
+    assert colors[1].tolist() == COLORMAP[[255, 0, 0]].tolist()
+    # only infinite values
+    assert (colorize(np.full((2, 2), np.inf)) == COLORMAP[-1]).all()
+    assert (colorize(np.full((2, 2), -np.inf)) == COLORMAP[0]).all()
+    assert colorize(np.array([[np.inf, np.nan]])).tolist() == [COLORMAP[[255, 0]].tolist()]
+    assert colorize(np.array([[np.inf, 1.0]])).tolist() == [COLORMAP[[255, 0]].tolist()]
+
+
 def test_feelings(random_snapshot):
     snapshot, data, _ = random_snapshot
     result = run_parser('feelings', data)
@@ -77,22 +154,154 @@ def test_feelings(random_snapshot):
     verify_feelings(result['result'], snapshot)
 
 
+def verify_parser_result(parser, result, snapshot):
+    if parser == 'pose':
+        verify_pose(result, snapshot)
+    elif parser == 'color_image':
+        verify_color_image(result, snapshot)
+    elif parser == 'depth_image':
+        verify_depth_image(result, snapshot)
+    elif parser == 'feelings':
+        verify_feelings(result, snapshot)
+
+
+@pytest.mark.parametrize('executor_type', [None, concurrent.futures.ThreadPoolExecutor,
+                                           concurrent.futures.ProcessPoolExecutor])
+def test_run_parsers(executor_type, random_snapshot):
+    snapshot, data, _ = random_snapshot
+    if executor_type:
+        with executor_type(max_workers=2) as executor:
+            results, errors = run_parsers(PARSERS, data, executor)
+    else:
+        results, errors = run_parsers(PARSERS, data)
+    assert errors == {}
+    assert set(results) == set(PARSERS)
+    for parser, result in results.items():
+        verify_result_header(result, snapshot)
+        verify_parser_result(parser, result['result'], snapshot)
+
+
+def test_run_parsers_failure(random_snapshot):
+    snapshot, data, _ = random_snapshot
+    os.remove(os.path.join(snapshot.path, snapshot.color_image.file_name))
+    # the other parsers are not affected by the failed one
+    results, errors = run_parsers(PARSERS, data)
+    assert set(results) == set(PARSERS) - {'color_image'}
+    assert set(errors) == {'color_image'}
+
+
+@pytest.fixture
+def result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_entries=2)
+    set_result_cache(cache)
+    yield cache
+    set_result_cache(None)
+
+
+def copy_snapshot(snapshot, path):
+    # the same snapshot content, in another directory
+    copy = type(snapshot)()
+    copy.CopyFrom(snapshot)
+    copy.uuid += 1
+    copy.path = str(path)
+    shutil.copytree(snapshot.path, copy.path)
+    return copy
+
+
+@pytest.mark.parametrize('parser', ['color_image', 'depth_image'])
+def test_result_cache(parser, result_cache, random_snapshot, tmp_path, monkeypatch):
+    snapshot, data, _ = random_snapshot
+    copy = copy_snapshot(snapshot, tmp_path / 'copy')
+    result = run_parser(parser, data)
+    assert (result_cache.hits, result_cache.misses) == (0, 1)
+    # the parser is not called for the same content
+    monkeypatch.setitem(brain.parsers.framework.parsers, parser, None)
+    copy_result = run_parser(parser, copy.SerializeToString())
+    assert (result_cache.hits, result_cache.misses) == (1, 1)
+    assert copy_result['uuid'] == str(copy.uuid)
+    assert copy_result['result']['path'] == os.path.join(copy.path, f'{parser}.jpg')
+    verify_parser_result(parser, copy_result['result'], copy)
+    with open(result['result']['path'], 'rb') as file, open(copy_result['result']['path'], 'rb') as copy_file:
+        assert file.read() == copy_file.read()
+    # the input file is deleted, as the parser does
+    assert not os.path.exists(os.path.join(copy.path, getattr(copy, parser).file_name))
+
+
+def test_result_cache_batch(result_cache, tmp_path):
+    snapshots = [gen_snapshot_for_parsers(tmp_path, should_gen_user=True) for _ in range(2)]
+    items = [snapshot.SerializeToString() for snapshot in snapshots]
+    assert run_parser_batch('pose', items[:1]) == run_parser_batch('pose', items[:1])
+    assert (result_cache.hits, result_cache.misses) == (1, 1)
+    results, _ = run_parser_batch('pose', items)
+    assert (result_cache.hits, result_cache.misses) == (2, 2)
+    for i, snapshot in enumerate(snapshots):
+        verify_pose(results[i]['result'], snapshot)
+
+
+def test_result_cache_eviction(result_cache, tmp_path, monkeypatch):
+    snapshots = [gen_snapshot_for_parsers(tmp_path, should_gen_user=True) for _ in range(3)]
+    for snapshot in snapshots:
+        run_parser('feelings', snapshot.SerializeToString())
+    assert len(os.listdir(result_cache.path)) == 2
+    # the least recently used is evicted
+    run_parser('feelings', snapshots[0].SerializeToString())
+    assert (result_cache.hits, result_cache.misses) == (0, 4)
+    run_parser('feelings', snapshots[2].SerializeToString())
+    assert (result_cache.hits, result_cache.misses) == (1, 4)
+    # a new version of the parser does not use the cached results
+    monkeypatch.setitem(brain.parsers.framework.parser_versions, 'feelings', 1)
+    run_parser('feelings', snapshots[2].SerializeToString())
+    assert (result_cache.hits, result_cache.misses) == (1, 5)
+    # the entries are found by a new cache as well
+    assert len(ResultCache(str(result_cache.path), max_entries=2)._entries) == 2
+
+
 class MockMQAgent:
     snapshot = None
     result = None
+    topic = None
+    published = {}
+    publish_counts = collections.Counter()
+    attempts = []
 
     def __init__(self, url):
         pass
 
-    def consume_snapshots(self, callback, topic):
+    def consume_snapshots(self, callback, topic, prefetch=None):
+        self.__class__.topic = topic
         callback(self.__class__.snapshot)
 
+    def consume_snapshots_parts(self, callback, topic, prefetch=None, max_attempts=3):
+        # retry the snapshot with the failed parts, as the RabbitMQ agent does
+        self.__class__.topic = topic
+        parts = None
+        for _ in range(max_attempts):
+            self.__class__.attempts.append(parts)
+            errors = callback(self.__class__.snapshot, parts)
+            if not errors:
+                break
+            parts = list(errors)
+
+    def consume_snapshots_batch(self, callback, topic, batch_size, timeout, prefetch=None):
+        self.__class__.batch_params = batch_size, timeout, prefetch
+        snapshots = self.__class__.snapshot if isinstance(self.__class__.snapshot, list) else \
+            [self.__class__.snapshot] * batch_size
+        self.__class__.errors = callback(snapshots)
+
     def publish_result(self, result, topic):
         self.__class__.result = result
+        self.__class__.published[topic] = result
+        self.__class__.publish_counts[topic] += 1
+
+    def publish_results(self, results, topic):
+        self.__class__.results = results
 
     @classmethod
     def clear(cls):
-        cls.snapshot = cls.result = None
+        cls.snapshot = cls.result = cls.results = cls.batch_params = cls.topic = cls.errors = None
+        cls.published = {}
+        cls.publish_counts = collections.Counter()
+        cls.attempts = []
 
 
 @pytest.fixture
@@ -119,6 +328,125 @@ def test_invoke_parser(parser, mock_mq_agent, random_snapshot):
         verify_feelings(result, snapshot)
 
 
+@pytest.mark.parametrize('processes', [False, True])
+def test_invoke_parsers(processes, mock_mq_agent, random_snapshot):
+    snapshot, data, _ = random_snapshot
+    MockMQAgent.snapshot = data
+    invoke_parsers(PARSERS, MQ_URL, processes=processes)
+    assert MockMQAgent.topic == ','.join(sorted(PARSERS))
+    assert set(MockMQAgent.published) == set(PARSERS)
+    for parser, result in MockMQAgent.published.items():
+        verify_result_header(result, snapshot)
+        verify_parser_result(parser, result['result'], snapshot)
+
+
+def test_invoke_parsers_failure(mock_mq_agent, random_snapshot):
+    snapshot, data, _ = random_snapshot
+    os.remove(os.path.join(snapshot.path, snapshot.color_image.file_name))
+    MockMQAgent.snapshot = data
+    # the results of the other parsers are published, and then the snapshot is retried only with the failed parser
+    invoke_parsers(PARSERS, MQ_URL)
+    assert set(MockMQAgent.published) == set(PARSERS) - {'color_image'}
+    assert MockMQAgent.attempts == [None, ['color_image'], ['color_image']]
+    assert set(MockMQAgent.publish_counts.values()) == {1}
+
+
+def test_invoke_parsers_retry(mock_mq_agent, random_snapshot, monkeypatch):
+    snapshot, data, _ = random_snapshot
+    MockMQAgent.snapshot = data
+    parse_feelings = brain.parsers.framework.get_parser_by_name('feelings')
+    calls = []
+
+    def flaky_parse_feelings(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise Exception('Temporary failure')
+        return parse_feelings(*args)
+
+    monkeypatch.setitem(brain.parsers.framework.parsers, 'feelings', flaky_parse_feelings)
+    # the image parsers delete their files, so only the failed parser runs again
+    invoke_parsers(PARSERS, MQ_URL)
+    assert MockMQAgent.attempts == [None, ['feelings']]
+    assert MockMQAgent.publish_counts == {parser: 1 for parser in PARSERS}
+    for parser, result in MockMQAgent.published.items():
+        verify_result_header(result, snapshot)
+        verify_parser_result(parser, result['result'], snapshot)
+
+
+@pytest.mark.parametrize('parser', ['pose', 'color_image', 'depth_image', 'feelings'])
+def test_run_parser_batch(parser, tmp_path):
+    # the batch is parsed by parse_batch for pose and feelings, and one by one for the images
+    snapshots = [gen_snapshot_for_parsers(tmp_path, should_gen_user=True) for _ in range(3)]
+    results, errors = run_parser_batch(parser, [snapshot.SerializeToString() for snapshot in snapshots])
+    assert errors == {}
+    assert sorted(results) == list(range(len(snapshots)))
+    for i, snapshot in enumerate(snapshots):
+        result = results[i]
+        verify_result_header(result, snapshot)
+        if parser == 'pose':
+            verify_pose(result['result'], snapshot)
+        elif parser == 'color_image':
+            verify_color_image(result['result'], snapshot)
+        elif parser == 'depth_image':
+            verify_depth_image(result['result'], snapshot)
+        elif parser == 'feelings':
+            verify_feelings(result['result'], snapshot)
+
+
+@pytest.mark.parametrize('parser', ['color_image', 'pose'])
+def test_run_parser_batch_failure(parser, tmp_path, monkeypatch):
+    snapshots = [gen_snapshot_for_parsers(tmp_path, should_gen_user=True) for _ in range(4)]
+    items = [snapshot.SerializeToString() for snapshot in snapshots]
+    items[1] = b'Invalid snapshot'
+    if parser == 'color_image':
+        os.remove(os.path.join(snapshots[2].path, snapshots[2].color_image.file_name))
+    else:
+        # parse_batch fails with the whole batch, so the items are parsed one by one
+        parse_pose = brain.parsers.framework.get_parser_by_name('pose')
+        bad_translation = snapshots[2].pose.translation.x
+        monkeypatch.setitem(brain.parsers.framework.batch_parsers, 'pose', lambda items, contexts: 1 / 0)
+
+        def parse_pose_or_fail(data, ctx):
+            if data['translation']['x'] == bad_translation:
+                raise Exception('Bad pose')
+            return parse_pose(data, ctx)
+
+        monkeypatch.setitem(brain.parsers.framework.parsers, 'pose', parse_pose_or_fail)
+    # only the bad items fail
+    results, errors = run_parser_batch(parser, items)
+    assert sorted(errors) == [1, 2]
+    assert sorted(results) == [0, 3]
+    for i in results:
+        verify_result_header(results[i], snapshots[i])
+        verify_parser_result(parser, results[i]['result'], snapshots[i])
+
+
+def test_invoke_parser_batch_failure(mock_mq_agent, tmp_path):
+    # a batch of an image parser, which deletes the files of the items it parsed
+    snapshots = [gen_snapshot_for_parsers(tmp_path, should_gen_user=True) for _ in range(3)]
+    os.remove(os.path.join(snapshots[1].path, snapshots[1].color_image.file_name))
+    MockMQAgent.snapshot = [snapshot.SerializeToString() for snapshot in snapshots]
+    invoke_parser('color_image', MQ_URL, batch_size=3)
+    # the results of the good items are published, and only the bad item is retried
+    assert len(MockMQAgent.results) == 2
+    for result, snapshot in zip(MockMQAgent.results, [snapshots[0], snapshots[2]]):
+        verify_result_header(result, snapshot)
+        verify_color_image(result['result'], snapshot)
+    assert [error is None for error in MockMQAgent.errors] == [True, False, True]
+    assert isinstance(MockMQAgent.errors[1], FileNotFoundError)
+
+
+def test_invoke_parser_batch(mock_mq_agent, random_snapshot):
+    snapshot, data, _ = random_snapshot
+    MockMQAgent.snapshot = data
+    invoke_parser('pose', MQ_URL, batch_size=4, batch_timeout=0.05, prefetch=8)
+    assert MockMQAgent.batch_params == (4, 0.05, 8)
+    assert len(MockMQAgent.results) == 4
+    for result in MockMQAgent.results:
+        verify_result_header(result, snapshot)
+        verify_pose(result['result'], snapshot)
+
+
 @pytest.fixture
 def mock_rabbitmq(monkeypatch):
     def expected_callback(data):
@@ -127,21 +455,25 @@ def mock_rabbitmq(monkeypatch):
     expected_data = {'abc': 'def'}
 
     class MockRabbitMQ:
+        published = []
+
         def __init__(self, url):
-            assert url == MQ_URL
+            assert url.startswith(MQ_URL)
 
-        def consume(self, callback, exchange, queues, exchange_type='fanout'):
+        def consume(self, callback, exchange, queues, exchange_type='fanout', prefetch=None):
             assert callback == expected_callback
             assert exchange == 'snapshot'
             assert queues == ['pose']
 
-        def publish(self, data, exchange='', queue=''):
-            assert json.loads(data) == expected_data
+        def publish(self, data, exchange='', queue='', content_type=None, content_encoding=None):
+            assert codec.decode(data, content_type, content_encoding) == expected_data
             assert exchange == 'saver'
             assert queue == 'saver_pose'
+            MockRabbitMQ.published.append((content_type, content_encoding))
 
     monkeypatch.setattr(brain.parsers.mq_agent.rabbitmq_agent, 'RabbitMQ', MockRabbitMQ)
     yield expected_callback, expected_data
+    MockRabbitMQ.published.clear()
 
 
 def test_context(tmp_path):
@@ -164,13 +496,52 @@ def test_mq_agent(mock_rabbitmq):
     mq_agent = mq_agent_module.MQAgent(MQ_URL)
     mq_agent.consume_snapshots(expected_callback, 'pose')
     mq_agent.publish_result(expected_data, 'pose')
+    assert brain.parsers.mq_agent.rabbitmq_agent.RabbitMQ.published == [(codec.JSON_CONTENT_TYPE, None)]
+
+
+def test_mq_agent_parts(monkeypatch):
+    class MockRabbitMQ:
+        def __init__(self, url):
+            pass
+
+        def consume(self, callback, exchange, queues, prefetch=None, headers=False):
+            assert headers
+            with pytest.raises(PartialFailure) as error:
+                callback(b'snapshot', {})
+            assert error.value.headers == {PARTS_HEADER: 'color_image,pose'}
+            callback(b'snapshot', error.value.headers)
+
+    def callback(data, parts):
+        calls.append(parts)
+        return {} if parts else {'color_image': FileNotFoundError(), 'pose': Exception()}
+
+    calls = []
+    monkeypatch.setattr(brain.parsers.mq_agent.rabbitmq_agent, 'RabbitMQ', MockRabbitMQ)
+    load_mq_agent('rabbitmq').MQAgent(MQ_URL).consume_snapshots_parts(callback, 'color_image,pose')
+    assert calls == [None, ['color_image', 'pose']]
+
+
+@pytest.mark.parametrize('args, expected', [
+    ('?codec=json', (codec.JSON_CONTENT_TYPE, None)),
+    ('?codec=binary', (codec.BINARY_CONTENT_TYPE, None)),
+    ('?codec=binary&compress=0', (codec.BINARY_CONTENT_TYPE, codec.ZLIB_ENCODING)),
+    ('?codec=binary&compress=1024', (codec.BINARY_CONTENT_TYPE, None)),
+])
+def test_mq_agent_codec(mock_rabbitmq, args, expected):
+    expected_callback, expected_data = mock_rabbitmq
+    mq_agent = load_mq_agent('rabbitmq').MQAgent(MQ_URL + args)
+    mq_agent.publish_result(expected_data, 'pose')
+    assert brain.parsers.mq_agent.rabbitmq_agent.RabbitMQ.published == [expected]
+    with pytest.raises(NotImplementedError):
+        load_mq_agent('rabbitmq').MQAgent(MQ_URL + '?codec=xml')
 
 
 @pytest.fixture
 def mock_invoke_parser(monkeypatch):
-    def fake_invoke_parser(parser, mq_url):
+    def fake_invoke_parser(parser, mq_url, batch_size, batch_timeout, prefetch):
         assert parser == 'pose'
         assert mq_url == MQ_URL
+        assert (batch_size, batch_timeout, prefetch) == (1, 0.1, None)
 
     monkeypatch.setattr(brain.parsers.__main__, 'invoke_parser', fake_invoke_parser)
 
@@ -194,3 +565,36 @@ def test_cli(random_snapshot, mock_invoke_parser):
 
     res = runner.invoke(cli, ['run-parser', 'pose', MQ_URL])
     assert res.exit_code == 0, res.exception
+
+
+def test_cli_workers(monkeypatch):
+    class MockSupervisor:
+        def __init__(self, target, args, kwargs, workers):
+            assert target == brain.parsers.__main__.invoke_parser
+            assert args == ('pose', MQ_URL)
+            assert kwargs == {'batch_size': 1, 'batch_timeout': 0.1, 'prefetch': None}
+            assert workers == 4
+
+        def run(self):
+            MockSupervisor.ran = True
+
+    monkeypatch.setattr(brain.parsers.__main__, 'Supervisor', MockSupervisor)
+    res = CliRunner().invoke(cli, ['run-parser', '-w', '4', 'pose', MQ_URL])
+    assert res.exit_code == 0, res.exception
+    assert MockSupervisor.ran
+
+
+def test_cli_run_parsers(monkeypatch):
+    calls = []
+
+    def fake_invoke_parsers(parsers, mq_url, workers, processes, prefetch):
+        calls.append((parsers, mq_url, workers, processes, prefetch))
+
+    monkeypatch.setattr(brain.parsers.__main__, 'invoke_parsers', fake_invoke_parsers)
+    runner = CliRunner()
+    res = runner.invoke(cli, ['run-parsers', MQ_URL])
+    assert res.exit_code == 0, res.exception
+    res = runner.invoke(cli, ['run-parsers', '-p', 'pose', '-p', 'feelings', '-w', '2', '--processes', MQ_URL])
+    assert res.exit_code == 0, res.exception
+    assert calls == [(brain.parsers.get_parsers(), MQ_URL, None, False, None),
+                     (['pose', 'feelings'], MQ_URL, 2, True, None)]
@@ -1,14 +1,21 @@
+import collections
+import concurrent.futures
 import json
+import random
+import threading
+import time
 
 import pytest
 from click.testing import CliRunner
 
+import brain.api.db_agent.sqlite_agent
 import brain.saver.mq_agent.rabbitmq_agent
 import brain.saver.saver
-from brain.saver import Saver, run_saver
+from brain.saver import Journal, JournalFlusher, JoinBuffer, Saver, SaverPool, run_saver
 from brain.saver.__main__ import cli
+from brain.utils import codec
 from brain.utils.consts import *
-from .data_generators import gen_data_for_saver, PARSERS
+from .data_generators import gen_data_for_saver, gen_db_data, PARSERS
 
 
 @pytest.fixture
@@ -23,24 +30,21 @@ def random_results(tmp_path_factory):
 
 
 def compare_db(database, users_snapshots):
-    collection = database[COLLECTION_NAME]
-    collection_data = collection.find({})
-    collection_data = list(collection_data)
+    users = {user_entry['_id']: user_entry for user_entry in database[USERS_COLLECTION_NAME].find({})}
+    snapshots = list(database[SNAPSHOTS_COLLECTION_NAME].find({}))
     for user_id, items in users_snapshots.items():
-        for user_entry in collection_data:
-            if user_entry['user_id'] == user_id:
-                break
-        else:
-            assert False, f'Could not find user entry with user id {user_id}'
+        assert user_id in users, f'Could not find user entry with user id {user_id}'
+        user_entry = users[user_id]
         expected_user = items['user']
+        assert user_entry['user_id'] == user_id
         assert user_entry['username'] == expected_user['username']
         assert user_entry['birthday'] == expected_user['birthday']
         assert user_entry['gender'] == expected_user['gender']
         expected_snapshots = items['snapshots']
         for snapshot in expected_snapshots:
             uuid = snapshot['uuid']
-            for snapshot_entry in user_entry['snapshots']:
-                if snapshot_entry['uuid'] == uuid:
+            for snapshot_entry in snapshots:
+                if snapshot_entry['user_id'] == user_id and snapshot_entry['uuid'] == uuid:
                     break
             else:
                 assert False, f'Could not find snapshot entry with uuid {uuid}'
@@ -58,19 +62,262 @@ def test_save(saver, database, random_results):
     compare_db(database, users_snapshots)
 
 
+def test_save_batch(saver, database, random_results):
+    results, users_snapshots = random_results
+    items = [(key, json.dumps(value)) for key, value in results]
+    saver.save_batch(items[:3])
+    saver.save_batch(items[3:])
+    compare_db(database, users_snapshots)
+    # saving again does not duplicate the users and the snapshots
+    saver.save_batch(items)
+    compare_db(database, users_snapshots)
+    assert database[USERS_COLLECTION_NAME].count_documents({}) == len(users_snapshots)
+    snapshot_ids = [(entry['user_id'], entry['uuid']) for entry in database[SNAPSHOTS_COLLECTION_NAME].find({})]
+    assert len(snapshot_ids) == len(set(snapshot_ids))
+
+
+def test_save_deleted_user(saver, database, random_results):
+    results, users_snapshots = random_results
+    items = [(key, json.dumps(value)) for key, value in results]
+    saver.save(*items[0])
+    saver.save_batch(items[:1])
+    # a user that was deleted from the database is saved again by the same saver
+    database[USERS_COLLECTION_NAME].delete_many({})
+    saver.save(*items[0])
+    assert database[USERS_COLLECTION_NAME].count_documents({}) == 1
+    database[USERS_COLLECTION_NAME].delete_many({})
+    saver.save_batch(items)
+    compare_db(database, users_snapshots)
+
+
+def test_save_batch_invalid(saver, database, random_results):
+    results, users_snapshots = random_results
+    items = [(key, json.dumps(value)) for key, value in results]
+    # the invalid result is reported, and the others are saved
+    errors = saver.save_batch(items[:1] + [('pose', '{"uuid": "1234"}')] + items[1:])
+    assert errors[0] is None and errors[2:] == [None] * (len(items) - 1)
+    assert isinstance(errors[1], KeyError)
+    compare_db(database, users_snapshots)
+
+
+def test_save_concurrently(database, tmp_path):
+    # results of the same snapshots arrive concurrently from different parsers, for a new user
+    results, users_snapshots = gen_data_for_saver(tmp_path, 1, 20)
+    items = [(key, json.dumps(value)) for key, value in results]
+    random.shuffle(items)
+    savers = [Saver(DB_URL) for _ in range(8)]
+
+    def save(i):
+        # half of the savers save in batches
+        if i % 2:
+            savers[i].save_batch(items[i::len(savers)])
+        else:
+            for key, value in items[i::len(savers)]:
+                savers[i].save(key, value)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(savers)) as executor:
+        list(executor.map(save, range(len(savers))))
+    compare_db(database, users_snapshots)
+    [user_id] = users_snapshots
+    snapshot_entries = list(database[SNAPSHOTS_COLLECTION_NAME].find({'user_id': user_id}))
+    assert len(snapshot_entries) == 20
+    for snapshot_entry in snapshot_entries:
+        assert set(snapshot_entry['results']) == set(PARSERS)
+
+
+def test_save_sqlite(tmp_path, random_results):
+    results, users_snapshots = random_results
+    url = f'sqlite://{tmp_path / "brain.db"}'
+    items = [(key, json.dumps(value)) for key, value in results]
+    saver = Saver(url)
+    saver.save(*items[0])
+    saver.save_batch(items)
+    # saving again (e.g. replaying a journal) does not change the database, and the results are readable by the API
+    saver.save_batch(items)
+    api_agent = brain.api.db_agent.sqlite_agent.DBAgent(url)
+    assert api_agent.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    users = api_agent.find_users()
+    assert sorted(user['user_id'] for user in users) == sorted(users_snapshots)
+    for user_id, items in users_snapshots.items():
+        user = api_agent.find_user(user_id)
+        assert {key: user[key] for key in ['username', 'birthday', 'gender']} == \
+               {key: items['user'][key] for key in ['username', 'birthday', 'gender']}
+        snapshots = api_agent.find_snapshots(user_id)
+        assert len(snapshots) == len(items['snapshots'])
+        for snapshot in items['snapshots']:
+            entry = api_agent.find_snapshot(user_id, snapshot['uuid'])
+            assert entry['datetime'] == snapshot['datetime']
+            assert set(entry['results']) == set(PARSERS)
+            for parser in PARSERS:
+                assert api_agent.find_result(user_id, snapshot['uuid'], parser) == snapshot[parser]
+
+
+def test_migrate(database, saver, tmp_path):
+    # legacy entries of users with their snapshots, where a result was already saved in the current layout
+    db_data = gen_db_data(tmp_path, 2, 3)
+    user_entry = db_data[0]
+    snapshot = user_entry['snapshots'][0]
+    user = {key: value for key, value in user_entry.items() if key not in ('_id', 'snapshots')}
+    newer = {'user': user, 'uuid': snapshot['uuid'], 'datetime': snapshot['datetime'],
+             'result': {'newer': True}}
+    saver.save('feelings', json.dumps(newer))
+    legacy = database[COLLECTION_NAME]
+    legacy.insert_many(db_data)
+    runner = CliRunner()
+    res = runner.invoke(cli, ['migrate', DB_URL, '-b', '1'])
+    assert res.exit_code == 0, res.exception
+    assert 'Migrated 2 users' in res.output
+    # migrating again is idempotent, and deletes the legacy entries
+    res = runner.invoke(cli, ['migrate', DB_URL, '--delete'])
+    assert res.exit_code == 0, res.exception
+    assert legacy.count_documents({}) == 0
+    for user_entry in db_data:
+        user_id = user_entry['user_id']
+        assert database[USERS_COLLECTION_NAME].find_one({'_id': user_id}, {'_id': 0}) == \
+            {key: value for key, value in user_entry.items() if key not in ('_id', 'snapshots')}
+        for snapshot in user_entry['snapshots']:
+            entry = database[SNAPSHOTS_COLLECTION_NAME].find_one({'user_id': user_id, 'uuid': snapshot['uuid']})
+            assert entry['datetime'] == snapshot['datetime']
+            expected = dict(snapshot['results'])
+            if snapshot['uuid'] == newer['uuid'] and user_id == newer['user']['user_id']:
+                expected['feelings'] = newer['result']
+            assert entry['results'] == expected
+
+
+def test_join_buffer(saver, database, random_results):
+    results, users_snapshots = random_results
+    acks = []
+    buffer = JoinBuffer(saver, PARSERS, timeout=60)
+    for key, value in results:
+        buffer.add(key, json.dumps(value), lambda error=None: acks.append(error))
+    # all the snapshots are complete, so they were saved once all their results arrived
+    assert len(buffer) == 0
+    assert (buffer.complete, buffer.partial) == (len(results) // len(PARSERS), 0)
+    assert acks == [None] * len(results)
+    compare_db(database, users_snapshots)
+
+
+def test_join_buffer_partial(saver, database, tmp_path, monkeypatch):
+    results, users_snapshots = gen_data_for_saver(tmp_path, 1, 3)
+    acks = []
+    buffer = JoinBuffer(saver, PARSERS, timeout=60, max_snapshots=2)
+    # the first result of each snapshot: the third snapshot evicts the first one
+    first = {}
+    for key, value in results:
+        first.setdefault(value['uuid'], (key, value))
+    for key, value in first.values():
+        buffer.add(key, json.dumps(value), lambda error=None: acks.append(error))
+    assert (len(buffer), buffer.partial, len(acks)) == (2, 1, 1)
+    buffer.expire()
+    assert len(buffer) == 2
+    buffer.timeout = 0
+    buffer.expire()
+    assert (len(buffer), buffer.partial, acks) == (0, 3, [None] * 3)
+    # a failure to save is passed to the acknowledgements, so the results are retried
+    error = Exception('failed')
+
+    def fail(results):
+        raise error
+
+    monkeypatch.setattr(saver.agent, 'save_results', fail)
+    for key, value in results:
+        buffer.add(key, json.dumps(value), lambda error=None: acks.append(error))
+    buffer.flush()
+    assert acks[3:] == [error] * len(results)
+
+
+def test_journal(tmp_path):
+    results = [('pose', str(i), {'username': 'user'}, str(i), i, {'x': i / 2, 'data': b'\x00'}) for i in range(10)]
+    journal = Journal(tmp_path, segment_size=200, sync=False)
+    journal.append(results[:4])
+    journal.append(results[4:])
+    assert journal.wait(0)
+    records, position = journal.read(6)
+    assert [tuple(record) for record in records] == results[:6]
+    journal.commit(position)
+    journal.close()
+    # after a crash, the records from the checkpoint are read again, and a torn record is ignored
+    segments = sorted(tmp_path.glob('journal-*.log'))
+    with open(segments[-1], 'ab') as writer:
+        writer.write(b'\xff\x00\x00\x00torn')
+    journal = Journal(tmp_path, segment_size=200, sync=False)
+    journal.append(results[:1])
+    records, position = journal.read(100)
+    assert [tuple(record) for record in records] == results[6:] + results[:1]
+    journal.commit(position)
+    assert not journal.wait(0)
+    assert journal.read(100) == ([], position)
+    # the saved segments were deleted
+    assert len(list(tmp_path.glob('journal-*.log'))) == 1
+    journal.close()
+
+
+def test_journal_flusher(saver, database, tmp_path, monkeypatch):
+    results, users_snapshots = gen_data_for_saver(tmp_path, 2, 2)
+    journal = Journal(tmp_path / 'journal', sync=False)
+    # the database fails at first, and the results are saved once it recovers
+    save_results = saver.agent.save_results
+    failures = []
+
+    def flaky_save_results(results):
+        if len(failures) < 2:
+            failures.append(len(results))
+            raise Exception('Database is down')
+        save_results(results)
+
+    monkeypatch.setattr(saver.agent, 'save_results', flaky_save_results)
+    flusher = JournalFlusher(journal, saver, batch_size=5, retry_delay=0.01)
+    flusher.start()
+    for key, value in results:
+        journal.append([saver._load(key, json.dumps(value))])
+    deadline = time.monotonic() + 10
+    while flusher.saved < len(results) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    flusher.stop()
+    assert flusher.saved == len(results)
+    assert len(failures) == 2
+    compare_db(database, users_snapshots)
+    # replaying the journal from the start saves the same results again
+    journal.commit((0, 0))
+    assert JournalFlusher(journal, saver).flush() == len(results)
+    compare_db(database, users_snapshots)
+    journal.close()
+
+
 class MockRabbitMQ:
     results_to_send = []
+    acks = []
 
     def __init__(self, url):
         pass
 
-    def consume(self, callback, exchange, queues, exchange_type='fanout'):
-        for result in self.__class__.results_to_send:
-            queue, msg = result
+    @classmethod
+    def messages(cls, decode):
+        # the messages are (queue, body) or (queue, body, content type, content encoding) tuples
+        assert decode
+        return [(queue, codec.decode(body, *properties)) for queue, body, *properties in cls.results_to_send]
+
+    def consume(self, callback, exchange, queues, exchange_type='fanout', decode=False):
+        for queue, msg in self.messages(decode):
             callback(queue, msg)
 
+    def consume_batch(self, callback, exchange, queues, batch_size, timeout, exchange_type='fanout', decode=False):
+        assert (exchange, exchange_type) == ('saver', 'direct')
+        results = self.messages(decode)
+        for i in range(0, len(results), batch_size):
+            callback(results[i:i + batch_size])
+
+    def consume_deferred(self, callback, exchange, queues, exchange_type='fanout', prefetch=None, tick=None,
+                         on_tick=None, decode=False):
+        assert (exchange, exchange_type) == ('saver', 'direct')
+        for result in self.messages(decode):
+            callback(result, lambda error=None: self.__class__.acks.append(error))
+        if on_tick:
+            on_tick()
+
     @classmethod
     def clear(cls):
+        cls.acks = []
         cls.results_to_send = []
 
 
@@ -88,11 +335,86 @@ def test_run_saver(database, random_results, mock_rabbitmq):
     compare_db(database, snapshots)
 
 
+def test_run_saver_batch(database, random_results, mock_rabbitmq):
+    results, snapshots = random_results
+    MockRabbitMQ.results_to_send = [(f'saver_{item[0]}', json.dumps(item[1])) for item in results]
+    run_saver(DB_URL, MQ_URL, batch_size=5, batch_timeout=0.01)
+    compare_db(database, snapshots)
+
+
+def test_run_saver_codecs(database, random_results, mock_rabbitmq):
+    # during a rollout, results of all the codecs arrive together
+    results, snapshots = random_results
+    encodings = [('json', None), ('binary', None), ('binary', 0), ('json', 0)]
+    MockRabbitMQ.results_to_send = [(f'saver_{item[0]}', *codec.encode(item[1], *encodings[i % len(encodings)]))
+                                    for i, item in enumerate(results)]
+    run_saver(DB_URL, MQ_URL)
+    compare_db(database, snapshots)
+
+
+@pytest.mark.parametrize('batch_size', [1, 5])
+def test_run_saver_journal(database, random_results, mock_rabbitmq, tmp_path, batch_size):
+    results, snapshots = random_results
+    MockRabbitMQ.results_to_send = [(f'saver_{item[0]}', json.dumps(item[1])) for item in results]
+    run_saver(DB_URL, MQ_URL, batch_size=batch_size, journal=str(tmp_path))
+    compare_db(database, snapshots)
+    # all the results were saved from the journal
+    assert Journal(tmp_path).read(100)[0] == []
+
+
+def test_run_saver_join(database, random_results, mock_rabbitmq):
+    results, snapshots = random_results
+    MockRabbitMQ.results_to_send = [(f'saver_{item[0]}', json.dumps(item[1])) for item in results]
+    run_saver(DB_URL, MQ_URL, join_timeout=0.01)
+    assert MockRabbitMQ.acks == [None] * len(results)
+    compare_db(database, snapshots)
+
+
+def test_run_saver_workers(database, random_results, mock_rabbitmq):
+    results, snapshots = random_results
+    MockRabbitMQ.results_to_send = [(f'saver_{item[0]}', json.dumps(item[1])) for item in results]
+    run_saver(DB_URL, MQ_URL, workers=3)
+    assert MockRabbitMQ.acks == [None] * len(results)
+    compare_db(database, snapshots)
+    with pytest.raises(Exception):
+        run_saver(DB_URL, MQ_URL, workers=3, batch_size=5)
+
+
+def test_saver_pool_order(saver, tmp_path, monkeypatch):
+    # the results of a snapshot are saved by the same thread, in the order they were added
+    results, _ = gen_data_for_saver(tmp_path, 2, 5)
+    saved = collections.defaultdict(list)
+
+    def save_result(topic, user_id, user_data, snapshot_id, timestamp, result):
+        time.sleep(random.random() / 100)
+        saved[user_id, snapshot_id].append((topic, threading.current_thread()))
+
+    monkeypatch.setattr(saver.agent, 'save_result', save_result)
+    acks = []
+    pool = SaverPool(saver, workers=4)
+    for key, value in results:
+        pool.add(key, json.dumps(value), acks.append)
+    pool.close()
+    assert acks == [None] * len(results)
+    for key, value in results:
+        snapshot_results = saved[value['user']['user_id'], value['uuid']]
+        assert len({thread for _, thread in snapshot_results}) == 1
+    expected = collections.defaultdict(list)
+    for key, value in results:
+        expected[value['user']['user_id'], value['uuid']].append(key)
+    assert {snapshot: [topic for topic, _ in items] for snapshot, items in saved.items()} == expected
+
+
 @pytest.fixture
 def mock_run_saver(monkeypatch):
-    def fake_run_saver(db, mq):
+    def fake_run_saver(db, mq, batch_size, batch_timeout, join_timeout, join_size, workers, prefetch, journal,
+                       journal_batch):
         assert db == DB_URL
         assert mq == MQ_URL
+        assert (batch_size, batch_timeout) == (1, 0.1)
+        assert (join_timeout, join_size) == (None, 256)
+        assert (workers, prefetch) == (1, None)
+        assert (journal, journal_batch) == (None, 1000)
 
     monkeypatch.setattr(brain.saver.__main__, 'run_saver', fake_run_saver)
 
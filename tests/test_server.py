@@ -1,13 +1,20 @@
+import os
+
+import numpy as np
 import pytest
 from click.testing import CliRunner
 
+import brain.client.server_agent.http_server_agent
+
 import brain.server.__main__
 import brain.server.mq_agent.rabbitmq_agent
 import brain.server.parsers_agent
 import brain.server.server
 from brain.server.__main__ import cli
 from brain.server.client_agent import load_client_agent
-from brain.server.server import construct_publish, handle_snapshot
+from brain.server.parsers_agent import construct_parsers_message
+from brain.server.server import construct_publish, handle_snapshot, handle_snapshots
+from brain.utils.common import pack_messages, protobuf2dict
 from brain.utils.consts import *
 from .data_generators import gen_snapshot_for_server
 
@@ -20,17 +27,25 @@ def client_message():
 
 class MockRabbitMQ:
     publish_params = None
+    publish_count = 0
+    fail_on = ()
 
     def __init__(self, mq_url):
         pass
 
     def publish(self, data, exchange='', queue=''):
+        MockRabbitMQ.publish_count += 1
+        if MockRabbitMQ.publish_count in MockRabbitMQ.fail_on:
+            raise Exception('Connection lost')
         MockRabbitMQ.publish_params = data, exchange, queue
 
 
 @pytest.fixture
 def mock_rabbitmq(monkeypatch):
     monkeypatch.setattr(brain.server.mq_agent.rabbitmq_agent, 'RabbitMQ', MockRabbitMQ)
+    yield
+    MockRabbitMQ.publish_count = 0
+    MockRabbitMQ.fail_on = ()
 
 
 @pytest.fixture
@@ -54,6 +69,91 @@ def test_server(client_message, mock_rabbitmq, mock_path):
     assert queue == ''
 
 
+def test_parsers_message(client_message, mock_path):
+    snapshot, msg = client_message
+    parsers_snapshot = construct_parsers_message(snapshot, 7)
+    assert parsers_snapshot.uuid == 7
+    with open(os.path.join(parsers_snapshot.path, parsers_snapshot.color_image.file_name), 'rb') as file:
+        assert file.read() == snapshot.color_image.data
+    # the depth image is saved as float32, and can be mapped by the parser
+    array = np.load(os.path.join(parsers_snapshot.path, parsers_snapshot.depth_image.file_name), mmap_mode='r')
+    assert array.dtype == np.float32
+    assert array.tolist() == list(snapshot.depth_image.data)
+
+
+def test_server_batch(client_message, mock_rabbitmq, mock_path):
+    snapshot, msg = client_message
+    publish = construct_publish(MQ_URL)
+    client_agent_module = load_client_agent('http')
+    client_agent = client_agent_module.ClientAgent(publish)
+    client_agent.register_snapshots_handler(handle_snapshots)
+    MockRabbitMQ.publish_count = 0
+
+    with client_agent.app.test_client() as client:
+        res = client.post('/snapshots', data=pack_messages([msg, b'invalid snapshot', msg]))
+        assert res.status_code == 200
+        statuses = res.get_json()
+        res = client.post('/snapshots', data=b'\xff\xff')
+        assert res.status_code == 400
+
+    assert [status['status'] for status in statuses] == ['ok', 'error', 'ok']
+    assert MockRabbitMQ.publish_count == 2
+    data, exchange, queue = MockRabbitMQ.publish_params
+    assert exchange == 'snapshot'
+
+
+def test_server_batch_publish_failure(client_message, mock_rabbitmq, mock_path):
+    snapshot, msg = client_message
+    client_agent_module = load_client_agent('http')
+    client_agent = client_agent_module.ClientAgent(construct_publish(MQ_URL))
+    client_agent.register_snapshots_handler(handle_snapshots)
+    MockRabbitMQ.publish_count = 0
+    MockRabbitMQ.fail_on = (2,)
+
+    with client_agent.app.test_client() as client:
+        res = client.post('/snapshots', data=pack_messages([msg] * 3))
+        assert res.status_code == 200
+
+    # only the snapshot that was not published is reported as failed
+    assert [status['status'] for status in res.get_json()] == ['ok', 'error', 'ok']
+    assert MockRabbitMQ.publish_count == 3
+
+
+@pytest.mark.parametrize('sample', ['random_sample', 'random_native_sample'])
+def test_server_sample(sample, request):
+    user, snapshots, file_path = request.getfixturevalue(sample)
+    received = []
+    client_agent_module = load_client_agent('http')
+    client_agent = client_agent_module.ClientAgent(lambda message: None)
+    client_agent.register_snapshot_handler(lambda snapshot, publish: received.append(snapshot))
+
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    with client_agent.app.test_client() as client:
+        res = client.post('/sample', data=data)
+        assert res.status_code == 200
+        assert res.get_json() == {'status': 'ok', 'count': len(snapshots)}
+
+    # the server should construct the same snapshots as the client
+    construct = brain.client.server_agent.http_server_agent.ServerAgent._construct_snapshot
+    assert [protobuf2dict(snapshot) for snapshot in received] == \
+           [protobuf2dict(construct(user, snapshot)) for snapshot in snapshots]
+
+
+def test_server_sample_truncated(random_native_sample):
+    user, snapshots, file_path = random_native_sample
+    client_agent_module = load_client_agent('http')
+    client_agent = client_agent_module.ClientAgent(lambda message: None)
+    client_agent.register_snapshot_handler(lambda snapshot, publish: None)
+
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    with client_agent.app.test_client() as client:
+        res = client.post('/sample', data=data[:-10])
+        assert res.status_code == 400
+        assert res.get_json()['count'] == len(snapshots) - 1
+
+
 class MockMQAgent:
     last_received_data = ''
 
@@ -1,13 +1,33 @@
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import sys
 import threading
 import time
+import types
 
+import click.testing
 import flask
+import numpy as np
 import pika
 import pytest
+import requests
 
+import brain.utils.__main__
+from brain.autogen import client_server_pb2, mind_pb2, server_parsers_pb2
+from brain.utils import codec
+from brain.client.server_agent.http_server_agent import ServerAgent
+from brain.utils.common import protobuf2dict, protobuf2python
 from brain.utils.consts import *
-from brain.utils.http import get, post
-from brain.utils.rabbitmq import RabbitMQ
+from brain.utils.__main__ import cli
+from brain.utils.http import get, post, HTTPClient
+from brain.utils.rabbitmq import PartialFailure, RabbitMQ
+from brain.utils.streams import MappedFile, ParallelGzipFile
+from brain.utils.supervisor import Supervisor
+from brain.utils.transcoder import client_to_parsers_snapshot, mind_to_client_snapshot
+from .data_generators import gen_snapshot_for_client, gen_user
 from .utils import run_in_background, add_shutdown_to_app, shutdown_server, wait_for_address
 
 
@@ -65,6 +85,166 @@ class TestRabbitMQ:
         assert simple_fanout() == msg
         assert simple_fanout() == msg
 
+    @pytest.fixture
+    def batch_consume(self):
+        def wrapper(pipe):
+            pipe.send('ready')
+
+            def callback(messages):
+                pipe.send(messages)
+
+            self.rabbit.consume_batch(callback, '', ['q4'], batch_size=3, timeout=0.5)
+
+        yield from run_in_background(wrapper, poll=2)
+
+    def test_consume_batch(self, batch_consume):
+        messages = [f'Message #{i}'.encode() for i in range(4)]
+        time.sleep(1)
+        for msg in messages:
+            self.rabbit.publish(msg, queue='q4')
+        # a full batch, and then the rest once the timeout expired
+        assert batch_consume() == messages[:3]
+        assert batch_consume() == messages[3:]
+
+    @pytest.fixture
+    def poisoned_batch_consume(self):
+        def wrapper(pipe):
+            rabbit = RabbitMQ(MQ_URL, max_attempts=1)
+            pipe.send('ready')
+
+            def callback(messages):
+                pipe.send(messages)
+                return [Exception('Bad message') if msg == b'Poison message!' else None for msg in messages]
+
+            rabbit.consume_batch(callback, '', ['q8'], batch_size=3, timeout=0.5)
+
+        yield from run_in_background(wrapper, poll=2)
+
+    def test_consume_batch_poison(self, poisoned_batch_consume):
+        self.rabbit.purge_dead_letters()
+        messages = [b'Message #0', b'Poison message!', b'Message #1']
+        time.sleep(1)
+        for msg in messages:
+            self.rabbit.publish(msg, queue='q8')
+        # only the poison message of the batch is retried
+        assert poisoned_batch_consume() == messages
+        with pytest.raises(TimeoutError):
+            poisoned_batch_consume()
+        assert self.rabbit.get_dead_letters() == [{'queue': 'q8', 'attempts': 1, 'error': 'Bad message',
+                                                   'body': b'Poison message!'}]
+        self.rabbit.purge_dead_letters()
+
+    @pytest.fixture
+    def deferred_consume(self):
+        def wrapper(pipe):
+            pipe.send('ready')
+            pending = []
+
+            def callback(data, ack):
+                # acknowledge the messages in pairs, after both of them arrived, from another thread
+                pending.append(ack)
+                if len(pending) == 2:
+                    acks = list(pending)
+                    pending.clear()
+                    threading.Thread(target=lambda: [pending_ack() for pending_ack in acks]).start()
+                    pipe.send(data)
+
+            def on_tick():
+                pipe.send(len(pending))
+
+            self.rabbit.consume_deferred(callback, '', ['q6'], prefetch=2, tick=0.5, on_tick=on_tick)
+
+        yield from run_in_background(wrapper, poll=2)
+
+    def test_consume_deferred(self, deferred_consume):
+        messages = [f'Message #{i}'.encode() for i in range(3)]
+        time.sleep(1)
+        for msg in messages:
+            self.rabbit.publish(msg, queue='q6')
+        assert deferred_consume() == messages[1]
+        # the last message waits for its pair, without blocking the consumer
+        assert deferred_consume() == 1
+
+    @pytest.fixture
+    def decoding_consume(self):
+        def wrapper(pipe):
+            pipe.send('ready')
+
+            def callback(data):
+                pipe.send(data)
+
+            self.rabbit.consume(callback, '', ['q7'], decode=True)
+
+        yield from run_in_background(wrapper, poll=2)
+
+    def test_consume_decode(self, decoding_consume):
+        msg = {'uuid': '1', 'result': [1.5, None]}
+        time.sleep(1)
+        self.rabbit.publish(json.dumps(msg), queue='q7')
+        data, content_type, content_encoding = codec.encode(msg, 'binary', compress_threshold=0)
+        self.rabbit.publish(data, queue='q7', content_type=content_type, content_encoding=content_encoding)
+        assert decoding_consume() == msg
+        assert decoding_consume() == msg
+
+    @pytest.fixture
+    def failing_consume(self):
+        def wrapper(pipe):
+            rabbit = RabbitMQ(MQ_URL, max_attempts=3, retry_delay=0.1)
+            pipe.send('ready')
+
+            def callback(data):
+                pipe.send(data)
+                raise Exception('Bad message')
+
+            rabbit.consume(callback, '', ['q5'])
+
+        yield from run_in_background(wrapper, poll=2)
+
+    def test_dead_letters(self, failing_consume):
+        self.rabbit.purge_dead_letters()
+        msg = b'Poison message!'
+        time.sleep(1)
+        self.rabbit.publish(msg, queue='q5')
+        # retried with delay, and then moved to the dead letters
+        start = time.monotonic()
+        assert [failing_consume() for _ in range(3)] == [msg] * 3
+        assert time.monotonic() - start >= 0.3
+        with pytest.raises(TimeoutError):
+            failing_consume()
+        dead_letters = self.rabbit.get_dead_letters()
+        assert dead_letters == [{'queue': 'q5', 'attempts': 3, 'error': 'Bad message', 'body': msg}]
+        # inspecting the dead letters does not remove them
+        assert self.rabbit.get_dead_letters() == dead_letters
+        assert self.rabbit.replay_dead_letters(queue='q1') == 0
+        assert self.rabbit.replay_dead_letters(queue='q5') == 1
+        assert failing_consume() == msg
+        assert self.rabbit.get_dead_letters() == []
+
+    @pytest.fixture
+    def partially_failing_consume(self):
+        def wrapper(pipe):
+            rabbit = RabbitMQ(MQ_URL, retry_delay=0.1)
+            pipe.send('ready')
+
+            def callback(data, headers):
+                pipe.send((data, headers.get('x-part')))
+                if 'x-part' not in headers:
+                    raise PartialFailure('Bad part', {'x-part': 'second'})
+
+            rabbit.consume(callback, '', ['q9'], headers=True)
+
+        yield from run_in_background(wrapper, poll=2)
+
+    def test_consume_partial_failure(self, partially_failing_consume):
+        msg = b'Message in parts'
+        time.sleep(1)
+        self.rabbit.publish(msg, queue='q9')
+        # the message is retried with the headers of the failure
+        assert partially_failing_consume() == (msg, None)
+        assert partially_failing_consume() == (msg, 'second')
+        with pytest.raises(TimeoutError):
+            partially_failing_consume()
+
     def test_exceptions(self):
         with pytest.raises(pika.connection.exceptions.AMQPError):
             RabbitMQ.connect(MQ_HOST, 1234, max_retries=3)
@@ -79,6 +259,16 @@ def simple_app():
     def default():
         return 'xyz'
 
+    failures = {'count': 0}
+
+    @app.route('/flaky', methods=['GET', 'POST'])
+    def flaky():
+        # fail every other request
+        failures['count'] += 1
+        if failures['count'] % 2:
+            flask.abort(503)
+        return 'xyz'
+
     thr = threading.Thread(target=lambda: app.run(host='127.0.0.1', port=8003))
     thr.start()
     wait_for_address('127.0.0.1', 8003)
@@ -102,3 +292,214 @@ def test_post(simple_app):
     with pytest.raises(Exception) as error:
         post(f'{simple_app}/bad_path', 'abc')
     assert 'failed with exit-code' in str(error.value)
+
+
+def test_http_client(simple_app):
+    client = HTTPClient(pool_size=2, retries=1, backoff=0)
+    assert client.get(f'{simple_app}/flaky') == 'xyz'
+    assert client.post(f'{simple_app}/flaky', 'abc', idempotent=True) == 'xyz'
+    # a POST request that was handled is not retried by default, so it is not handled twice
+    with pytest.raises(Exception) as error:
+        client.post(f'{simple_app}/flaky', 'abc')
+    assert 'failed with exit-code 503' in str(error.value)
+    assert client.post(f'{simple_app}/flaky', 'abc') == 'xyz'
+    client = HTTPClient(retries=0)
+    with pytest.raises(Exception) as error:
+        client.get(f'{simple_app}/flaky')
+    assert 'failed with exit-code 503' in str(error.value)
+    client.close()
+
+
+@pytest.mark.parametrize('error, retried', [(requests.ConnectTimeout(), True), (requests.ReadTimeout(), False),
+                                             (requests.ConnectionError('Connection aborted.'), False)])
+def test_http_client_post_retries(error, retried, monkeypatch):
+    client = HTTPClient(retries=1, backoff=0)
+    calls = []
+
+    def mock_request(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise error
+        return types.SimpleNamespace(status_code=200, text='xyz')
+
+    monkeypatch.setattr(client.session, 'request', mock_request)
+    # a POST request is retried only if it failed before it was sent
+    if retried:
+        assert client.post('http://127.0.0.1:8003/', 'abc') == 'xyz'
+    else:
+        with pytest.raises(type(error)):
+            client.post('http://127.0.0.1:8003/', 'abc')
+    assert len(calls) == (2 if retried else 1)
+    assert client.get('http://127.0.0.1:8003/') == 'xyz'
+
+
+def test_mapped_file(tmp_path):
+    path = tmp_path / 'file.raw'
+    data = os.urandom(1000)
+    path.write_bytes(data)
+    with MappedFile(str(path)) as file:
+        assert bytes(file.read(10)) == data[:10]
+        assert file.seek(-10, io.SEEK_END) == 990
+        assert bytes(file.read()) == data[990:]
+        assert file.read(10) == b''
+
+
+@pytest.mark.parametrize('block_size', [1, 1000, 1 << 20])
+def test_parallel_gzip_file(tmp_path, block_size):
+    # multiple gzip members, some of them contain the gzip magic bytes in their compressed data
+    members = [os.urandom(2000) + b'\x1f\x8b\x08' * i for i in range(20)]
+    path = tmp_path / 'file.gz'
+    path.write_bytes(b''.join(gzip.compress(member, compresslevel=i % 2) for i, member in enumerate(members)))
+    data = b''.join(members)
+    with ParallelGzipFile(str(path), workers=4, block_size=block_size) as file:
+        assert file.read(100) == data[:100]
+        assert file.seek(50, io.SEEK_CUR) == 150
+        assert file.read() == data[150:]
+        assert file.seek(10) == 10
+        assert file.read(10) == data[10:20]
+
+
+def test_parallel_gzip_file_errors(tmp_path):
+    path = tmp_path / 'file.gz'
+    path.write_bytes(gzip.compress(os.urandom(1000))[:-10])
+    with ParallelGzipFile(str(path)) as file:
+        with pytest.raises(EOFError):
+            file.read()
+
+
+def test_transcoder():
+    user = gen_user(mind_pb2.User())
+    snapshot = gen_snapshot_for_client()
+    client_msg = mind_to_client_snapshot(user.SerializeToString(), snapshot.SerializeToString())
+    client_snapshot = client_server_pb2.Snapshot()
+    client_snapshot.ParseFromString(client_msg)
+    assert protobuf2dict(client_snapshot) == protobuf2dict(ServerAgent._construct_snapshot(user, snapshot))
+
+    parsers_msg, color_data, depth_data = client_to_parsers_snapshot(client_msg)
+    parsers_snapshot = server_parsers_pb2.Snapshot()
+    parsers_snapshot.ParseFromString(parsers_msg)
+    assert parsers_snapshot.datetime == snapshot.datetime
+    assert str(parsers_snapshot.user) == str(user)
+    assert str(parsers_snapshot.pose) == str(snapshot.pose)
+    assert str(parsers_snapshot.feelings) == str(snapshot.feelings)
+    assert parsers_snapshot.HasField('feelings')
+    assert parsers_snapshot.color_image.width == snapshot.color_image.width
+    assert parsers_snapshot.depth_image.height == snapshot.depth_image.height
+    assert bytes(color_data) == snapshot.color_image.data
+    assert np.frombuffer(depth_data, dtype='<f4').tolist() == list(snapshot.depth_image.data)
+
+    with pytest.raises(ValueError):
+        client_to_parsers_snapshot(client_msg[:-1])
+
+
+def test_protobuf2python():
+    user = gen_user(mind_pb2.User())
+    snapshot = gen_snapshot_for_client()
+    snapshot.feelings.hunger = 0.3
+    snapshot.feelings.exhaustion = 0.123456789  # rounded to 9 digits
+    snapshot.feelings.thirst = float('inf')
+    snapshot.feelings.happiness = float('nan')
+    assert protobuf2python(user) == protobuf2dict(user)
+    assert protobuf2python(snapshot) == protobuf2dict(snapshot)
+    snapshot.ClearField('pose')
+    assert protobuf2python(snapshot) == protobuf2dict(snapshot)
+
+
+def supervised_worker(pids, crash_path):
+    pids.send(os.getpid())
+    try:
+        # the first worker to start crashes
+        with open(crash_path, 'x'):
+            pass
+        sys.exit(1)
+    except FileExistsError:
+        time.sleep(60)
+
+
+def test_supervisor(tmp_path):
+    # a pipe, and not a queue, so the workers have no feeder thread that might receive their SIGTERM
+    started_pids, pids = multiprocessing.Pipe(duplex=False)
+    supervisor = Supervisor(supervised_worker, args=(pids, str(tmp_path / 'crash')), workers=2, restart_delay=0.1,
+                            shutdown_timeout=5)
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    try:
+        # two workers, and the one that replaced the crashed worker
+        started = set()
+        for _ in range(3):
+            assert started_pids.poll(10)
+            started.add(started_pids.recv())
+    finally:
+        supervisor.stop()
+        thread.join()
+    assert len(started) == 3
+    assert supervisor.restarts == 1
+    assert not any(process.is_alive() for process in supervisor.processes)
+    # stopped gracefully by SIGTERM
+    assert [process.exitcode for process in supervisor.processes] == [0, 0]
+
+
+def test_cli_dead_letters(monkeypatch):
+    class MockRabbitMQ:
+        def __init__(self, url):
+            assert url == MQ_URL
+
+        def get_dead_letters(self, count):
+            assert count == 5
+            return [{'queue': 'saver_pose', 'attempts': 5, 'error': 'Bad message', 'body': b'abc'}]
+
+        def replay_dead_letters(self, queue, count):
+            assert (queue, count) == ('saver_pose', None)
+            return 3
+
+        def purge_dead_letters(self):
+            return 2
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(brain.utils.__main__, 'RabbitMQ', MockRabbitMQ)
+    runner = click.testing.CliRunner()
+    res = runner.invoke(cli, ['dead-letters', '-n', '5'])
+    assert res.exit_code == 0, res.exception
+    assert json.loads(res.stdout.splitlines()[-1]) == {'queue': 'saver_pose', 'attempts': 5, 'error': 'Bad message',
+                                                       'size': 3}
+    res = runner.invoke(cli, ['-m', MQ_URL, 'replay-dead-letters', '-q', 'saver_pose'])
+    assert res.exit_code == 0, res.exception
+    assert 'Replayed 3 dead letters' in res.stdout
+    res = runner.invoke(cli, ['purge-dead-letters'])
+    assert res.exit_code == 0, res.exception
+    assert 'Deleted 2 dead letters' in res.stdout
+
+
+@pytest.mark.parametrize('name', list(codec.CODECS))
+def test_codec(name):
+    obj = {'uuid': '123', 'datetime': 1588175541234, 'user': {'user_id': '42', 'username': 'Jöe', 'gender': 1},
+           'result': {'x': 0.1, 'y': -2.5, 'values': [None, True, False, -1, -64, 2 ** 70, 'a' * 1000]}}
+    data, content_type, content_encoding = codec.encode(obj, name)
+    assert (content_type, content_encoding) == (codec.CODECS[name], None)
+    assert codec.decode(data, content_type) == obj
+    # large messages are compressed
+    compressed, content_type, content_encoding = codec.encode(obj, name, compress_threshold=100)
+    assert content_encoding == codec.ZLIB_ENCODING
+    assert len(compressed) < len(data)
+    assert codec.decode(compressed, content_type, content_encoding) == obj
+    assert codec.encode(obj, name, compress_threshold=len(data)) == (data, content_type, None)
+
+
+def test_codec_binary():
+    obj = {'uuid': '123', 'datetime': 1588175541234, 'result': {'x': 0.1, 'data': b'\x00\xff'}}
+    data, content_type, _ = codec.encode(obj, 'binary')
+    assert codec.decode(data, content_type) == obj
+    obj.pop('result')
+    assert len(codec.encode(obj, 'binary')[0]) < len(codec.encode(obj, 'json')[0])
+    # messages without content type are JSON
+    assert codec.decode(json.dumps(obj)) == obj
+    with pytest.raises(ValueError):
+        codec.decode(data + b'N', content_type)
+    with pytest.raises(TypeError):
+        codec.encode({'x': object()}, 'binary')
+    with pytest.raises(NotImplementedError):
+        codec.encode(obj, 'xml')
+    with pytest.raises(NotImplementedError):
+        codec.decode(data, 'application/xml')